@@ -2,13 +2,19 @@
 
 import os
 import threading
-import time
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, Response
 from dotenv import load_dotenv
 from recorder import AudioRecorder
 from speech_to_text_test import SpeechToText
-from text_to_speech_test import ResponseSpeaker
 from command_classifier_claude import CommandClassifier
+from streaming_stt import StreamingTranscriber
+from tts_cache import TTSCache
+from session_manager import SessionManager, SessionLimitError, utterance_from_upload
+from aws_clients import client_stats, create_client
+from tracing import default_tracer
+from keyword_spotter import CONTROL_KEYWORDS, create_spotter
+from wake_gate import SLEEP_WORDS, WAKE_WORDS, WakeWordGate
+from echo_canceller import EchoCanceller, PlaybackReference
 from flask_cors import CORS
 
 # 載入環境變數
@@ -17,100 +23,129 @@ load_dotenv(os.path.join(os.path.dirname(__file__), 'config', '.env'))
 app = Flask(__name__)
 CORS(app)  # ✅ 開啟全域 CORS 支援
 
-# 初始化主要元件
-recorder = AudioRecorder()
-transcriber = SpeechToText()
-speaker = ResponseSpeaker()
-classifier = CommandClassifier()
+# ====== Session / 管線參數 ======
+# 每個裝置一個 session（各自的佇列、狀態、事件、語速），STT / LLM / TTS 客戶端全部共用
+MAX_SESSIONS = int(os.getenv('MAX_SESSIONS', '64'))
+SESSION_IDLE_TIMEOUT = float(os.getenv('SESSION_IDLE_TIMEOUT', '600'))
+MAX_CONCURRENT_TURNS = int(os.getenv('MAX_CONCURRENT_TURNS', '16'))
+AWS_MAX_POOL_CONNECTIONS = int(os.getenv('AWS_MAX_POOL_CONNECTIONS', str(MAX_CONCURRENT_TURNS * 2)))
+# 本機麥克風 session：錄音執行緒只負責把語句放進佇列，STT → 分類 → 回應由 worker 執行
+# 同一個 session 只有一支麥克風、一個喇叭與一份對話記憶，每輪依序處理；併發來自多個 session
+PIPELINE_WORKERS = int(os.getenv('PIPELINE_WORKERS', '1'))
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', '4'))
+PIPELINE_QUEUE_POLICY = os.getenv('PIPELINE_QUEUE_POLICY', 'merge')
+# 串流辨識：說話途中就送出重疊切片給 Whisper
+STREAMING_STT = os.getenv('STREAMING_STT', 'true').lower() == 'true'
+# 每輪對話（STT → 分類 → 回應）的 AWS 呼叫時間預算
+TURN_BUDGET_SECONDS = float(os.getenv('TURN_BUDGET_SECONDS', '15'))
+LOCAL_SESSION_ID = "local"
+# 裝置端關鍵詞偵測：「停 / 慢一點 / 快一點 / 恢復正常」在本機辨識，不送 Whisper（需先錄製樣板）
+KWS_ENABLED = os.getenv('KWS_ENABLED', 'true').lower() == 'true'
+# 喚醒詞：說「你好」進入對話模式、「再見」或閒置 WAKE_TIMEOUT 秒後休眠，休眠時不呼叫 Whisper（需錄製「你好」樣板）
+WAKE_WORD_ENABLED = os.getenv('WAKE_WORD_ENABLED', 'true').lower() == 'true'
+# 回音消除：以播放中的 PCM 為參考扣掉喇叭回音，播放中使用者開口即可插話打斷
+AEC_ENABLED = os.getenv('AEC_ENABLED', 'true').lower() == 'true'
+
+
+def pooled_client(service_name, region_name):
+    """所有 session 共用的 AWS 客戶端：連線池大小依同時回應數調整，並加上期限、重試與斷路器"""
+    return create_client(service_name, region_name, max_pool_connections=AWS_MAX_POOL_CONNECTIONS)
+
+
+# 初始化共用元件
+keyword_spotter = create_spotter(CONTROL_KEYWORDS + WAKE_WORDS + SLEEP_WORDS) if KWS_ENABLED else None
+recorder = AudioRecorder(keyword_spotter=keyword_spotter)
+transcriber = SpeechToText(runtime=pooled_client("sagemaker-runtime", os.getenv('AWS_REGION', 'us-west-2')))
+classifier = CommandClassifier(client=pooled_client("bedrock-runtime", os.getenv('AWS_REGION', 'us-west-2')))
+tts_cache = TTSCache(
+    cache_dir=os.getenv('TTS_CACHE_DIR') or None,
+    max_disk_bytes=int(float(os.getenv('TTS_CACHE_MAX_MB', '200')) * 1024 * 1024)
+)
+streaming_transcriber = (StreamingTranscriber(transcriber, max_workers=max(4, MAX_CONCURRENT_TURNS))
+                         if STREAMING_STT else None)
+
+tracer = default_tracer()
+sessions = SessionManager(
+    transcriber, classifier, pooled_client("polly", "us-east-1"), tts_cache,
+    streaming_transcriber=streaming_transcriber,
+    max_sessions=MAX_SESSIONS,
+    idle_timeout=SESSION_IDLE_TIMEOUT,
+    max_concurrent_turns=MAX_CONCURRENT_TURNS,
+    queue_size=PIPELINE_QUEUE_SIZE,
+    queue_policy=PIPELINE_QUEUE_POLICY,
+    turn_budget=TURN_BUDGET_SECONDS,
+    tracer=tracer
+)
+# ✅ 本機麥克風與喇叭是其中一個 session，原本的 /process_audio、/events 等路由都對應到它
+local_session = sessions.create(LOCAL_SESSION_ID, local=True, num_workers=PIPELINE_WORKERS)
+if WAKE_WORD_ENABLED and keyword_spotter and any(word in keyword_spotter.templates for word in WAKE_WORDS):
+    recorder.wake_gate = WakeWordGate(
+        is_busy=lambda: local_session.state != "idle" or local_session.speaker.check_audio(),
+        on_change=lambda state, reason: local_session.events.publish("wake", {"state": state, "reason": reason}))
+if AEC_ENABLED:
+    playback_reference = PlaybackReference(sample_rate=recorder.sample_rate)
+    recorder.echo_canceller = EchoCanceller(reference=playback_reference,
+                                            frame_size=int(recorder.sample_rate * recorder.frame_ms / 1000),
+                                            sample_rate=recorder.sample_rate)
+    local_session.speaker.reference = playback_reference
 
 # ====== 持續監聽控制參數 ======
 listening_thread = None
 stop_listening = False
-cur_state = "idle"
-latest_response_text = ""
-has_new_response = False
+
 # ====== 核心功能 ======
 
 
-def handle_heard_audio(audio_path):
-    global cur_state, stop_listening, latest_response_text, has_new_response
+def listen_forever():
+    global stop_listening
+    stop_listening = False
+    local_session.workers.start()
 
-    if stop_listening:
-        return
-    
-    transcript_text = transcriber.transcribe_file(audio_path)
-    if not transcript_text:
-        return
-
-    if process_command(transcript_text):
-        return
-    if speaker.check_audio():
-        return
-    
-    cur_state = "thinking"
-    command_type = classifier.classify_command(transcript_text)
-
-    response = ""
-    if command_type == '聊天':
-        response = classifier.chat_with_gemini(transcript_text)
-        classifier.save_chat_history(transcript_text, response, command_type)
-    elif command_type == '查詢':
-        response = classifier.handle_query(transcript_text)
-        classifier.save_query_history(transcript_text, response, command_type)
-    elif command_type == '行動':
-        response = classifier.handle_movement(transcript_text)
-        classifier.save_movement_history(transcript_text, response, command_type)
-
-    if command_type == "行動" and isinstance(response, dict) and "說明" in response and "動作順序" in response:
-        description_list = response["說明"]
-        code_list = response["動作順序"]
-        combined = [f"{code}，{desc}" for code, desc in zip(code_list, description_list)]
-        response_text = "\n".join(combined)
-    elif isinstance(response, str):
-        response_text = response
-    else:
-        response_text = "⚠️ 無法識別命令"
-
-    speaker.speak(response_text)
-    cur_state = "talking"
-
-    latest_response_text = response_text
-    has_new_response = True
+    def on_frame_captured(utterance):
+        # ✅ 只入佇列，不在錄音執行緒上做 STT / LLM / TTS，避免 stream.read 停擺造成 overflow
+        if not stop_listening:
+            local_session.submit(utterance)
 
+    def on_speech_frame(utterance):
+        if utterance.stream_session:
+            utterance.stream_session.feed()
 
-    
+    def on_speech_discard(utterance):
+        if utterance.stream_session:
+            utterance.stream_session.cancel()
 
-def process_command(text):
-    """根據語音指令調整朗讀速度或中斷朗讀"""
-    global cur_state
-    if "停" in text:
-        speaker.stop_audio()
-        cur_state = "idle"
-        return True
-    elif "慢一點" in text:
-        speaker.set_rate("80%")
-        return True
-    elif "快一點" in text:
-        speaker.set_rate("130%")
-        return True
-    elif "正常" in text or "恢復正常" in text:
-        speaker.set_rate("100%")
-        return True
-    else:
-        return False
-    
+    recorder.listen_forever(on_heard_callback=on_frame_captured,
+                            on_speech_start=local_session.start_streaming,
+                            on_speech_frame=on_speech_frame,
+                            on_speech_discard=on_speech_discard,
+                            on_keyword=local_session.handle_keyword,
+                            on_barge_in=local_session.barge_in)
 
-def listen_forever():
-    global cur_state,stop_listening
-    stop_listening = False
 
-    def on_frame_captured(audio_path):
-        global cur_state
-        if(cur_state == "talking" and speaker.check_audio() == False):
-            cur_state = "idle"
-        handle_heard_audio(audio_path)
+def sse_response(session):
+    """SSE 推播：state / transcript / reply_delta / reply（遠端 session 另有 reply_audio）事件
+
+    斷線重連時瀏覽器會帶 Last-Event-ID，從該游標之後補送；新連線先送一次目前狀態。
+    """
+    cursor = request.headers.get('Last-Event-ID', type=int)
+    if cursor is None:
+        cursor = request.args.get('since', type=int)
+
+    def generate(cursor):
+        if cursor is None:
+            cursor = session.events.latest_id
+            yield f"event: state\ndata: {{\"state\": \"{session.state}\"}}\n\n"
+        yield from session.events.stream(cursor)
+
+    return Response(generate(cursor), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
-    recorder.listen_forever(on_heard_callback=on_frame_captured)
+
+def session_or_404(session_id):
+    session = sessions.get(session_id)
+    if session is None:
+        return None, (jsonify({"error": f"session {session_id} 不存在"}), 404)
+    return session, None
 
 # ====== API ======
 
@@ -150,22 +185,125 @@ def process_audio():
 #     stop_listening = True
 #     return jsonify({"message": "Listening stopped."})
 
-cunt = 0
 @app.route('/audio_status', methods=['GET'])
 def audio_status():
-    global cur_state,cunt, latest_response_text, has_new_response
-
-    if cur_state == "talking" and speaker.check_audio() == False:
-        cur_state = "idle"
-
-    response = {
-        "state": cur_state,
-        "has_new": has_new_response,
-        "reply": latest_response_text
-    }
-    has_new_response = False
-    latest_response_text = ""
-    return jsonify(response)
+    """相容舊版輪詢：不再清除狀態，以 since（上次拿到的 cursor）判斷是否有新回覆"""
+    since = request.args.get('since', default=0, type=int)
+    reply = local_session.events.latest("reply")
+    has_new = reply is not None and reply["id"] > since
+    return jsonify({
+        "state": local_session.state,
+        "has_new": has_new,
+        "reply": reply["data"]["text"] if has_new else "",
+        "cursor": reply["id"] if reply else since
+    })
+
+@app.route('/events', methods=['GET'])
+def event_stream():
+    return sse_response(local_session)
+
+@app.route('/pipeline_stats', methods=['GET'])
+def pipeline_stats():
+    """回傳佇列深度、丟棄/合併次數與 worker 忙碌狀況（背壓指標）"""
+    return jsonify({
+        "queue": local_session.queue.stats(),
+        "workers": local_session.workers.stats(),
+        "tts_cache": tts_cache.stats(),
+        "search_cache": classifier.search_cache.stats(),
+        "speculation": classifier.speculator.stats.stats(),
+        "plan_cache": classifier.plan_cache.stats(),
+        "aws": client_stats(),
+        "tracing": tracer.stats(),
+        "keyword_spotter": recorder.keyword_spotter.stats() if recorder.keyword_spotter else None,
+        "keyword_skipped": recorder.keyword_skipped,
+        "wake_gate": recorder.wake_gate.stats() if recorder.wake_gate else None,
+        "echo_canceller": recorder.echo_canceller.stats() if recorder.echo_canceller else None,
+        "playback": local_session.speaker.player.stats() if local_session.speaker.player else None,
+        "sessions": sessions.stats()
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus 格式：各階段耗時與 time-to-first-audio 直方圖"""
+    return Response(tracer.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/history', methods=['GET'])
+def history():
+    """查詢歷史紀錄：kind（chat/query/movement/transcript）、session_id、command_type、since/until（epoch 秒）、q、limit"""
+    args = request.args
+    records = classifier.history.query(
+        kind=args.get('kind'),
+        session_id=args.get('session_id'),
+        command_type=args.get('command_type'),
+        since=args.get('since', type=float),
+        until=args.get('until', type=float),
+        text=args.get('q'),
+        limit=min(args.get('limit', default=50, type=int), 500)
+    )
+    return jsonify({"records": records, "stats": classifier.history.stats()})
+
+# ====== 多裝置 Session API ======
+
+@app.route('/sessions', methods=['POST'])
+def create_session():
+    """建立 session；body 可帶 {"session_id": "..."}（例如機器人序號），已存在則沿用"""
+    data = request.get_json(silent=True) or {}
+    try:
+        session = sessions.create(data.get('session_id'))
+    except SessionLimitError as e:
+        return jsonify({"error": str(e)}), 503
+    return jsonify({"session_id": session.session_id, "state": session.state}), 201
+
+@app.route('/sessions', methods=['GET'])
+def list_sessions():
+    return jsonify(sessions.stats())
+
+@app.route('/sessions/<session_id>', methods=['GET'])
+def session_status(session_id):
+    session, error = session_or_404(session_id)
+    if error:
+        return error
+    return jsonify(session.stats())
+
+@app.route('/sessions/<session_id>', methods=['DELETE'])
+def close_session(session_id):
+    if session_id == LOCAL_SESSION_ID or not sessions.close(session_id):
+        return jsonify({"error": f"session {session_id} 不存在或無法關閉"}), 404
+    return jsonify({"message": "Session closed."})
+
+@app.route('/sessions/<session_id>/audio', methods=['POST'])
+def upload_audio(session_id):
+    """上傳一段已切好的語句：WAV，或 16-bit mono PCM（以 ?sample_rate= 指定取樣率，預設 16000）"""
+    session, error = session_or_404(session_id)
+    if error:
+        return error
+    try:
+        utterance = utterance_from_upload(request.get_data(),
+                                          sample_rate=request.args.get('sample_rate', default=16000, type=int),
+                                          content_type=request.mimetype)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    accepted = session.submit(utterance)
+    return jsonify({"accepted": accepted, "duration": round(utterance.duration, 2),
+                    "queue": session.queue.stats()}), 202 if accepted else 429
+
+@app.route('/sessions/<session_id>/events', methods=['GET'])
+def session_events(session_id):
+    session, error = session_or_404(session_id)
+    if error:
+        return error
+    return sse_response(session)
+
+@app.route('/sessions/<session_id>/clips/<int:clip_id>', methods=['GET'])
+def session_clip(session_id, clip_id):
+    """下載 reply_audio 事件中的語音段落"""
+    session, error = session_or_404(session_id)
+    if error:
+        return error
+    audio = session.clips.get(clip_id)
+    if audio is None:
+        return jsonify({"error": "clip 不存在或已過期"}), 404
+    return Response(audio, mimetype='audio/mpeg')
 
 if __name__ == '__main__':
     #listen_forever()
@@ -0,0 +1,278 @@
+"""多裝置 session API 的 ASGI 版本（asyncio 管線，不依賴 Web 框架）
+
+    uvicorn asgi_app:app --port 5002
+
+路由與 app.py 的 /sessions 系列相同：
+    POST   /sessions                          建立 session（body 可帶 {"session_id": "..."}）
+    GET    /sessions                          所有 session 狀態
+    GET    /sessions/<id>                     單一 session 狀態
+    DELETE /sessions/<id>                     關閉 session
+    POST   /sessions/<id>/audio               上傳一段語句（WAV 或 16-bit PCM，?sample_rate=）
+    GET    /sessions/<id>/events              SSE 事件
+    GET    /sessions/<id>/clips/<clip_id>     下載合成好的語音段落
+"""
+import json
+import os
+import re
+from urllib.parse import parse_qs
+from dotenv import load_dotenv
+from speech_to_text_test import SpeechToText
+from command_classifier_claude import CommandClassifier
+from tts_cache import TTSCache
+from session_manager import SessionLimitError, utterance_from_upload
+from async_pipeline import AsyncPipeline
+
+load_dotenv(os.path.join(os.path.dirname(__file__), 'config', '.env'))
+
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', str(2 * 1024 * 1024)))  # 16 kHz 16-bit 約 65 秒
+
+ROUTES = []
+
+
+def route(method, pattern):
+    def register(handler):
+        ROUTES.append((method, re.compile(f"^{pattern}$"), handler))
+        return handler
+    return register
+
+
+def build_pipeline():
+    return AsyncPipeline(
+        SpeechToText(),
+        CommandClassifier(),
+        TTSCache(cache_dir=os.getenv('TTS_CACHE_DIR') or None,
+                 max_disk_bytes=int(float(os.getenv('TTS_CACHE_MAX_MB', '200')) * 1024 * 1024)),
+        max_sessions=int(os.getenv('MAX_SESSIONS', '256')),
+        idle_timeout=float(os.getenv('SESSION_IDLE_TIMEOUT', '600')),
+        max_concurrent_turns=int(os.getenv('MAX_CONCURRENT_TURNS', '64')),
+        executor_workers=int(os.getenv('ASYNC_EXECUTOR_WORKERS', '8')),
+        queue_size=int(os.getenv('PIPELINE_QUEUE_SIZE', '4')),
+        queue_policy=os.getenv('PIPELINE_QUEUE_POLICY', 'merge'),
+        turn_budget=float(os.getenv('TURN_BUDGET_SECONDS', '15'))
+    )
+
+
+class Request:
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.query = {k: v[-1] for k, v in parse_qs(scope.get("query_string", b"").decode()).items()}
+        self.headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+
+    @property
+    def mimetype(self):
+        return self.headers.get("content-type", "").split(";")[0].strip() or None
+
+    async def body(self, limit=MAX_UPLOAD_BYTES):
+        """讀取完整 body；超過 limit 時拋出 ValueError"""
+        chunks = []
+        size = 0
+        while True:
+            message = await self.receive()
+            if message["type"] == "http.disconnect":
+                raise ConnectionError("客戶端已斷線")
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > limit:
+                raise ValueError(f"上傳內容超過 {limit} 位元組")
+            chunks.append(chunk)
+            if not message.get("more_body"):
+                return b"".join(chunks)
+
+    async def json(self):
+        data = await self.body()
+        try:
+            return json.loads(data) if data else {}
+        except ValueError:
+            return {}
+
+
+async def send_response(send, status, body, content_type="application/json", headers=()):
+    if not isinstance(body, (bytes, bytearray)):
+        body = json.dumps(body, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode()),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"access-control-allow-origin", b"*"), *headers],
+    })
+    await send({"type": "http.response.body", "body": bytes(body)})
+
+
+def session_or_404(pipeline, session_id):
+    session = pipeline.get(session_id)
+    if session is None:
+        return None, (404, {"error": f"session {session_id} 不存在"})
+    return session, None
+
+
+@route("POST", r"/sessions")
+async def create_session(pipeline, request, send):
+    data = await request.json()
+    try:
+        session = pipeline.create(data.get("session_id"))
+    except SessionLimitError as e:
+        return 503, {"error": str(e)}
+    return 201, {"session_id": session.session_id, "state": session.state}
+
+
+@route("GET", r"/sessions")
+async def list_sessions(pipeline, request, send):
+    return 200, pipeline.stats()
+
+
+@route("GET", r"/sessions/(?P<session_id>[^/]+)")
+async def session_status(pipeline, request, send, session_id):
+    session, error = session_or_404(pipeline, session_id)
+    return error or (200, session.stats())
+
+
+@route("DELETE", r"/sessions/(?P<session_id>[^/]+)")
+async def close_session(pipeline, request, send, session_id):
+    if not pipeline.close_session(session_id):
+        return 404, {"error": f"session {session_id} 不存在"}
+    return 200, {"message": "Session closed."}
+
+
+@route("POST", r"/sessions/(?P<session_id>[^/]+)/audio")
+async def upload_audio(pipeline, request, send, session_id):
+    session, error = session_or_404(pipeline, session_id)
+    if error:
+        return error
+    try:
+        data = await request.body()
+        utterance = utterance_from_upload(data, sample_rate=int(request.query.get("sample_rate", 16000)),
+                                          content_type=request.mimetype)
+    except ValueError as e:
+        return 400, {"error": str(e)}
+    accepted = session.submit(utterance)
+    return 202 if accepted else 429, {"accepted": accepted, "duration": round(utterance.duration, 2),
+                                      "queue": session.queue.stats()}
+
+
+@route("GET", r"/sessions/(?P<session_id>[^/]+)/events")
+async def session_events(pipeline, request, send, session_id):
+    """SSE：從 Last-Event-ID（或 ?since=）之後補送，新連線先送一次目前狀態"""
+    session, error = session_or_404(pipeline, session_id)
+    if error:
+        return error
+    cursor = request.headers.get("last-event-id") or request.query.get("since")
+    if cursor is not None:
+        # 回應開始後就不能再回錯誤碼，游標要先驗證
+        try:
+            cursor = int(cursor)
+        except ValueError:
+            cursor = -1
+        if cursor < 0:
+            return 400, {"error": "Last-Event-ID / since 必須是非負整數"}
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache"),
+                    (b"x-accel-buffering", b"no"), (b"access-control-allow-origin", b"*")],
+    })
+    if cursor is None:
+        cursor = session.events.latest_id
+        snapshot = f"event: state\ndata: {json.dumps({'state': session.state})}\n\n"
+        await send({"type": "http.response.body", "body": snapshot.encode(), "more_body": True})
+    try:
+        async for message in session.events.stream_async(cursor):
+            await send({"type": "http.response.body", "body": message.encode("utf-8"), "more_body": True})
+    except OSError:
+        # 客戶端斷線
+        pass
+    return None
+
+
+@route("GET", r"/sessions/(?P<session_id>[^/]+)/clips/(?P<clip_id>\d+)")
+async def session_clip(pipeline, request, send, session_id, clip_id):
+    session, error = session_or_404(pipeline, session_id)
+    if error:
+        return error
+    audio = session.clips.get(int(clip_id))
+    if audio is None:
+        return 404, {"error": "clip 不存在或已過期"}
+    await send_response(send, 200, audio, content_type="audio/mpeg")
+    return None
+
+
+@route("GET", r"/metrics")
+async def metrics(pipeline, request, send):
+    await send_response(send, 200, pipeline.tracer.render().encode("utf-8"),
+                        content_type="text/plain; version=0.0.4")
+    return None
+
+
+class VoiceAssistantApp:
+    """ASGI 應用：lifespan 時啟動 / 關閉 AsyncPipeline，HTTP 請求依 ROUTES 分派"""
+
+    def __init__(self, pipeline_factory=build_pipeline):
+        self.pipeline_factory = pipeline_factory
+        self.pipeline = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.startup()
+                except Exception as e:
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def startup(self):
+        self.pipeline = self.pipeline_factory()
+        await self.pipeline.start()
+
+    async def shutdown(self):
+        if self.pipeline:
+            await self.pipeline.close()
+            self.pipeline = None
+
+    async def _http(self, scope, receive, send):
+        request = Request(scope, receive)
+        if request.method == "OPTIONS":
+            await send_response(send, 204, b"", headers=[
+                (b"access-control-allow-methods", b"GET, POST, DELETE, OPTIONS"),
+                (b"access-control-allow-headers", b"content-type, last-event-id")])
+            return
+        if self.pipeline is None:
+            await send_response(send, 503, {"error": "管線尚未啟動"})
+            return
+
+        allowed = False
+        for method, pattern, handler in ROUTES:
+            match = pattern.match(request.path)
+            if not match:
+                continue
+            allowed = True
+            if method != request.method:
+                continue
+            try:
+                result = await handler(self.pipeline, request, send, **match.groupdict())
+            except ConnectionError:
+                return
+            if result is not None:
+                await send_response(send, *result)
+            return
+        if allowed:
+            await send_response(send, 405, {"error": "method not allowed"})
+        else:
+            await send_response(send, 404, {"error": "not found"})
+
+
+app = VoiceAssistantApp()
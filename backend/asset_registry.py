@@ -0,0 +1,152 @@
+import os
+import json
+import threading
+import time
+
+COMMAND_TYPES = ('聊天', '查詢', '行動')
+TEXT_PLACEHOLDER = "\x00TEXT\x00"
+
+
+class AssetSnapshot:
+    """某一版資產的內容與預先組好的提示詞片段（不可變）"""
+
+    def __init__(self, reference_data, movement_data, version):
+        self.reference_data = reference_data
+        self.movement_data = movement_data
+        self.version = version
+        self.fields = {
+            "examples": "\n".join(f"- 輸入：{item['command']}  類型：{item['command_type']}" for item in reference_data),
+            "action_list": json.dumps(movement_data['動作清單'], ensure_ascii=False, indent=2),
+            "task_examples": json.dumps(movement_data['任務拆解'], ensure_ascii=False, indent=2),
+            "action_list_compact": json.dumps(movement_data['動作清單'], ensure_ascii=False),
+            "task_examples_compact": json.dumps(movement_data['任務拆解'], ensure_ascii=False),
+        }
+        self._prompts = {}
+        self._lock = threading.Lock()
+
+    def prompt_parts(self, template):
+        """把模板中除了 {text} 以外的欄位先填好，回傳 (前綴, 後綴)"""
+        parts = self._prompts.get(template)
+        if parts is None:
+            rendered = template.format(text=TEXT_PLACEHOLDER, **self.fields)
+            prefix, _, suffix = rendered.partition(TEXT_PLACEHOLDER)
+            parts = (prefix, suffix)
+            with self._lock:
+                self._prompts[template] = parts
+        return parts
+
+    def render(self, template, text):
+        prefix, suffix = self.prompt_parts(template)
+        return prefix + text + suffix
+
+
+def validate_command_types(data):
+    if not isinstance(data, list) or not data:
+        raise ValueError("command_type.json 必須是非空陣列")
+    for i, item in enumerate(data):
+        if not isinstance(item, dict) or not isinstance(item.get('command'), str):
+            raise ValueError(f"command_type.json 第 {i} 筆缺少 command")
+        if item.get('command_type') not in COMMAND_TYPES:
+            raise ValueError(f"command_type.json 第 {i} 筆類型錯誤: {item.get('command_type')}")
+
+
+def validate_movement(data):
+    if not isinstance(data, dict):
+        raise ValueError("movement_deployment.json 必須是物件")
+    actions = data.get('動作清單')
+    if not isinstance(actions, dict) or not actions:
+        raise ValueError("movement_deployment.json 缺少 動作清單")
+    tasks = data.get('任務拆解')
+    if not isinstance(tasks, list):
+        raise ValueError("movement_deployment.json 缺少 任務拆解")
+    for i, task in enumerate(tasks):
+        if not isinstance(task, dict) or not isinstance(task.get('任務'), str):
+            raise ValueError(f"任務拆解第 {i} 筆缺少 任務")
+        codes = task.get('動作順序')
+        if not isinstance(codes, list) or not isinstance(task.get('說明'), list):
+            raise ValueError(f"任務拆解第 {i} 筆缺少 動作順序 或 說明")
+        unknown = [code for code in codes if str(code) not in actions]
+        if unknown:
+            raise ValueError(f"任務拆解第 {i} 筆使用未定義的動作代號: {unknown}")
+
+
+class AssetRegistry:
+    """集中載入並驗證 assets/command_type.json 與 assets/movement_deployment.json
+
+    - 只在啟動與檔案修改時間改變時讀檔（最多每 check_interval 秒檢查一次 mtime）
+    - 重新載入失敗（JSON 錯誤、驗證不過）時保留舊版本並印出警告
+    - 每個版本的提示詞前綴/後綴只組一次，每次請求只剩字串串接
+    """
+
+    FILES = {
+        "command_type": "command_type.json",
+        "movement": "movement_deployment.json",
+    }
+
+    def __init__(self, assets_dir=None, check_interval=1.0):
+        self.assets_dir = assets_dir or os.path.abspath(os.path.join(os.path.dirname(__file__), 'assets'))
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtimes = {}
+        self._last_check = 0.0
+        self._snapshot = None
+        self._load()
+
+    def _path(self, name):
+        return os.path.join(self.assets_dir, self.FILES[name])
+
+    def _current_mtimes(self):
+        return {name: os.stat(self._path(name)).st_mtime_ns for name in self.FILES}
+
+    def _load(self):
+        mtimes = self._current_mtimes()
+        with open(self._path("command_type"), 'r', encoding='utf-8') as f:
+            reference_data = json.load(f)
+        with open(self._path("movement"), 'r', encoding='utf-8') as f:
+            movement_data = json.load(f)
+        validate_command_types(reference_data)
+        validate_movement(movement_data)
+
+        version = self._snapshot.version + 1 if self._snapshot else 1
+        self._snapshot = AssetSnapshot(reference_data, movement_data, version)
+        self._mtimes = mtimes
+
+    def refresh(self):
+        """檔案有變動時重新載入，回傳目前的版本快照"""
+        now = time.time()
+        if now - self._last_check < self.check_interval:
+            return self._snapshot
+        with self._lock:
+            if now - self._last_check < self.check_interval:
+                return self._snapshot
+            self._last_check = now
+            try:
+                mtimes = self._current_mtimes()
+                if mtimes != self._mtimes:
+                    try:
+                        self._load()
+                        print(f"🔄 已重新載入 assets（版本 {self._snapshot.version}）")
+                    finally:
+                        # 失敗時也記下 mtime，避免每次檢查都重複報錯，等下一次修改再試
+                        self._mtimes = mtimes
+            except (OSError, ValueError) as e:
+                print(f"⚠️ assets 重新載入失敗，沿用舊版本：{e}")
+        return self._snapshot
+
+    def current(self):
+        return self.refresh()
+
+    @property
+    def version(self):
+        return self.current().version
+
+    @property
+    def reference_data(self):
+        return self.current().reference_data
+
+    @property
+    def movement_data(self):
+        return self.current().movement_data
+
+    def render(self, template, text):
+        return self.current().render(template, text)
@@ -0,0 +1,720 @@
+"""asyncio 版本的對話管線：STT → 分類 / 回應 → 搜尋 → TTS 全程不佔用執行緒
+
+安裝 aiobotocore 與 aiohttp 時，SageMaker / Bedrock / Polly 與 Google 搜尋都以非阻塞方式呼叫；
+未安裝時退回在有界的執行緒池中呼叫同步版本，介面相同，只是並行度受限於 executor_workers。
+提示詞、解析、本機快速分類與快取都沿用同步類別，兩個版本的行為一致。
+"""
+import asyncio
+import contextvars
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack
+from audio_buffer import Utterance
+from aws_clients import AsyncResilientClient, service_settings, turn_budget
+from command_classifier_claude import (CHAT_SYSTEM_PROMPT, CLASSIFY_PROMPT, COMBINED_PROMPT, MOVEMENT_PROMPT,
+                                       ReplyStream)
+from conversation_memory import ConversationMemory
+from event_bus import EventBus
+from movement_program import MovementRunner, PlanStream, SimulatedRobot
+from pipeline import UtteranceQueue
+from session_manager import ClipStore, SessionLimitError, parse_control
+from text_segmenter import SentenceSegmenter
+from text_to_speech_test import ResponseSpeaker
+from tracing import current_trace, default_tracer, mark, span
+from tts_cache import TTSCache
+
+# aiobotocore / aiohttp 為可選依賴
+try:
+    from aiobotocore.session import get_session
+    from aiobotocore.config import AioConfig
+except ImportError:
+    get_session = None
+    AioConfig = None
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+async def iterate_in_executor(executor, iterator):
+    """把同步產生器包成 async iterator，每取一個元素才借用一次執行緒"""
+    loop = asyncio.get_running_loop()
+    sentinel = object()
+    while True:
+        item = await loop.run_in_executor(executor, next, iterator, sentinel)
+        if item is sentinel:
+            return
+        yield item
+
+
+async def _aiter_chunks(chunks):
+    if hasattr(chunks, "__aiter__"):
+        async for chunk in chunks:
+            yield chunk
+    else:
+        for chunk in chunks:
+            yield chunk
+
+
+class AsyncClients:
+    """所有 session 共用的非同步客戶端；對應套件未安裝時該屬性為 None"""
+
+    def __init__(self, region=None, polly_region="us-east-1", max_pool_connections=32, http_timeout=5.0):
+        self.region = region or os.getenv('AWS_REGION', 'us-west-2')
+        self.polly_region = polly_region
+        self.max_pool_connections = max_pool_connections
+        self.http_timeout = http_timeout
+        self.sagemaker = None
+        self.bedrock = None
+        self.polly = None
+        self.http = None
+        self._stack = None
+
+    async def start(self):
+        self._stack = AsyncExitStack()
+        if get_session is not None:
+            session = get_session()
+            credentials = {
+                "aws_access_key_id": os.getenv('AWS_ACCESS_KEY_ID'),
+                "aws_secret_access_key": os.getenv('AWS_SECRET_ACCESS_KEY'),
+            }
+            # 與同步版相同的期限、整輪時間預算、斷路器與 hedging（aws_clients.ResilientClient）
+            self.sagemaker = AsyncResilientClient(await self._stack.enter_async_context(session.create_client(
+                "sagemaker-runtime", region_name=self.region, config=self._config("sagemaker-runtime"),
+                **credentials)), "sagemaker-runtime")
+            self.bedrock = AsyncResilientClient(await self._stack.enter_async_context(session.create_client(
+                "bedrock-runtime", region_name=self.region, config=self._config("bedrock-runtime"),
+                **credentials)), "bedrock-runtime")
+            self.polly = AsyncResilientClient(await self._stack.enter_async_context(session.create_client(
+                "polly", region_name=self.polly_region, config=self._config("polly"), **credentials)), "polly")
+        if aiohttp is not None:
+            self.http = await self._stack.enter_async_context(aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_pool_connections),
+                timeout=aiohttp.ClientTimeout(total=self.http_timeout)))
+
+    def _config(self, service_name):
+        """逾時與 adaptive 重試與同步版（aws_clients.build_config）一致"""
+        connect, read, _, _ = service_settings(service_name)
+        return AioConfig(max_pool_connections=self.max_pool_connections, connect_timeout=connect, read_timeout=read,
+                         retries={"mode": "adaptive", "max_attempts": int(os.getenv('AWS_MAX_ATTEMPTS', '3'))})
+
+    async def close(self):
+        if self._stack:
+            await self._stack.aclose()
+            self._stack = None
+        self.sagemaker = self.bedrock = self.polly = self.http = None
+
+    def describe(self):
+        return {
+            "aws": "aiobotocore" if self.bedrock else "executor",
+            "http": "aiohttp" if self.http else "executor",
+        }
+
+    def stats(self):
+        clients = {"sagemaker-runtime": self.sagemaker, "bedrock-runtime": self.bedrock, "polly": self.polly}
+        return {name: client.stats() for name, client in clients.items() if client is not None}
+
+
+class AsyncSpeechToText:
+    """SpeechToText 的非同步介面"""
+
+    def __init__(self, transcriber, clients, executor):
+        self.transcriber = transcriber
+        self.clients = clients
+        self.executor = executor
+
+    async def invoke_endpoint(self, audio_bytes):
+        if self.clients.sagemaker is None:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, self.transcriber.invoke_endpoint, audio_bytes)
+        response = await self.clients.sagemaker.invoke_endpoint(
+            EndpointName=self.transcriber.endpoint_name,
+            ContentType="audio/wav",
+            Body=bytes(audio_bytes)
+        )
+        async with response["Body"] as stream:
+            body = await stream.read()
+        return self.transcriber.parse_endpoint_response(body)
+
+    async def transcribe_bytes(self, audio_bytes, source_name="memory.wav", session_id=None):
+        try:
+            transcript_text, confidence = await self.invoke_endpoint(audio_bytes)
+        except Exception as e:
+            print(f"轉換過程中出現錯誤: {str(e)}")
+            return None
+        # 存檔與繁簡轉換在執行緒池中進行
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.transcriber.finalize_transcript,
+                                          transcript_text, source_name, confidence, session_id)
+
+    async def transcribe_utterance(self, utterance, session_id=None):
+        return await self.transcribe_bytes(utterance.wav_bytes(), utterance.name, session_id)
+
+
+class AsyncCommandClassifier:
+    """CommandClassifier 的非同步 I/O 層
+
+    分類門檻、回應解析、快取與備援都呼叫 CommandClassifier 的共用方法，
+    這裡只負責以非阻塞方式呼叫 Bedrock 與搜尋，流程與同步版本相同。
+    """
+
+    def __init__(self, classifier, clients, executor):
+        self.classifier = classifier
+        self.clients = clients
+        self.executor = executor
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        # 帶著目前的 contextvars（追蹤、時間預算）到執行緒池
+        return await loop.run_in_executor(self.executor, contextvars.copy_context().run, func, *args)
+
+    async def _send_to_model(self, prompt, max_tokens=512, history=None, system=None):
+        classifier = self.classifier
+        if self.clients.bedrock is None:
+            return await self._run(classifier._send_to_model, prompt, max_tokens, history, system)
+        try:
+            response = await self.clients.bedrock.invoke_model(
+                body=classifier.model_request_body(prompt, max_tokens, history, system),
+                modelId=classifier.model_id,
+                contentType="application/json"
+            )
+            async with response["body"] as stream:
+                body = await stream.read()
+            return classifier.parse_model_response(body)
+        except Exception as e:
+            print(f"模型調用錯誤: {str(e)}")
+            return "無法獲取模型回應"
+
+    async def _stream_from_model(self, prompt, max_tokens=512, history=None, system=None):
+        classifier = self.classifier
+        if self.clients.bedrock is None:
+            chunks = classifier._stream_from_model(prompt, max_tokens, history, system)
+            async for text in iterate_in_executor(self.executor, chunks):
+                yield text
+            return
+
+        produced = False
+        try:
+            response = await self.clients.bedrock.invoke_model_with_response_stream(
+                body=classifier.model_request_body(prompt, max_tokens, history, system),
+                modelId=classifier.model_id,
+                contentType="application/json"
+            )
+            async for event in response["body"]:
+                text = classifier.stream_event_text(event)
+                if text:
+                    if not produced:
+                        mark("llm_first_token")
+                    produced = True
+                    yield text
+        except Exception as e:
+            print(f"模型調用錯誤: {str(e)}")
+            if not produced:
+                yield "無法獲取模型回應"
+
+    @staticmethod
+    async def _reply(reply, chunks):
+        """ReplyStream.wrap 的 async 版本"""
+        reply.start()
+        try:
+            async for chunk in chunks:
+                yield reply.feed(chunk)
+            reply.finish()
+        finally:
+            reply.close()
+
+    async def web_search(self, query):
+        classifier = self.classifier
+        if self.clients.http is None:
+            return await self._run(classifier.web_search, query)
+        cached = classifier.search_cache.get_results(query)
+        if cached is not None:
+            return cached
+        try:
+            with span("search"):
+                async with self.clients.http.get(classifier.SEARCH_URL,
+                                                 params=classifier.search_params(query)) as response:
+                    results = classifier.parse_search_results(await response.json(content_type=None))
+        except Exception as e:
+            print(f"搜索出錯: {str(e)}")
+            return []
+        classifier.search_cache.put_results(query, results)
+        return results
+
+    async def respond(self, text, stream=False, memory=None):
+        """分類並產生回應，回傳 (類型, 回應)；stream=True 時聊天與查詢回傳 async generator"""
+        classifier = self.classifier
+        local = classifier._intent().predict(text)
+        uncertain = local[1] < classifier.fastpath_threshold
+        if uncertain and classifier.mode == 'combined':
+            return await self.classify_and_respond(text, stream, memory)
+
+        branches = {}
+        if uncertain and classifier.speculate_search:
+            branches['查詢'] = lambda: self.web_search(text)
+        if uncertain and classifier.speculate_chat:
+            branches['聊天'] = lambda: self.chat(text, memory=memory)
+        if not branches:
+            command_type = await self.classify_command(text, local)
+            return command_type, await self.dispatch(command_type, text, stream=stream, memory=memory)
+
+        command_type, value, used = await classifier.speculator.run_async(
+            lambda: self.classify_command(text, local), branches)
+        if used and command_type == '聊天':
+            return command_type, value
+        return command_type, await self.dispatch(command_type, text, stream=stream,
+                                                 search_results=value if used else None, memory=memory)
+
+    async def dispatch(self, command_type, text, search_query=None, stream=False, search_results=None,
+                       memory=None):
+        if command_type == '查詢':
+            return await self.handle_query(text, search_query, stream, search_results, memory)
+        if command_type == '行動':
+            return await self.handle_movement(text)
+        return await self.chat(text, stream, memory)
+
+    async def classify_and_respond(self, text, stream=False, memory=None):
+        classifier = self.classifier
+        plan = await self._run(classifier.cached_plan, text)
+        if plan is not None:
+            return '行動', plan
+        prompt = classifier.assets.render(COMBINED_PROMPT, text)
+        history, system = classifier.conversation(memory)
+        with span("classify_respond"):
+            result = await self._send_to_model(prompt, max_tokens=1024, history=history, system=system)
+        data = classifier.accept_combined(text, result)
+        if data is None:
+            command_type = await self.classify_command(text)
+            return command_type, await self.dispatch(command_type, text, stream=stream, memory=memory)
+
+        command_type = data['type']
+        if command_type == '查詢':
+            return command_type, await self.handle_query(text, data['search_query'], stream, memory=memory)
+        return command_type, data['response'] if command_type == '聊天' else data['movement_plan']
+
+    async def classify_command(self, text, local=None):
+        classifier = self.classifier
+        local = local or classifier._intent().predict(text)
+        label = classifier.fast_label(local)
+        if label is not None:
+            return label
+        with span("classify"):
+            result = await self._send_to_model(classifier.assets.render(CLASSIFY_PROMPT, text))
+        return classifier.accept_classification(text, local, result)
+
+    async def chat(self, text, stream=False, memory=None):
+        history, system = self.classifier.conversation(memory, CHAT_SYSTEM_PROMPT)
+        if stream:
+            return self._reply(ReplyStream("chat"), self._stream_from_model(text, history=history, system=system))
+        with span("chat"):
+            return (await self._send_to_model(text, history=history, system=system)).strip()
+
+    async def handle_query(self, text, search_query=None, stream=False, search_results=None, memory=None):
+        classifier = self.classifier
+        if search_results is None:
+            search_results = await self.web_search(search_query or text)
+        history, system = classifier.conversation(memory)
+        cached = classifier.cached_answer(text, search_results, history)
+        if cached is not None:
+            return cached
+        prompt = classifier.answer_prompt(text, search_results)
+        if stream:
+            chunks = self._stream_from_model(prompt, history=history, system=system)
+            return self._reply(classifier.answer_stream(text, search_results, history), chunks)
+        with span("answer"):
+            answer = await self._send_to_model(prompt, history=history, system=system)
+        return classifier.accept_answer(text, search_results, history, answer)
+
+    async def handle_movement(self, text):
+        classifier = self.classifier
+        # 第一次查快取可能要讀 SQLite 歷史，放到執行緒池
+        plan = await self._run(classifier.cached_plan, text)
+        if plan is not None:
+            return plan
+        with span("plan"):
+            result = await self._send_to_model(classifier.assets.render(MOVEMENT_PROMPT, text))
+        return classifier.accept_movement(text, classifier.parse_movement_plan(result.strip()))
+
+
+class AsyncResponseSpeaker:
+    """逐段合成語音並交給 audio_sink（遠端裝置下載播放）；語速、聲音與快取設定沿用 ResponseSpeaker"""
+
+    def __init__(self, speaker, clients, executor, audio_sink):
+        self.speaker = speaker
+        self.clients = clients
+        self.executor = executor
+        self.audio_sink = audio_sink
+        self._generation = 0
+        self._synthesizing = 0
+
+    @property
+    def current_rate(self):
+        return self.speaker.current_rate
+
+    def set_rate(self, rate):
+        self.speaker.set_rate(rate)
+
+    async def synthesize(self, text):
+        """合成一段文字（先查快取），回傳音訊 bytes；失敗回傳 None"""
+        speaker = self.speaker
+        loop = asyncio.get_running_loop()
+        if self.clients.polly is None:
+            return await loop.run_in_executor(self.executor, speaker._synthesize, text)
+
+        rate = speaker.current_rate
+        ssml_text = speaker.build_ssml(text, rate)
+        key = TTSCache.make_key(ssml_text, speaker.voice_id, rate, speaker.output_format)
+        audio = await loop.run_in_executor(self.executor, speaker.cache.get, key)
+        if audio is not None:
+            return audio
+        try:
+            with span("tts_synth"):
+                response = await self.clients.polly.synthesize_speech(
+                    Text=ssml_text,
+                    OutputFormat=speaker.output_format,
+                    VoiceId=speaker.voice_id,
+                    LanguageCode=speaker.language_code,
+                    TextType="ssml"
+                )
+                async with response["AudioStream"] as stream:
+                    audio = await stream.read()
+        except Exception as e:
+            print(f"⚠️ Polly 語音合成錯誤：{e}")
+            return None
+        await loop.run_in_executor(self.executor, speaker.cache.put, key, audio,
+                                   speaker.output_format)
+        return audio
+
+    async def speak(self, text, on_first_audio=None, on_segment=None):
+        if not text:
+            return ""
+        return await self.speak_stream([text], on_first_audio, on_segment)
+
+    async def speak_stream(self, chunks, on_first_audio=None, on_segment=None):
+        """chunks 可為一般或 async iterable；邊接收文字邊逐句合成，回傳完整文字"""
+        segmenter = SentenceSegmenter()
+        generation = self._generation
+        parts = []
+        first = [on_first_audio]
+
+        async def emit(segment):
+            audio = await self.synthesize(segment)
+            if audio and generation == self._generation:
+                if first[0]:
+                    first[0]()
+                    first[0] = None
+                self.audio_sink(audio, segment)
+                if on_segment:
+                    on_segment(segment)
+
+        self._synthesizing += 1
+        try:
+            async for chunk in _aiter_chunks(chunks):
+                parts.append(chunk)
+                if generation != self._generation:
+                    break
+                for segment in segmenter.feed(chunk):
+                    await emit(segment)
+            if generation == self._generation:
+                for segment in segmenter.flush():
+                    await emit(segment)
+        finally:
+            self._synthesizing -= 1
+        return "".join(parts)
+
+    def stop_audio(self):
+        self._generation += 1
+
+    def check_audio(self):
+        return self._synthesizing > 0
+
+
+class AsyncSession:
+    """Session 的 asyncio 版本：每個 session 一個 worker task，依序處理該裝置的語句"""
+
+    def __init__(self, session_id, pipeline, queue_size=4, queue_policy="merge", max_clips=32):
+        self.session_id = session_id
+        self.pipeline = pipeline
+        self.local = False
+        self.state = "idle"
+        self.created_at = time.time()
+        self.last_active = self.created_at
+        self.events = EventBus()
+        self.clips = ClipStore(max_clips)
+        self.memory = ConversationMemory(summarize_fn=pipeline.classifier.classifier.summarize_conversation)
+        self.robot = MovementRunner(pipeline.executor_factory(), on_event=self.events.publish)
+        self.turns = 0
+
+        speaker = ResponseSpeaker(client=pipeline.polly_client, cache=pipeline.tts_cache,
+                                  audio_sink=self._store_clip)
+        self.speaker = AsyncResponseSpeaker(speaker, pipeline.clients, pipeline.executor, self._store_clip)
+        self.output_format = speaker.output_format
+        # 與同步版 Session 相同的有界佇列與滿載策略；worker task 以 _queued 喚醒
+        self.queue = UtteranceQueue(maxsize=queue_size, policy=queue_policy, merge_fn=Utterance.concat)
+        self._queued = asyncio.Event()
+        self._handling = False
+        self._worker = asyncio.create_task(self._run())
+
+    def touch(self):
+        self.last_active = time.time()
+
+    def set_state(self, state):
+        if self.state != state:
+            self.state = state
+            self.events.publish("state", {"state": state})
+
+    def _store_clip(self, audio, text):
+        clip_id = self.clips.add(audio)
+        self.events.publish("reply_audio", {
+            "clip": clip_id,
+            "text": text,
+            "format": self.output_format,
+            "url": f"/sessions/{self.session_id}/clips/{clip_id}",
+        })
+
+    def submit(self, utterance):
+        """放入一段語句（在 event loop 上呼叫）；佇列滿時依 queue_policy 丟棄或合併，回傳是否被接受"""
+        self.touch()
+        accepted = self.queue.put(utterance)
+        self._queued.set()
+        return accepted
+
+    async def _run(self):
+        while True:
+            entry = self.queue.get(timeout=0)
+            if entry is None:
+                self._queued.clear()
+                await self._queued.wait()
+                continue
+            utterance, _ = entry
+            self._handling = True
+            try:
+                await self.handle_utterance(utterance)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ 處理語句時發生錯誤: {str(e)}")
+            finally:
+                self._handling = False
+
+    def busy(self):
+        """有排隊中的語句、正在處理一輪對話或正在合成；state 在 STT 期間仍是 idle，不能只看它"""
+        return bool(len(self.queue)) or self._handling or self.speaker.check_audio()
+
+    async def handle_utterance(self, utterance):
+        tracer = self.pipeline.tracer
+        ended_at = utterance.ended_at or time.time()
+        trace = tracer.start(self.session_id, started_at=utterance.speech_ended_at or ended_at)
+        trace.add_span("vad_endpoint", trace.started_at, ended_at)
+        trace.add_span("queue_wait", ended_at, time.time())
+        # 整輪（STT → 分類 → 回應）的 AWS 呼叫期限不超過 turn_budget 秒
+        with tracer.activate(trace), turn_budget(self.pipeline.turn_budget):
+            await self._handle_utterance(utterance, trace)
+
+    async def _handle_utterance(self, utterance, trace):
+        with span("stt"):
+            transcript_text = await self.pipeline.stt.transcribe_utterance(utterance, self.session_id)
+        if not transcript_text:
+            trace.set(command_type="empty")
+            return
+        trace.mark("transcript")
+        self.events.publish("transcript", {"text": transcript_text, "final": True, "turn_id": trace.turn_id})
+
+        if self.process_command(transcript_text):
+            trace.set(command_type="control")
+            return
+        if self.speaker.check_audio():
+            trace.set(command_type="ignored")
+            return
+
+        async with self.pipeline.turn_slots:
+            await self.respond(transcript_text)
+        self.turns += 1
+        self.touch()
+
+    async def respond(self, transcript_text):
+        pipeline = self.pipeline
+        speaker = self.speaker
+        trace = current_trace()
+        self.set_state("thinking")
+        with span("respond"):
+            command_type, response = await pipeline.classifier.respond(transcript_text, stream=True,
+                                                                       memory=self.memory)
+        if trace:
+            trace.set(command_type=command_type)
+
+        def mark_talking():
+            if trace:
+                trace.mark("first_audio")
+            self.set_state("talking")
+
+        def publish_segment(segment):
+            self.events.publish("reply_delta", {"text": segment})
+
+        if command_type == "行動" and isinstance(response, dict):
+            # 計劃已完整產生：整份送給執行器（背景執行緒），同時播報
+            steps = PlanStream.from_plan(response, pipeline.classifier.classifier.actions)
+            response_text = "".join(self.robot.follow(steps)).strip() or "無法生成有效的動作計劃"
+            await speaker.speak(response_text, mark_talking, publish_segment)
+        elif isinstance(response, str):
+            response_text = response
+            await speaker.speak(response_text, mark_talking, publish_segment)
+        elif response is not None and not isinstance(response, dict):
+            response_text = (await speaker.speak_stream(response, mark_talking, publish_segment)).strip()
+            response = response_text
+        else:
+            response_text = "⚠️ 無法識別命令"
+            await speaker.speak(response_text, mark_talking, publish_segment)
+        self.events.publish("reply", {"text": response_text, "command_type": command_type,
+                                      "turn_id": trace.turn_id if trace else None})
+        self.set_state("idle")
+        if command_type in ('聊天', '查詢') and response is not None:
+            # 只記錄對話內容；摘要的模型呼叫在 ConversationMemory 的背景執行緒池中進行
+            self.memory.add_turn(transcript_text, response_text)
+        pipeline.save_history(command_type, transcript_text, response, self.session_id)
+
+    def process_command(self, text):
+        control = parse_control(text)
+        if control is None:
+            return False
+        action, rate = control
+        if action == "stop":
+            self.speaker.stop_audio()
+            self.robot.stop()
+            self.events.publish("stop", {})
+            self.set_state("idle")
+        else:
+            self.speaker.set_rate(rate)
+        return True
+
+    def close(self):
+        self._worker.cancel()
+        self.speaker.stop_audio()
+        self.robot.close()
+        self.events.publish("closed", {})
+
+    def stats(self):
+        return {
+            "session_id": self.session_id,
+            "state": self.state,
+            "turns": self.turns,
+            "rate": self.speaker.current_rate,
+            "idle_seconds": round(time.time() - self.last_active, 1),
+            "queue": self.queue.stats(),
+            "memory": self.memory.stats(),
+            "robot": self.robot.stats(),
+        }
+
+
+class AsyncPipeline:
+    """SessionManager 的 asyncio 版本，所有 session 在同一個 event loop 上執行
+
+    記憶體以 max_sessions、每個 session 的佇列長度、clip 數與事件數為上限；
+    同時進行的回應輪數由 max_concurrent_turns 限制。
+    """
+
+    def __init__(self, transcriber, classifier, tts_cache, polly_client=None, clients=None,
+                 max_sessions=256, idle_timeout=600.0, max_concurrent_turns=64,
+                 executor_workers=8, queue_size=4, queue_policy="merge", executor_factory=SimulatedRobot,
+                 turn_budget=None, tracer=None):
+        self.clients = clients or AsyncClients(max_pool_connections=max_concurrent_turns)
+        self.executor = ThreadPoolExecutor(max_workers=executor_workers, thread_name_prefix="async-fallback")
+        self.stt = AsyncSpeechToText(transcriber, self.clients, self.executor)
+        self.classifier = AsyncCommandClassifier(classifier, self.clients, self.executor)
+        self.tts_cache = tts_cache
+        self.polly_client = polly_client
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_concurrent_turns = max_concurrent_turns
+        self.queue_size = queue_size
+        self.queue_policy = queue_policy
+        self.executor_factory = executor_factory
+        self.turn_budget = turn_budget
+        self.tracer = tracer or default_tracer()
+        self.turn_slots = None
+        self._sessions = {}
+        self._sweeper = None
+        self.created = 0
+        self.expired = 0
+
+    async def start(self):
+        self.turn_slots = asyncio.Semaphore(self.max_concurrent_turns)
+        await self.clients.start()
+        self._sweeper = asyncio.create_task(self._sweep())
+        print(f"✅ 非同步管線啟動：{self.clients.describe()}")
+
+    async def close(self):
+        if self._sweeper:
+            self._sweeper.cancel()
+        for session in list(self._sessions.values()):
+            session.close()
+        self._sessions.clear()
+        await self.clients.close()
+        self.executor.shutdown(wait=False)
+
+    def save_history(self, command_type, command, response, session_id=None):
+        """HistoryStore.record 只是放進佇列，可直接在 event loop 上呼叫"""
+        classifier = self.classifier.classifier
+        savers = {'聊天': classifier.save_chat_history, '查詢': classifier.save_query_history,
+                  '行動': classifier.save_movement_history}
+        if command_type in savers:
+            savers[command_type](command, response, command_type, session_id)
+
+    def create(self, session_id=None):
+        session_id = session_id or uuid.uuid4().hex
+        session = self._sessions.get(session_id)
+        if session:
+            session.touch()
+            return session
+        if len(self._sessions) >= self.max_sessions:
+            self._expire_idle()
+        if len(self._sessions) >= self.max_sessions:
+            raise SessionLimitError(f"session 數已達上限 {self.max_sessions}")
+        session = AsyncSession(session_id, self, queue_size=self.queue_size, queue_policy=self.queue_policy)
+        self._sessions[session_id] = session
+        self.created += 1
+        return session
+
+    def get(self, session_id):
+        session = self._sessions.get(session_id)
+        if session:
+            session.touch()
+        return session
+
+    def close_session(self, session_id):
+        session = self._sessions.pop(session_id, None)
+        if session:
+            session.close()
+        return session is not None
+
+    def _expire_idle(self):
+        """回收超過 idle_timeout 沒有活動的 session；處理中的 session 不回收"""
+        now = time.time()
+        expired = [s for s in self._sessions.values()
+                   if s.state == "idle" and now - s.last_active > self.idle_timeout and not s.busy()]
+        for session in expired:
+            self.close_session(session.session_id)
+            self.expired += 1
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(5.0)
+            self._expire_idle()
+
+    def stats(self):
+        return {
+            "active": len(self._sessions),
+            "max_sessions": self.max_sessions,
+            "created": self.created,
+            "expired": self.expired,
+            "clients": self.clients.describe(),
+            "aws": self.clients.stats(),
+            "search_cache": self.classifier.classifier.search_cache.stats(),
+            "speculation": self.classifier.classifier.speculator.stats.stats(),
+            "plan_cache": self.classifier.classifier.plan_cache.stats(),
+            "tracing": self.tracer.stats(),
+            "sessions": [session.stats() for session in self._sessions.values()],
+        }
@@ -0,0 +1,141 @@
+import os
+import queue
+import struct
+import threading
+import time
+from datetime import datetime
+import numpy as np
+
+WAV_HEADER_SIZE = 44
+
+
+def pack_wav_header(buf, num_samples, sample_rate, channels=1, offset=0):
+    """把 16-bit PCM 的 WAV header 寫入 buf[offset:offset+44]"""
+    data_size = num_samples * channels * 2
+    struct.pack_into(
+        "<4sI4s4sIHHIIHH4sI", buf, offset,
+        b"RIFF", 36 + data_size, b"WAVE",
+        b"fmt ", 16, 1, channels, sample_rate, sample_rate * channels * 2, channels * 2, 16,
+        b"data", data_size
+    )
+
+
+def wav_bytes_from_array(samples, sample_rate):
+    """將 int16 陣列包成記憶體中的 WAV bytes"""
+    samples = np.ascontiguousarray(samples, dtype=np.int16)
+    buf = bytearray(WAV_HEADER_SIZE + samples.nbytes)
+    pack_wav_header(buf, len(samples), sample_rate)
+    buf[WAV_HEADER_SIZE:] = samples.tobytes()
+    return bytes(buf)
+
+
+class Utterance:
+    """一段語句的音訊
+
+    預先配置一塊 bytearray，前 44 bytes 保留給 WAV header，後面直接當作 int16 PCM 寫入。
+    wav_bytes() 只補上 header 並回傳 memoryview，不需要串接或寫檔。
+    每段語句擁有自己的緩衝區，交給轉錄端後錄音端不會再改寫。
+    """
+
+    def __init__(self, sample_rate, max_seconds=30.0):
+        self.sample_rate = sample_rate
+        self.capacity = int(sample_rate * max_seconds)
+        self._buf = bytearray(WAV_HEADER_SIZE + self.capacity * 2)
+        self._pcm = np.frombuffer(self._buf, dtype=np.int16, offset=WAV_HEADER_SIZE)
+        self.length = 0
+        self.started_at = time.time()
+        self.ended_at = None
+        # 使用者實際停止說話的時間（ended_at 扣掉 VAD 的 hangover），延遲量測的起點
+        self.speech_ended_at = None
+        self.name = f"recording_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.wav"
+        # 下游附加的串流辨識工作階段（streaming_stt.StreamingSession），沒有則為 None
+        self.stream_session = None
+
+    @classmethod
+    def concat(cls, first, second):
+        """合併兩段語句（佇列滿時的 merge 策略使用）；原本的串流辨識結果不再適用，直接取消"""
+        for part in (first, second):
+            if part.stream_session:
+                part.stream_session.cancel()
+        merged = cls(first.sample_rate, (first.length + second.length) / first.sample_rate)
+        merged.append(first.samples)
+        merged.append(second.samples)
+        merged.started_at = first.started_at
+        merged.ended_at = second.ended_at
+        merged.speech_ended_at = second.speech_ended_at
+        merged.name = first.name
+        return merged
+
+    def append(self, samples):
+        """附加樣本，空間不足時截斷並回傳 False"""
+        n = min(len(samples), self.capacity - self.length)
+        self._pcm[self.length:self.length + n] = samples[:n]
+        self.length += n
+        return n == len(samples)
+
+    def append_ring(self, ring):
+        """把環形緩衝區（pre-roll）內容直接複製進來"""
+        n = len(ring)
+        if n > self.capacity - self.length:
+            self.append(ring.read())
+            return
+        self.length += ring.read_into(self._pcm[self.length:self.length + n])
+
+    def is_full(self):
+        return self.length >= self.capacity
+
+    def finish(self, hangover=0.0):
+        """標記語句結束；hangover 為 VAD 判定結束前等待的靜音秒數"""
+        self.ended_at = time.time()
+        self.speech_ended_at = self.ended_at - hangover
+        return self
+
+    @property
+    def samples(self):
+        """int16 樣本的唯讀 view（不複製）"""
+        view = self._pcm[:self.length]
+        view.flags.writeable = False
+        return view
+
+    @property
+    def duration(self):
+        return self.length / self.sample_rate
+
+    def wav_bytes(self):
+        """回傳完整 WAV（header + PCM）的 memoryview"""
+        pack_wav_header(self._buf, self.length, self.sample_rate)
+        return memoryview(self._buf)[:WAV_HEADER_SIZE + self.length * 2]
+
+
+class AudioArchiver:
+    """背景執行緒把語句存成 WAV 檔，不阻塞錄音與轉錄"""
+
+    def __init__(self, audio_dir, max_pending=32):
+        self.audio_dir = audio_dir
+        os.makedirs(self.audio_dir, exist_ok=True)
+        self._queue = queue.Queue(maxsize=max_pending)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, utterance):
+        try:
+            self._queue.put_nowait(utterance)
+        except queue.Full:
+            self.dropped += 1
+            print("⚠️ 音訊存檔佇列已滿，略過此段")
+
+    def _run(self):
+        while True:
+            utterance = self._queue.get()
+            try:
+                path = os.path.join(self.audio_dir, utterance.name)
+                with open(path, "wb") as f:
+                    f.write(utterance.wav_bytes())
+            except Exception as e:
+                print(f"⚠️ 音訊存檔失敗：{e}")
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        self._queue.join()
@@ -0,0 +1,355 @@
+import os
+import time
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import boto3
+from botocore.config import Config
+
+# 各服務的預設值：(連線逾時, 讀取逾時, 單次呼叫期限, 是否允許 hedging)
+# 讀取逾時是 botocore 層的上限，單次呼叫期限則由 ResilientClient 控制，超過就放棄等待並改走備援；
+# 讀取逾時不會超過期限，被放棄的請求才會盡快結束、釋放執行緒
+SERVICE_SETTINGS = {
+    "bedrock-runtime": (2.0, 30.0, 20.0, False),
+    "sagemaker-runtime": (2.0, 15.0, 10.0, False),
+    "polly": (2.0, 5.0, 4.0, True),
+}
+DEFAULT_SETTINGS = (2.0, 15.0, 10.0, False)
+
+# 可以安全重送（沒有副作用）的操作；串流操作只保護「取得回應」這一步，不 hedge
+IDEMPOTENT_OPERATIONS = {"invoke_model", "invoke_endpoint", "synthesize_speech"}
+STREAMING_OPERATIONS = {"invoke_model_with_response_stream", "invoke_endpoint_with_response_stream"}
+
+# 受整輪時間預算限制的服務；TTS 在回答產生後才呼叫，不受預算限制以免答案唸到一半被切掉
+BUDGETED_SERVICES = {"bedrock-runtime", "sagemaker-runtime"}
+
+_turn_deadline = contextvars.ContextVar("turn_deadline", default=None)
+
+
+class CircuitOpenError(RuntimeError):
+    """斷路器開啟中，不送出請求"""
+
+
+class DeadlineExceeded(TimeoutError):
+    """呼叫超過期限"""
+
+
+def service_settings(service_name):
+    connect, read, deadline, hedge = SERVICE_SETTINGS.get(service_name, DEFAULT_SETTINGS)
+    key = service_name.upper().replace("-", "_")
+    deadline = float(os.getenv(f'AWS_DEADLINE_{key}', deadline))
+    hedge_services = os.getenv('AWS_HEDGE_SERVICES')
+    if hedge_services is not None:
+        hedge = service_name in [name.strip() for name in hedge_services.split(",")]
+    return connect, min(read, deadline), deadline, hedge
+
+
+def build_config(service_name, max_pool_connections=None):
+    """依服務建立 botocore Config：連線池、連線 / 讀取逾時、adaptive 重試、TCP keep-alive"""
+    connect, read, _, _ = service_settings(service_name)
+    return Config(
+        max_pool_connections=max_pool_connections or int(os.getenv('AWS_MAX_POOL_CONNECTIONS', '32')),
+        connect_timeout=connect,
+        read_timeout=read,
+        retries={"mode": "adaptive", "max_attempts": int(os.getenv('AWS_MAX_ATTEMPTS', '3'))},
+        tcp_keepalive=True,
+    )
+
+
+@contextmanager
+def turn_budget(seconds):
+    """在這個範圍內的 AWS 呼叫，期限不超過整輪對話剩下的時間"""
+    token = _turn_deadline.set(time.time() + seconds if seconds else None)
+    try:
+        yield
+    finally:
+        _turn_deadline.reset(token)
+
+
+def remaining_budget():
+    deadline = _turn_deadline.get()
+    return None if deadline is None else deadline - time.time()
+
+
+class LatencyTracker:
+    """最近 window 次成功呼叫的延遲，用來決定 hedging 的等待時間"""
+
+    def __init__(self, window=200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+class CircuitBreaker:
+    """連續失敗 failure_threshold 次後開啟，reset_timeout 秒內直接拒絕；之後放行一個試探請求（half-open），
+    成功就關閉、失敗就再開啟"""
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opened = 0
+        self.rejected = 0
+        self._probe = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._probe = False
+            if self.state == "half_open" and not self._probe:
+                self._probe = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                print(f"✅ {self.name} 已恢復，斷路器關閉")
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+                if self.state == "closed":
+                    print(f"⚠️ {self.name} 連續失敗 {self.failures} 次，斷路器開啟 {self.reset_timeout:.0f} 秒")
+                self.state = "open"
+                self.opened_at = time.time()
+                self.opened += 1
+
+    def stats(self):
+        with self._lock:
+            return {"state": self.state, "failures": self.failures, "opened": self.opened, "rejected": self.rejected}
+
+
+_call_executors = {}
+_call_executor_lock = threading.Lock()
+
+
+def call_executor(service_name):
+    """ResilientClient 送出請求的執行緒池（期限與 hedging 都需要在背景送出請求）
+
+    每個服務各自一個：逾期被放棄、仍在等回應的 Bedrock 請求不會佔滿執行緒，拖住還在期限內的 Polly / STT。
+    """
+    with _call_executor_lock:
+        executor = _call_executors.get(service_name)
+        if executor is None:
+            executor = _call_executors[service_name] = ThreadPoolExecutor(
+                max_workers=int(os.getenv('AWS_CALL_WORKERS', '32')),
+                thread_name_prefix=f"aws-call-{service_name}")
+        return executor
+
+
+class ResilientClient:
+    """包住 boto3 client，介面不變：每次呼叫加上期限、斷路器，可重送的操作另外做 hedging
+
+    - 期限 = min(服務預設期限, 本輪剩餘預算)；超過時拋出 DeadlineExceeded（背景請求由不超過期限的 botocore 讀取逾時收尾）
+    - hedging：等待超過最近延遲的 p95（至少 hedge_min 秒）仍未回應時，再送一份相同請求，先回來的勝出
+    - 斷路器開啟時直接拋出 CircuitOpenError，呼叫端照原本的錯誤處理走備援（快取、本機結果）
+    """
+
+    def __init__(self, client, service_name, deadline=None, hedge=None, hedge_min=0.3, breaker=None):
+        _, _, default_deadline, default_hedge = service_settings(service_name)
+        self.client = client
+        self.service_name = service_name
+        self.deadline = default_deadline if deadline is None else deadline
+        self.hedge = default_hedge if hedge is None else hedge
+        self.hedge_min = hedge_min
+        self.breaker = breaker or CircuitBreaker(
+            service_name,
+            failure_threshold=int(os.getenv('AWS_BREAKER_FAILURES', '5')),
+            reset_timeout=float(os.getenv('AWS_BREAKER_RESET', '30')))
+        self.latency = LatencyTracker()
+        self.calls = 0
+        self.failures = 0
+        self.deadline_exceeded = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name in IDEMPOTENT_OPERATIONS or name in STREAMING_OPERATIONS:
+            return lambda **kwargs: self.call(name, **kwargs)
+        return attr
+
+    def _timeout(self):
+        remaining = remaining_budget() if self.service_name in BUDGETED_SERVICES else None
+        if remaining is None:
+            return self.deadline
+        return max(0.0, min(self.deadline, remaining))
+
+    def _count(self, field):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def _begin(self, operation):
+        """檢查時間預算與斷路器，回傳 (開始時間, 期限時間點, hedge 時間點或 None)"""
+        timeout = self._timeout()
+        if timeout <= 0:
+            self._count("deadline_exceeded")
+            raise DeadlineExceeded(f"{self.service_name}.{operation} 本輪時間預算已用完")
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"{self.service_name} 斷路器開啟中")
+        self._count("calls")
+        started = time.time()
+        hedge_at = None
+        if self.hedge and operation in IDEMPOTENT_OPERATIONS:
+            # 還沒有延遲樣本時以期限為準，等於不 hedge
+            hedge_at = started + max(self.hedge_min, self.latency.percentile(95) or self.deadline)
+        return started, started + timeout, hedge_at
+
+    def _succeeded(self, started, is_hedge):
+        self.latency.add(time.time() - started)
+        self.breaker.record_success()
+        if is_hedge:
+            self._count("hedge_wins")
+
+    def _failed(self, operation, started, deadline, timed_out, error):
+        self._count("failures")
+        self.breaker.record_failure()
+        if timed_out:
+            self._count("deadline_exceeded")
+            return DeadlineExceeded(f"{self.service_name}.{operation} 超過 {deadline - started:.1f} 秒")
+        return error
+
+    def call(self, operation, **kwargs):
+        started, deadline, hedge_at = self._begin(operation)
+        method = getattr(self.client, operation)
+        executor = call_executor(self.service_name)
+
+        def submit():
+            return executor.submit(contextvars.copy_context().run, method, **kwargs)
+
+        pending = {submit(): False}  # future -> 是否為 hedge 請求
+        error = None
+        while pending:
+            now = time.time()
+            if now >= deadline:
+                break
+            until = deadline if hedge_at is None else min(deadline, hedge_at)
+            done, _ = wait(pending, timeout=max(0.0, until - now), return_when=FIRST_COMPLETED)
+            for future in done:
+                is_hedge = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                self._succeeded(started, is_hedge)
+                for other in pending:
+                    other.cancel()
+                return result
+            if hedge_at is not None and pending and time.time() >= hedge_at:
+                self._count("hedged")
+                pending[submit()] = True
+                hedge_at = None
+
+        for future in pending:
+            future.cancel()
+        raise self._failed(operation, started, deadline, bool(pending), error)
+
+    def stats(self):
+        p50 = self.latency.percentile(50)
+        p95 = self.latency.percentile(95)
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "deadline_exceeded": self.deadline_exceeded,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "breaker": self.breaker.stats(),
+        }
+
+
+class AsyncResilientClient(ResilientClient):
+    """aiobotocore client 的版本：期限、時間預算、斷路器與 hedging 和同步版相同
+
+    呼叫都是 coroutine；逾期或 hedge 落敗的請求直接取消，不佔用任何執行緒。
+    """
+
+    async def call(self, operation, **kwargs):
+        started, deadline, hedge_at = self._begin(operation)
+        method = getattr(self.client, operation)
+        pending = {asyncio.ensure_future(method(**kwargs)): False}  # task -> 是否為 hedge 請求
+        error = None
+        try:
+            while pending:
+                now = time.time()
+                if now >= deadline:
+                    break
+                until = deadline if hedge_at is None else min(deadline, hedge_at)
+                done, _ = await asyncio.wait(pending, timeout=max(0.0, until - now),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    is_hedge = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        error = e
+                        continue
+                    self._succeeded(started, is_hedge)
+                    return result
+                if hedge_at is not None and pending and time.time() >= hedge_at:
+                    self._count("hedged")
+                    pending[asyncio.ensure_future(method(**kwargs))] = True
+                    hedge_at = None
+        finally:
+            for task in pending:
+                task.cancel()
+        raise self._failed(operation, started, deadline, bool(pending), error)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def create_client(service_name, region_name=None, max_pool_connections=None, resilient=True):
+    """整個行程共用的 AWS 客戶端（同一服務與區域只建一次）"""
+    region_name = region_name or os.getenv('AWS_REGION', 'us-west-2')
+    key = (service_name, region_name, resilient)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = boto3.client(
+                service_name,
+                region_name=region_name,
+                aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+                aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+                config=build_config(service_name, max_pool_connections)
+            )
+            if resilient:
+                client = ResilientClient(client, service_name)
+            _clients[key] = client
+        return client
+
+
+def client_stats():
+    with _clients_lock:
+        clients = dict(_clients)
+    return {f"{service}@{region}": client.stats() for (service, region, resilient), client in clients.items()
+            if resilient}
@@ -0,0 +1,63 @@
+"""離線比較 two_call 與 combined 兩種 CommandClassifier 模式的呼叫次數與延遲
+
+以 local_stubs.LocalBedrockRuntime 取代 Bedrock，web_search 以固定延遲的替身取代：
+
+    python bench_classifier_modes.py --runs 2 --search-latency 0.3
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from command_classifier_claude import CommandClassifier
+from local_stubs import LocalBedrockRuntime
+
+
+def run_mode(mode, reference_data, runs, search_latency, seed):
+    labels = {item['command']: item['command_type'] for item in reference_data}
+    runtime = LocalBedrockRuntime(labels=labels, seed=seed)
+    classifier = CommandClassifier(client=runtime, mode=mode)
+    # 關閉本機快速分類，只比較兩種 LLM 路徑
+    classifier.fastpath_threshold = float("inf")
+
+    def fake_search(query):
+        time.sleep(search_latency)
+        return []
+    classifier.web_search = fake_search
+
+    latencies = {}
+    for _ in range(runs):
+        for item in reference_data:
+            started = time.time()
+            classifier.respond(item['command'])
+            latencies.setdefault(item['command_type'], []).append((time.time() - started) * 1000)
+    total_turns = runs * len(reference_data)
+    return latencies, runtime.calls / total_turns, classifier.speculator.stats.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CommandClassifier 模式比較")
+    parser.add_argument("--runs", type=int, default=2)
+    parser.add_argument("--search-latency", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # 舊版歷史紀錄匯入暫存資料庫（計劃快取與本機意圖模型從這裡讀），不動到正式的 history.db
+    os.environ['HISTORY_DB'] = os.path.join(tempfile.mkdtemp(prefix="bench-modes-"), "history.db")
+    reference_data = CommandClassifier(client=LocalBedrockRuntime()).reference_data
+    results = {mode: run_mode(mode, reference_data, args.runs, args.search_latency, args.seed)
+               for mode in ('two_call', 'combined')}
+
+    print(f"{'類型':>4} {'two_call(ms)':>14} {'combined(ms)':>14}")
+    for command_type in ('聊天', '查詢', '行動'):
+        row = [statistics.median(results[mode][0][command_type]) for mode in ('two_call', 'combined')]
+        print(f"{command_type:>4} {row[0]:>14.0f} {row[1]:>14.0f}")
+    for mode in ('two_call', 'combined'):
+        print(f"{mode}: 平均每輪 LLM 呼叫 {results[mode][1]:.2f} 次")
+    for name, branch in results['two_call'][2]['branches'].items():
+        print(f"two_call 推測分支 {name}: 命中 {branch['used']}/{branch['launched']}，"
+              f"省下 {branch['saved_ms']:.0f} ms，浪費 {branch['wasted_ms']:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
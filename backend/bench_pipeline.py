@@ -0,0 +1,309 @@
+"""離線重播壓測：把錄音與逐字稿重播過整條管線（STT → 分類 → 回應 → TTS），回報各階段與端到端延遲百分位數
+
+Whisper / Bedrock / Polly / 搜尋都換成 local_stubs 的本地替身（延遲、抖動、錯誤率皆可設定），
+外面照正式環境包上 ResilientClient，語句經由 SessionManager 以多個裝置 session 同時送入，
+延遲由 tracing.Tracer 量測（與 /metrics 相同的階段名稱）。不需要 AWS 憑證：
+
+    python bench_pipeline.py --sessions 8 --limit 90
+    python bench_pipeline.py --error-rate 0.02 --slow-rate 0.03 --output after.json --baseline before.json
+
+語料：data/transcripts 的逐字稿（經由 HistoryStore 匯入）對應 --audio-dir 中的同名 WAV；
+找不到錄音檔時以逐字稿長度合成一段雜訊代替，並登記到 Whisper 替身，辨識結果仍是原逐字稿。
+"""
+import argparse
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import wave
+import numpy as np
+import requests
+from aws_clients import ResilientClient
+from command_classifier_claude import CommandClassifier
+from history_store import default_store
+from local_stubs import FaultInjectingClient, LocalBedrockRuntime, LocalPollyRuntime, LocalSearchApi, \
+    LocalWhisperRuntime
+from session_manager import SessionManager, utterance_from_upload
+from speech_to_text_test import SpeechToText
+from tracing import Tracer
+from tts_cache import TTSCache
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_RATE = 16000
+CHARS_PER_SECOND = 4.0  # 合成語音的語速（中文約每秒 4 字）
+STUB_NAMES = ("stt", "llm", "tts", "search")
+
+
+def read_wav(path):
+    """讀取 16-bit WAV，回傳 (樣本, 取樣率)；格式不符回傳 None"""
+    try:
+        with wave.open(path, "rb") as wav:
+            if wav.getsampwidth() != 2:
+                return None
+            channels = wav.getnchannels()
+            rate = wav.getframerate()
+            samples = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+    except (OSError, wave.Error, EOFError):
+        return None
+    if channels > 1:
+        samples = samples[:len(samples) // channels * channels].reshape(-1, channels).mean(axis=1).astype(np.int16)
+    return samples, rate
+
+
+def to_wav_bytes(samples, sample_rate):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(np.asarray(samples, dtype=np.int16).tobytes())
+    return buffer.getvalue()
+
+
+def synthetic_speech(text, rng):
+    seconds = max(0.8, len(text) / CHARS_PER_SECOND)
+    return rng.integers(-3000, 3000, int(seconds * SAMPLE_RATE)).astype(np.int16)
+
+
+def load_corpus(store, audio_dirs, whisper, rng, limit=None):
+    """回傳 [(名稱, WAV bytes, 逐字稿)]；每段音訊都登記到 Whisper 替身，重播時辨識出原逐字稿"""
+    wav_paths = {}
+    for directory in audio_dirs:
+        if os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                if name.lower().endswith(".wav"):
+                    wav_paths.setdefault(name, os.path.join(directory, name))
+
+    corpus, used = [], set()
+    for record in store.query(kind="transcript", newest_first=False, limit=100000):
+        text = (record.get("command") or "").strip()
+        if not text:
+            continue
+        audio_file = os.path.basename((record.get("extra") or {}).get("audio_file") or "")
+        loaded = read_wav(wav_paths[audio_file]) if audio_file in wav_paths else None
+        if loaded is not None:
+            samples, sample_rate = loaded
+            used.add(audio_file)
+        else:
+            samples, sample_rate = synthetic_speech(text, rng), SAMPLE_RATE
+        whisper.register(samples, text)
+        corpus.append((audio_file or f"synthetic-{len(corpus)}", to_wav_bytes(samples, sample_rate), text))
+
+    # 沒有逐字稿的錄音也一起重播（辨識結果為替身的 default_text）
+    for name, path in wav_paths.items():
+        loaded = read_wav(path)
+        if name not in used and loaded is not None:
+            corpus.append((name, to_wav_bytes(*loaded), None))
+    return corpus[:limit] if limit else corpus
+
+
+def build_stubs(args):
+    seed = args.seed
+    stubs = {
+        "stt": LocalWhisperRuntime(base_latency=args.stt_latency, rtf=args.stt_rtf, jitter=args.stt_jitter, seed=seed),
+        "llm": LocalBedrockRuntime(base_latency=args.llm_latency, per_output_token=args.llm_token_latency,
+                                   jitter=args.llm_jitter, seed=seed),
+        "tts": LocalPollyRuntime(base_latency=args.tts_latency, jitter=args.tts_jitter, seed=seed),
+        "search": LocalSearchApi(base_latency=args.search_latency, jitter=args.search_jitter, seed=seed),
+    }
+    faulty = {}
+    for offset, (name, stub) in enumerate(stubs.items()):
+        if name in args.fault_services and (args.error_rate or args.slow_rate):
+            # 搜尋走 requests，錯誤型別要是 RequestException 才會被 web_search 當成搜尋失敗處理
+            error_type = requests.ConnectionError if name == "search" else None
+            faulty[name] = FaultInjectingClient(stub, error_rate=args.error_rate, slow_rate=args.slow_rate,
+                                                slow_seconds=args.slow_seconds, seed=seed + offset,
+                                                **({"error_type": error_type} if error_type else {}))
+        else:
+            faulty[name] = stub
+    return stubs, faulty
+
+
+class UncachedTTS(TTSCache):
+    """不快取的 TTSCache（替身的回答文字固定，開著快取量不到實際合成延遲）"""
+
+    def get(self, key):
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, audio, output_format=None):
+        pass
+
+
+class ReplayDevice(threading.Thread):
+    """一台模擬裝置：依序送出語句，等上一輪結束（trace 完成）再送下一句（closed loop）"""
+
+    def __init__(self, session, items, think_time, turn_timeout):
+        super().__init__(name=f"replay-{session.session_id}", daemon=True)
+        self.session = session
+        self.items = items
+        self.think_time = think_time
+        self.turn_timeout = turn_timeout
+        self.finished = threading.Event()
+        self.rejected = 0
+        self.timeouts = 0
+
+    def run(self):
+        for name, audio, text in self.items:
+            self.finished.clear()
+            # utterance_from_upload 以現在時間作為語句結束時間，延遲從這裡開始算
+            if not self.session.submit(utterance_from_upload(audio)):
+                self.rejected += 1
+                continue
+            if not self.finished.wait(self.turn_timeout):
+                self.timeouts += 1
+                print(f"⚠️ {self.session.session_id} 等待 {name} 回應逾時")
+            if self.think_time:
+                time.sleep(self.think_time)
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="bench-pipeline-")
+    rng = np.random.default_rng(args.seed)
+    stubs, faulty = build_stubs(args)
+
+    # 舊版 data/*_history、data/transcripts 匯入暫存資料庫（本機意圖模型也從這裡讀），不動到正式的 history.db
+    os.environ['HISTORY_DB'] = os.path.join(workdir, "history.db")
+    store = default_store()
+    corpus = load_corpus(store, args.audio_dir, stubs["stt"], rng, args.limit)
+    if not corpus:
+        raise SystemExit("❌ 找不到可重播的逐字稿或錄音")
+    items = corpus * args.repeat
+
+    classifier = CommandClassifier(client=ResilientClient(faulty["llm"], "bedrock-runtime"), history=store)
+    stubs["llm"].labels = {text: command_type for text, command_type in store.examples()}
+    stubs["llm"].labels.update((item['command'], item['command_type']) for item in classifier.reference_data)
+    classifier.http = faulty["search"]
+    transcriber = SpeechToText(runtime=ResilientClient(faulty["stt"], "sagemaker-runtime"),
+                               save_transcripts=False, history=store)
+    tts_cache = (TTSCache if args.tts_cache else UncachedTTS)(cache_dir=os.path.join(workdir, "tts_cache"))
+
+    devices = {}
+    tracer = Tracer(log_path=args.trace_log or "", window=max(1000, len(items)),
+                    on_finish=lambda record: devices[record["session_id"]].finished.set())
+    manager = SessionManager(transcriber, classifier, ResilientClient(faulty["tts"], "polly"), tts_cache,
+                             max_sessions=args.sessions, max_concurrent_turns=args.concurrent_turns,
+                             queue_size=max(4, len(items)), turn_budget=args.turn_budget, tracer=tracer)
+    for i in range(args.sessions):
+        session = manager.create(f"replay-{i}")
+        devices[session.session_id] = ReplayDevice(session, items[i::args.sessions], args.think, args.turn_timeout)
+
+    print(f"▶️ 重播 {len(items)} 句（{len(corpus)} 段 × {args.repeat}），{args.sessions} 個 session 同時進行")
+    started = time.time()
+    for device in devices.values():
+        device.start()
+    for device in devices.values():
+        device.join()
+    elapsed = time.time() - started
+    turn_counts = tracer.turns.snapshot()
+    for session_id in devices:
+        manager.close(session_id)
+
+    tracing = tracer.stats()
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "utterances": len(items),
+        "turns": sum(turn_counts.values()),
+        "command_types": dict(turn_counts),
+        "rejected": sum(device.rejected for device in devices.values()),
+        "timeouts": sum(device.timeouts for device in devices.values()),
+        "elapsed_seconds": round(elapsed, 2),
+        "throughput_tps": round(sum(turn_counts.values()) / elapsed, 2) if elapsed else 0.0,
+        "stages": tracing["stages"],
+        "milestones": tracing["milestones"],
+        "stub_calls": {name: stub.calls for name, stub in stubs.items()},
+        "faults": {name: {"errors": client.errors, "slow": client.slow}
+                   for name, client in faulty.items() if isinstance(client, FaultInjectingClient)},
+        "aws": {"bedrock-runtime": classifier.client.stats(), "sagemaker-runtime": transcriber.runtime.stats(),
+                "polly": manager.polly_client.stats()},
+        "caches": {"search": classifier.search_cache.stats(), "plan": classifier.plan_cache.stats(),
+                   "tts": tts_cache.stats()},
+    }
+    return report
+
+
+def _delta(current, previous):
+    if previous in (None, 0) or current is None:
+        return ""
+    return f"{(current - previous) / previous * 100:+.0f}%"
+
+
+def print_report(report, baseline=None):
+    base_rows = {}
+    if baseline:
+        for section in ("stages", "milestones"):
+            base_rows.update({(section, name): row for name, row in baseline.get(section, {}).items()})
+
+    print(f"\n{'階段':<18} {'次數':>6} {'p50(ms)':>10} {'p95(ms)':>10} {'p99(ms)':>10}"
+          + (f" {'Δp50':>7} {'Δp95':>7}" if baseline else ""))
+    for section in ("stages", "milestones"):
+        for name, row in report[section].items():
+            line = (f"{name:<18} {row['count']:>6} {row['p50_ms']:>10.1f} {row['p95_ms']:>10.1f} "
+                    f"{row['p99_ms']:>10.1f}")
+            previous = base_rows.get((section, name))
+            if previous:
+                line += f" {_delta(row['p50_ms'], previous['p50_ms']):>7} {_delta(row['p95_ms'], previous['p95_ms']):>7}"
+            print(line)
+        if section == "stages":
+            print("—— 里程碑（自使用者說完話起算；first_audio 即 time-to-first-audio）")
+
+    throughput = f"{report['throughput_tps']:.2f} 輪/秒"
+    if baseline and baseline.get("throughput_tps"):
+        throughput += f"（{_delta(report['throughput_tps'], baseline['throughput_tps'])}）"
+    print(f"\n完成 {report['turns']}/{report['utterances']} 輪，耗時 {report['elapsed_seconds']:.1f} 秒，吞吐量 {throughput}")
+    print(f"類型：{report['command_types']}  拒收 {report['rejected']}  逾時 {report['timeouts']}")
+    print(f"替身呼叫次數：{report['stub_calls']}  注入故障：{report['faults']}")
+    for service, stats in report["aws"].items():
+        print(f"{service}: 失敗 {stats['failures']}，逾期 {stats['deadline_exceeded']}，hedge {stats['hedged']}"
+              f"（勝 {stats['hedge_wins']}），斷路器 {stats['breaker']['state']}（開啟 {stats['breaker']['opened']} 次）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="離線重播整條語音管線並回報延遲百分位數")
+    parser.add_argument("--audio-dir", nargs="+",
+                        default=[os.path.join(BASE_DIR, "data", "audio"), os.path.join(BASE_DIR, "data", "audio_input")])
+    parser.add_argument("--limit", type=int, default=None, help="最多重播幾段語料")
+    parser.add_argument("--repeat", type=int, default=1, help="語料重播次數（第二次起會命中各種快取）")
+    parser.add_argument("--sessions", type=int, default=4, help="同時進行的裝置 session 數")
+    parser.add_argument("--concurrent-turns", type=int, default=16)
+    parser.add_argument("--think", type=float, default=0.0, help="每輪之間的間隔秒數")
+    parser.add_argument("--turn-budget", type=float, default=15.0)
+    parser.add_argument("--turn-timeout", type=float, default=60.0)
+    parser.add_argument("--tts-cache", action="store_true", help="啟用 TTS 快取（預設關閉，量測實際合成延遲）")
+    parser.add_argument("--stt-latency", type=float, default=0.3)
+    parser.add_argument("--stt-rtf", type=float, default=0.08)
+    parser.add_argument("--stt-jitter", type=float, default=0.03)
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="首 token 延遲")
+    parser.add_argument("--llm-token-latency", type=float, default=0.015, help="每個輸出 token 的秒數")
+    parser.add_argument("--llm-jitter", type=float, default=0.05)
+    parser.add_argument("--tts-latency", type=float, default=0.12)
+    parser.add_argument("--tts-jitter", type=float, default=0.02)
+    parser.add_argument("--search-latency", type=float, default=0.3)
+    parser.add_argument("--search-jitter", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="每次呼叫失敗的機率")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="每次呼叫變慢（長尾）的機率")
+    parser.add_argument("--slow-seconds", type=float, default=2.0)
+    parser.add_argument("--fault-services", nargs="+", default=list(STUB_NAMES), choices=STUB_NAMES)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace-log", default=None, help="每輪追蹤寫成 JSONL")
+    parser.add_argument("--output", default=None, help="報告存成 JSON，之後可當 --baseline 比較")
+    parser.add_argument("--baseline", default=None, help="先前的 JSON 報告，列出百分位數變化")
+    args = parser.parse_args()
+
+    report = run(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"✅ 報告已儲存：{args.output}")
+
+
+if __name__ == "__main__":
+    main()
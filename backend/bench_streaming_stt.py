@@ -0,0 +1,84 @@
+"""離線比較整段辨識與串流辨識的「語句結束 → 最終逐字稿」延遲
+
+使用 local_stubs.LocalWhisperRuntime 取代 SageMaker endpoint，不需要 AWS 憑證：
+
+    python bench_streaming_stt.py --lengths 2 4 8 --runs 3
+"""
+import argparse
+import statistics
+import time
+import numpy as np
+from audio_buffer import Utterance
+from local_stubs import LocalWhisperRuntime
+from speech_to_text_test import SpeechToText, converter
+from streaming_stt import StreamingTranscriber
+
+SAMPLE_RATE = 16000
+FRAME_MS = 30
+SAMPLE_TEXT = "今天天氣很好我們一起去公園散步然後再去吃午餐下午回來繼續工作晚上看電影"
+
+
+def make_utterance(seconds, rng):
+    samples = rng.integers(-8000, 8000, int(seconds * SAMPLE_RATE)).astype(np.int16)
+    text = (SAMPLE_TEXT * 10)[:int(seconds * 4)]
+    return samples, text
+
+
+def play_into(utterance, samples, on_frame=None):
+    """以實際時間節奏把樣本逐幀寫入 Utterance，模擬錄音端"""
+    frame = SAMPLE_RATE * FRAME_MS // 1000
+    started = time.time()
+    for i in range(0, len(samples), frame):
+        utterance.append(samples[i:i + frame])
+        if on_frame:
+            on_frame()
+        delay = started + (i + frame) / SAMPLE_RATE - time.time()
+        if delay > 0:
+            time.sleep(delay)
+    return utterance.finish()
+
+
+def run(lengths, runs, chunk, overlap, seed):
+    rng = np.random.default_rng(seed)
+    runtime = LocalWhisperRuntime(seed=seed)
+    transcriber = SpeechToText(runtime=runtime, save_transcripts=False)
+    streaming = StreamingTranscriber(transcriber, chunk_seconds=chunk, overlap_seconds=overlap)
+
+    print(f"{'長度(s)':>8} {'整段(ms)':>10} {'串流(ms)':>10} {'文字一致':>8}")
+    for seconds in lengths:
+        batch_ms, stream_ms, exact = [], [], 0
+        for _ in range(runs):
+            samples, text = make_utterance(seconds, rng)
+            runtime.register(samples, text)
+
+            utterance = Utterance(SAMPLE_RATE, seconds + 1)
+            play_into(utterance, samples)
+            started = time.time()
+            transcriber.transcribe_utterance(utterance)
+            batch_ms.append((time.time() - started) * 1000)
+
+            utterance = Utterance(SAMPLE_RATE, seconds + 1)
+            session = streaming.start(utterance)
+            play_into(utterance, samples, on_frame=session.feed)
+            started = time.time()
+            result = session.finish()
+            stream_ms.append((time.time() - started) * 1000)
+            exact += int(result == converter.convert(text))
+
+        print(f"{seconds:>8.1f} {statistics.median(batch_ms):>10.0f} "
+              f"{statistics.median(stream_ms):>10.0f} {exact:>5}/{runs}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="串流辨識離線延遲測試")
+    parser.add_argument("--lengths", type=float, nargs="+", default=[2, 4, 8])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--chunk", type=float, default=2.0)
+    parser.add_argument("--overlap", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run(args.lengths, args.runs, args.chunk, args.overlap, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,188 @@
 import os
 import json
-import boto3
+import time
 from dotenv import load_dotenv
-from datetime import datetime
 import requests
+from opencc import OpenCC
+from intent_classifier import IntentClassifier, normalize
+from asset_registry import AssetRegistry, COMMAND_TYPES
+from search_cache import SearchCache, create_http_session
+from speculative import SpeculativeExecutor
+from history_store import default_store
+from aws_clients import create_client
+from tracing import current_trace, mark, span
+from plan_cache import PlanCache
+from movement_program import PlanStream, compile_plan
+
+class ReplyStream:
+    """串流回覆的共用後處理（同步與 asyncio 版本都用它）
+
+    - 追蹤：建立時取得目前這輪的 trace，從開始讀取（送出請求）到最後一段文字記成 name 階段，
+      與非串流呼叫的 chat / answer / plan 階段對應；消費端可能在別的執行緒，不依賴 contextvars
+    - 模型無法使用時以 fallback() 取代錯誤文字
+    - 完整讀完且模型正常回應時，以完整文字呼叫 on_complete（例如寫入答案快取），中途被「停」打斷則不呼叫
+    """
+
+    def __init__(self, name=None, fallback=None, on_complete=None):
+        self.name = name
+        self.fallback = fallback
+        self.on_complete = on_complete
+        self.failed = False
+        self._parts = []
+        self._trace = current_trace() if name else None
+        self._started = None
+
+    def start(self):
+        self._started = time.time()
+
+    def close(self):
+        """記錄階段；被打斷時也記錄到中斷為止"""
+        if self._trace is not None and self._started is not None:
+            self._trace.add_span(self.name, self._started, time.time())
+            self._trace = None
+
+    def feed(self, chunk):
+        if chunk == "無法獲取模型回應":
+            self.failed = True
+            return self.fallback() if self.fallback else chunk
+        self._parts.append(chunk)
+        return chunk
+
+    def finish(self):
+        if self.on_complete and not self.failed:
+            self.on_complete("".join(self._parts).strip())
+
+    def wrap(self, chunks):
+        self.start()
+        try:
+            for chunk in chunks:
+                yield self.feed(chunk)
+            self.finish()
+        finally:
+            self.close()
+
 
 # ✅ 正確加載環境變數
 env_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'config', '.env'))
 load_dotenv(env_path)
 
+# ✅ 提示詞模板：{examples} 等欄位由 AssetRegistry 每個資產版本只填一次，請求時只串接 {text}
+CLASSIFY_PROMPT = """
+        根据以下示例對命令進行分類。
+        示例：
+        {examples}
+        請對以下輸入進行分類：
+        輸入："{text}"
+        請只回復以下三種類型之一：
+        - 聊天
+        - 查詢
+        - 行動
+        """
+
+COMBINED_PROMPT = """
+        你是一個機器人語音助手。請先判斷用戶輸入的類型，再直接完成該類型的任務。
+        類型只有三種：聊天、查詢、行動。分類示例：
+        {examples}
+
+        依類型輸出：
+        - 聊天：用自然、友好的繁體中文回覆，放在 "response"
+        - 查詢：產生適合 Google 搜尋的關鍵詞，放在 "search_query"
+        - 行動：依動作清單規劃動作，放在 "movement_plan"，格式為 {{"動作順序": [...], "說明": [...]}}
+
+        系統可用的動作清單：
+        {action_list_compact}
+
+        參考任務範例：
+        {task_examples_compact}
+
+        用戶輸入："{text}"
+
+        只回覆一個 JSON 物件並使用```json 包裹，例如：
+        {{"type": "聊天", "response": "..."}}
+        {{"type": "查詢", "search_query": "..."}}
+        {{"type": "行動", "movement_plan": {{"動作順序": ["1"], "說明": ["..."]}}}}
+        """
+
+MOVEMENT_PROMPT = """
+        你是一個專業的機器人動作規劃助手。請根據以下系統設定和用戶的任務，生成詳細的動作順序和說明。
+
+        系統可用的動作清單：
+        {action_list}
+
+        參考任務範例：
+        {task_examples}
+
+        當前用戶任務：{text}
+
+        請按照以下格式返回：
+        {{
+            "動作順序": ["動作代號1", "動作代號2", ...],
+            "說明": [
+                "詳細步驟1",
+                "詳細步驟2",
+                ...
+            ]
+        }}
+
+        請確保：
+        1. 動作順序使用動作清單中的代號
+        2. 說明要詳細且符合實際執行順序
+        3. 回覆必須是有效的JSON格式，並使用```json 包裹
+        """
+
+# 聊天的固定系統提示詞：每輪都相同，對話摘要接在後面，前綴可重複使用
+CHAT_SYSTEM_PROMPT = "你是一個友善的AI助手，請用自然、友好的方式回應用戶的對話。請用繁體中文回覆。"
+
+SUMMARY_PROMPT = """
+        請把以下對話濃縮成 100 字以內的繁體中文摘要，保留用戶提到的人名、偏好、約定與尚未解決的問題。
+        先前摘要：
+        {summary}
+        對話：
+        {turns}
+        只輸出摘要內容。
+        """
+
+
 class CommandClassifier:
-    def __init__(self):
-        # 設置 AWS Bedrock 客戶端
-        self.client = boto3.client(
-            service_name="bedrock-runtime",
-            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-            region_name=os.getenv('AWS_REGION', 'us-west-2')
-        )
+    def __init__(self, client=None, mode=None, assets=None, history=None):
+        # 設置 AWS Bedrock 客戶端（可注入本地替身 local_stubs.LocalBedrockRuntime）
+        self.client = client or create_client("bedrock-runtime", os.getenv('AWS_REGION', 'us-west-2'))
 
         # 設置模型 ID
         self.model_id = "anthropic.claude-3-5-sonnet-20241022-v2:0"
 
-        # ✅ 正確載入 assets/command_type.json
-        json_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'assets', 'command_type.json'))
-        with open(json_path, 'r', encoding='utf-8') as f:
-            self.reference_data = json.load(f)
+        # 回應模式：two_call（先分類再回應）或 combined（一次呼叫同時分類與回應）
+        self.mode = mode or os.getenv('CLASSIFIER_MODE', 'two_call')
+        if self.mode not in ('two_call', 'combined'):
+            raise ValueError(f"未知的 CLASSIFIER_MODE: {self.mode}")
+
+        # ✅ assets 只載入、驗證一次，檔案修改後自動重新載入
+        self.assets = assets or AssetRegistry()
+
+        # ✅ 本機快速分類：信心值達門檻就不呼叫 Bedrock
+        self.fastpath_threshold = float(os.getenv('INTENT_FASTPATH_THRESHOLD', '0.6'))
+        self._converter = OpenCC('s2tw')
+        self._intent_version = self.assets.version
+        self.intent_model = IntentClassifier.from_data(self.reference_data, converter=self._converter)
+
+        # ✅ 搜尋：keep-alive 連線池、逾時與重試，結果與最終答案依查詢類型快取
+        self.http = create_http_session()
+        self.search_timeout = (2.0, float(os.getenv('SEARCH_TIMEOUT', '4')))
+        self.search_cache = SearchCache(max_items=int(os.getenv('SEARCH_CACHE_ITEMS', '512')))
+
+        # ✅ 推測執行：需要 LLM 分類時，同時先跑搜尋（可選：先擬聊天回覆），分類結果出來後取用或丟棄
+        self.speculate_search = os.getenv('SPECULATIVE_SEARCH', 'true').lower() == 'true'
+        self.speculate_chat = os.getenv('SPECULATIVE_CHAT', 'false').lower() == 'true'
+        self.speculator = SpeculativeExecutor(max_workers=int(os.getenv('SPECULATIVE_WORKERS', '4')))
+
+        # 歷史紀錄（SQLite），第一次寫入時才開啟
+        self._history = history
+
+        # ✅ 行動計劃快取：任務拆解與成功規劃過的任務，相同或幾乎相同的任務不再呼叫 Bedrock
+        self.plan_cache = PlanCache(threshold=float(os.getenv('MOVEMENT_CACHE_THRESHOLD', '0.85')),
+                                    max_items=int(os.getenv('MOVEMENT_CACHE_ITEMS', '512')),
+                                    normalizer=lambda text: normalize(self._converter.convert(text)))
+        self._plan_version = None
 
         self.available_functions = [{
             "function_name": "web_search",
@@ -37,49 +194,260 @@ class CommandClassifier:
             }]
         }]
 
-    def _send_to_model(self, prompt):
-        """發送提示詞到 Claude 模型並獲取回應"""
-        body = json.dumps({
-            "max_tokens": 512,
-            "messages": [{"role": "user", "content": prompt}],
+    @staticmethod
+    def model_request_body(prompt, max_tokens=512, history=None, system=None):
+        """history 為先前輪次的 messages（user / assistant 交替），system 為系統提示詞"""
+        body = {
+            "max_tokens": max_tokens,
+            "messages": [*(history or []), {"role": "user", "content": prompt}],
             "anthropic_version": "bedrock-2023-05-31"
-        })
-
+        }
+        if system:
+            body["system"] = system
+        return json.dumps(body)
+
+    @staticmethod
+    def conversation(memory, system=""):
+        """由對話記憶取得 (history, system)；沒有記憶時只有固定的 system"""
+        if memory is None:
+            return [], system or None
+        return memory.messages(), (system + memory.system_suffix()).strip() or None
+
+    @staticmethod
+    def parse_model_response(body):
+        return json.loads(body)["content"][0]["text"]
+
+    @staticmethod
+    def stream_event_text(event):
+        """取出串流事件中的文字增量，非文字事件回傳 None"""
+        chunk = event.get("chunk")
+        if not chunk:
+            return None
+        data = json.loads(chunk["bytes"])
+        if data.get("type") == "content_block_delta" and data["delta"].get("type") == "text_delta":
+            return data["delta"]["text"]
+        return None
+
+    def _send_to_model(self, prompt, max_tokens=512, history=None, system=None):
+        """發送提示詞到 Claude 模型並獲取回應"""
         try:
             response = self.client.invoke_model(
-                body=body,
+                body=self.model_request_body(prompt, max_tokens, history, system),
                 modelId=self.model_id,
                 contentType="application/json"
             )
-            response_body = json.loads(response["body"].read())
-            return response_body["content"][0]["text"]
+            return self.parse_model_response(response["body"].read())
         except Exception as e:
             print(f"模型調用錯誤: {str(e)}")
             return "無法獲取模型回應"
 
-    def classify_command(self, text):
-        """分類輸入命令"""
-        examples = "\n".join([f"- 輸入：{item['command']}  類型：{item['command_type']}" for item in self.reference_data])
-
-        prompt = f"""
-        根据以下示例對命令進行分類。
-        示例：
-        {examples}
-        請對以下輸入進行分類：
-        輸入："{text}"
-        請只回復以下三種類型之一：
-        - 聊天
-        - 查詢
-        - 行動
+    def _stream_from_model(self, prompt, max_tokens=512, history=None, system=None):
+        """以 invoke_model_with_response_stream 逐段產生 Claude 回應文字"""
+        produced = False
+        try:
+            response = self.client.invoke_model_with_response_stream(
+                body=self.model_request_body(prompt, max_tokens, history, system),
+                modelId=self.model_id,
+                contentType="application/json"
+            )
+            for event in response["body"]:
+                text = self.stream_event_text(event)
+                if text:
+                    if not produced:
+                        mark("llm_first_token")
+                    produced = True
+                    yield text
+        except Exception as e:
+            print(f"模型調用錯誤: {str(e)}")
+            if not produced:
+                yield "無法獲取模型回應"
+
+    @staticmethod
+    def _extract_json(result):
+        """取出回應中 ```json 區塊（或整段）的 JSON 字串"""
+        if "```json" in result:
+            return result.split("```json")[1].split("```")[0].strip()
+        return result.strip()
+
+    @property
+    def history(self):
+        if self._history is None:
+            self._history = default_store()
+        return self._history
+
+    @property
+    def reference_data(self):
+        return self.assets.reference_data
+
+    def _intent(self):
+        """回傳本機意圖模型；command_type.json 更新後以新範例重建"""
+        if self.assets.version != self._intent_version:
+            self._intent_version = self.assets.version
+            self.intent_model = IntentClassifier.from_data(self.reference_data, converter=self._converter)
+        return self.intent_model
+
+    def _plans(self):
+        """回傳行動計劃快取；movement_deployment.json 更新後替換任務拆解，第一次使用時載入歷史計劃"""
+        version = self.assets.version
+        if version != self._plan_version:
+            first_load = self._plan_version is None
+            self._plan_version = version
+            movement_data = self.assets.movement_data
+            actions = movement_data['動作清單']
+            self.plan_cache.load([(task['任務'], task) for task in movement_data['任務拆解']], actions, "assets")
+            if first_load:
+                rows = self.history.query(kind='movement', limit=self.plan_cache.max_items, newest_first=False)
+                self.plan_cache.load([(row['command'], row['response']) for row in rows], actions, "history")
+        return self.plan_cache
+
+    def remember_plan(self, text, plan):
+        """把通過驗證的計劃加入快取"""
+        self._plans().add(text, plan, self.actions)
+
+    def respond(self, text, stream=False, memory=None):
+        """分類並產生回應，回傳 (類型, 回應)
+
+        回應為字串，行動類型為動作計劃 dict；stream=True 時聊天與查詢回傳逐段文字的產生器。
+        memory 為該 session 的 ConversationMemory，聊天與查詢會帶入先前的對話。
         """
+        # 本機分類每輪只算一次；有把握時不呼叫 LLM 分類
+        local = self._intent().predict(text)
+        uncertain = local[1] < self.fastpath_threshold
+        if uncertain and self.mode == 'combined':
+            # 用一次呼叫同時分類與回應
+            return self.classify_and_respond(text, stream, memory)
+
+        branches = self.speculative_branches(text, memory) if uncertain else {}
+        if not branches:
+            command_type = self.classify_command(text, local)
+            return command_type, self.dispatch(command_type, text, stream=stream, memory=memory)
+
+        command_type, value, used = self.speculator.run(lambda: self.classify_command(text, local), branches)
+        if used and command_type == '聊天':
+            return command_type, value
+        return command_type, self.dispatch(command_type, text, stream=stream,
+                                           search_results=value if used else None, memory=memory)
+
+    def speculative_branches(self, text, memory=None):
+        """本機分類沒把握（需要等 LLM 分類）時，可與分類同時啟動的分支；查詢直接以原文搜尋"""
+        branches = {}
+        if self.speculate_search:
+            branches['查詢'] = lambda: self.web_search(text)
+        if self.speculate_chat:
+            branches['聊天'] = lambda: self.chat_with_gemini(text, memory=memory)
+        return branches
+
+    def dispatch(self, command_type, text, search_query=None, stream=False, search_results=None, memory=None):
+        """依類型呼叫對應的處理函式；search_results 為已預先取得的搜尋結果"""
+        if command_type == '查詢':
+            return self.handle_query(text, search_query, stream, search_results, memory)
+        if command_type == '行動':
+            return self.handle_movement(text, stream)
+        return self.chat_with_gemini(text, stream, memory)
+
+    def classify_and_respond(self, text, stream=False, memory=None):
+        """單次呼叫：讓模型回傳 {type, response | search_query | movement_plan}，解析失敗時退回兩段式"""
+        # 已規劃過的行動任務直接用快取計劃，不花一次產生完整計劃的呼叫
+        plan = self.cached_plan(text)
+        if plan is not None:
+            return '行動', plan
+        prompt = self.assets.render(COMBINED_PROMPT, text)
+
+        # 帶入先前對話，「那明天呢」這類追問才能正確分類與回應
+        history, system = self.conversation(memory)
+        with span("classify_respond"):
+            result = self._send_to_model(prompt, max_tokens=1024, history=history, system=system)
+        data = self.accept_combined(text, result)
+        if data is None:
+            command_type = self.classify_command(text)
+            return command_type, self.dispatch(command_type, text, stream=stream, memory=memory)
+
+        command_type = data['type']
+        if command_type == '查詢':
+            return command_type, self.handle_query(text, data['search_query'], stream, memory=memory)
+        return command_type, data['response'] if command_type == '聊天' else data['movement_plan']
+
+    def accept_combined(self, text, result):
+        """解析並採用單次呼叫的回應；格式不符時回傳 None（呼叫端改用兩段式）
+
+        回傳的 dict 中文字欄位已去除空白，行動類型的 movement_plan 已編譯並加入計劃快取。
+        """
+        try:
+            data = self.parse_combined_response(result.strip())
+        except ValueError as e:
+            print(f"警告：單次呼叫回應格式不符，改用兩段式 - {str(e)}")
+            return None
+
+        command_type = data['type']
+        print(f"分類結果: {command_type}（單次呼叫）")
+        self.intent_model.add_example(text, command_type)
+        if command_type == '聊天':
+            data['response'] = data['response'].strip()
+        elif command_type == '查詢':
+            data['search_query'] = data['search_query'].strip()
+        else:
+            data['movement_plan'] = self.accept_movement(text, data['movement_plan'])
+        return data
 
-        # print("\n=== 提示詞內容 ===")
-        # print(prompt)
-        # print("=== 提示詞結束 ===\n")
+    def parse_combined_response(self, result):
+        """嚴格解析單次呼叫的回應；任何欄位缺漏或型別不符都拋出 ValueError"""
+        data = json.loads(self._extract_json(result))
+        if not isinstance(data, dict):
+            raise ValueError("回應不是 JSON 物件")
 
-        result = self._send_to_model(prompt).strip()
-        #print(f"模型響應: {result}\n")
+        command_type = data.get('type')
+        if command_type not in COMMAND_TYPES:
+            raise ValueError(f"未知的類型: {command_type}")
 
+        if command_type == '聊天':
+            if not isinstance(data.get('response'), str) or not data['response'].strip():
+                raise ValueError("聊天缺少 response")
+        elif command_type == '查詢':
+            if not isinstance(data.get('search_query'), str) or not data['search_query'].strip():
+                raise ValueError("查詢缺少 search_query")
+        else:
+            plan = data.get('movement_plan')
+            if (not isinstance(plan, dict) or not isinstance(plan.get('動作順序'), list)
+                    or not isinstance(plan.get('說明'), list)):
+                raise ValueError("行動缺少有效的 movement_plan")
+        return data
+
+    def classify_command(self, text, local=None):
+        """分類輸入命令；local 為這一輪已算好的本機預測 (類型, 信心)"""
+        local = local or self._intent().predict(text)
+        label = self.fast_label(local)
+        if label is not None:
+            return label
+
+        with span("classify"):
+            result = self._send_to_model(self.assets.render(CLASSIFY_PROMPT, text))
+        #print(f"模型響應: {result}\n")
+        return self.accept_classification(text, local, result)
+
+    def fast_label(self, local):
+        """本機預測 (類型, 信心) 達門檻時回傳類型，否則回傳 None（需要 LLM 分類）"""
+        label, confidence = local
+        if confidence < self.fastpath_threshold:
+            return None
+        print(f"分類結果: {label}（本機，信心 {confidence:.2f}）")
+        return label
+
+    def accept_classification(self, text, local, result):
+        """依分類呼叫的回應決定類型"""
+        result = result.strip()
+        if result == "無法獲取模型回應":
+            # Bedrock 無法使用（逾時、斷路器開啟）時退回本機分類結果，不拿來補充本機模型
+            label, confidence = local
+            print(f"分類結果: {label}（模型無法使用，改用本機，信心 {confidence:.2f}）")
+            return label
+        label = self.parse_classification(result)
+        # 以 LLM 的判斷持續補充本機模型
+        self.intent_model.add_example(text, label)
+        return label
+
+    @staticmethod
+    def parse_classification(result):
+        """把分類呼叫的回應對應到三種類型之一"""
         if '查' in result or '詢' in result:
             print("分類結果: 查詢")
             return '查詢'
@@ -90,60 +458,69 @@ class CommandClassifier:
             print("分類結果: 聊天")
             return '聊天'
 
-    def chat_with_gemini(self, text):
-        """與 Claude 聊天"""
-        prompt = f"""
-        你是一個友善的AI助手，請用自然、友好的方式回應用戶的對話。
-        請用繁體中文回覆。
-        用戶說：{text}
-        """
+    def chat_with_gemini(self, text, stream=False, memory=None):
+        """與 Claude 聊天；stream=True 時回傳逐段文字的產生器"""
+        history, system = self.conversation(memory, CHAT_SYSTEM_PROMPT)
         # print("\n=== 聊天提示詞內容 ===")
-        # print(prompt)
+        # print(system, history, text)
         # print("=== 提示詞結束 ===\n")
 
-        result = self._send_to_model(prompt).strip()
+        if stream:
+            return ReplyStream("chat").wrap(self._stream_from_model(text, history=history, system=system))
+
+        with span("chat"):
+            result = self._send_to_model(text, history=history, system=system).strip()
         print(f"Claude回應: {result}\n")
         return result
 
-    def save_chat_history(self, command, response, command_type):
-        """保存聊天歷史"""
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        chat_data = {"timestamp": timestamp, "command": command, "response": response, "command_type": command_type}
+    def summarize_conversation(self, summary, turns):
+        """ConversationMemory 的 summarize_fn：把移出視窗的輪次併入摘要"""
+        lines = "\n".join(f"用戶：{user}\n助手：{assistant}" for user, assistant in turns)
+        result = self._send_to_model(SUMMARY_PROMPT.format(summary=summary or "（無）", turns=lines),
+                                     max_tokens=300).strip()
+        if result == "無法獲取模型回應":
+            raise RuntimeError(result)
+        return result
 
-        # ✅ 保存到 data/chat_history
-        save_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'chat_history'))
-        os.makedirs(save_dir, exist_ok=True)
+    def save_chat_history(self, command, response, command_type, session_id=None):
+        """保存聊天歷史（交給 HistoryStore 背景批次寫入，不阻塞對話）"""
+        self.history.record('chat', command, command_type, response, session_id)
 
-        file_path = os.path.join(save_dir, f"chat_{timestamp}.json")
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(chat_data, f, ensure_ascii=False, indent=2)
+    SEARCH_URL = "https://www.googleapis.com/customsearch/v1"
 
-        #print(f"聊天記錄已保存至: {file_path}\n")
+    @staticmethod
+    def search_params(query):
+        return {'key': os.getenv('GOOGLE_SEARCH_API_KEY'), 'cx': os.getenv('GOOGLE_SEARCH_CX'), 'q': query}
 
-    def web_search(self, query):
-        """網路搜尋"""
-        search_api_key = os.getenv('GOOGLE_SEARCH_API_KEY')
-        cx = os.getenv('GOOGLE_SEARCH_CX')
-        url = "https://www.googleapis.com/customsearch/v1"
-        params = {'key': search_api_key, 'cx': cx, 'q': query}
+    @staticmethod
+    def parse_search_results(results):
+        """取前三筆搜尋結果的標題、摘要與連結"""
+        if 'items' in results:
+            return [{
+                'title': item['title'],
+                'snippet': item['snippet'],
+                'link': item['link']
+            } for item in results['items'][:3]]
+        return []
 
+    def web_search(self, query):
+        """網路搜尋（先查快取）"""
+        cached = self.search_cache.get_results(query)
+        if cached is not None:
+            return cached
         try:
-            response = requests.get(url, params=params)
-            results = response.json()
-
-            if 'items' in results:
-                return [{
-                    'title': item['title'],
-                    'snippet': item['snippet'],
-                    'link': item['link']
-                } for item in results['items'][:3]]
-            return []
-        except Exception as e:
+            with span("search"):
+                response = self.http.get(self.SEARCH_URL, params=self.search_params(query),
+                                         timeout=self.search_timeout)
+                results = self.parse_search_results(response.json())
+        except (requests.RequestException, ValueError) as e:
             print(f"搜索出錯: {str(e)}")
             return []
+        self.search_cache.put_results(query, results)
+        return results
 
-    def handle_query(self, text):
-        """處理查詢命令"""
+    def handle_query(self, text, search_query=None, stream=False, search_results=None, memory=None):
+        """處理查詢命令；search_query 為單次呼叫模式由模型產生的關鍵詞，stream=True 時回傳逐段文字的產生器"""
         prompt = f"""
         你是一個專業的搜索助手。用戶想要查詢一些信息，請幫我生成合適的搜索關鍵詞。
         用戶查詢：{text}
@@ -153,12 +530,62 @@ class CommandClassifier:
         # print(prompt)
         # print("=== 提示詞結束 ===\n")
 
-        search_query = text
+        search_query = search_query or text
         # print(f"生成的搜索關鍵詞: {search_query}")
 
-        search_results = self.web_search(search_query)
-
-        results_prompt = f"""
+        if search_results is None:
+            search_results = self.web_search(search_query)
+        history, system = self.conversation(memory)
+        cached = self.cached_answer(text, search_results, history)
+        if cached is not None:
+            return cached
+        results_prompt = self.answer_prompt(text, search_results)
+
+        if stream:
+            chunks = self._stream_from_model(results_prompt, history=history, system=system)
+            return self.answer_stream(text, search_results, history).wrap(chunks)
+
+        with span("answer"):
+            final_response = self._send_to_model(results_prompt, history=history, system=system)
+        return self.accept_answer(text, search_results, history, final_response)
+
+    def cached_answer(self, text, search_results, history):
+        """有先前對話時答案取決於上下文，不使用答案快取"""
+        if history:
+            return None
+        cached = self.search_cache.get_answer(text, search_results)
+        if cached is not None:
+            print("查詢結果: 使用快取答案")
+        return cached
+
+    def accept_answer(self, text, search_results, history, answer):
+        """採用模型的完整回答：模型無法使用時改以搜尋結果回答，否則寫入答案快取"""
+        answer = answer.strip()
+        if answer == "無法獲取模型回應":
+            return self.local_answer(search_results)
+        if not history:
+            self.search_cache.put_answer(text, search_results, answer)
+        return answer
+
+    def answer_stream(self, text, search_results, history):
+        """串流回答的後處理：模型無法使用時改以搜尋結果回答，完整讀完才寫入答案快取"""
+        on_complete = None
+        if not history:
+            on_complete = lambda answer: self.search_cache.put_answer(text, search_results, answer)
+        return ReplyStream("answer", fallback=lambda: self.local_answer(search_results), on_complete=on_complete)
+
+    @staticmethod
+    def local_answer(search_results):
+        """模型無法使用時，直接以第一筆搜尋結果回答"""
+        if not search_results:
+            return "查無確切結果"
+        first = search_results[0]
+        return f"{first['title']}：{first['snippet']}"
+
+    @staticmethod
+    def answer_prompt(text, search_results):
+        """依搜尋結果回答問題的提示詞"""
+        return f"""
         你是一個資訊助理，請根據以下 Google 搜尋結果，直接用繁體中文回答使用者的問題：
         問題：{text}
 
@@ -171,72 +598,66 @@ class CommandClassifier:
         {json.dumps(search_results, ensure_ascii=False, indent=2)}
         """
 
-        final_response = self._send_to_model(results_prompt)
-        return final_response.strip()
-
-    def save_query_history(self, command, response, command_type):
+    def save_query_history(self, command, response, command_type, session_id=None):
         """保存查詢歷史"""
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        query_data = {"timestamp": timestamp, "command": command, "response": response, "command_type": command_type}
-
-        # ✅ 保存到 data/query_history
-        save_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'query_history'))
-        os.makedirs(save_dir, exist_ok=True)
-
-        file_path = os.path.join(save_dir, f"query_{timestamp}.json")
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(query_data, f, ensure_ascii=False, indent=2)
-
-        #(f"查詢記錄已保存至: {file_path}\n")
-
-    def handle_movement(self, text):
-        """處理行動命令"""
-        # ✅ 載入 assets/movement_deployment.json
-        movement_json_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'assets', 'movement_deployment.json'))
-        with open(movement_json_path, 'r', encoding='utf-8') as f:
-            movement_data = json.load(f)
-
-        prompt = f"""
-        你是一個專業的機器人動作規劃助手。請根據以下系統設定和用戶的任務，生成詳細的動作順序和說明。
-
-        系統可用的動作清單：
-        {json.dumps(movement_data['動作清單'], ensure_ascii=False, indent=2)}
-
-        參考任務範例：
-        {json.dumps(movement_data['任務拆解'], ensure_ascii=False, indent=2)}
-
-        當前用戶任務：{text}
-
-        請按照以下格式返回：
-        {{
-            "動作順序": ["動作代號1", "動作代號2", ...],
-            "說明": [
-                "詳細步驟1",
-                "詳細步驟2",
-                ...
-            ]
-        }}
-
-        請確保：
-        1. 動作順序使用動作清單中的代號
-        2. 說明要詳細且符合實際執行順序
-        3. 回覆必須是有效的JSON格式，並使用```json 包裹
+        self.history.record('query', command, command_type, response, session_id)
+
+    def cached_plan(self, text):
+        """查計劃快取，命中時回傳已編譯計劃的副本"""
+        cached = self._plans().lookup(text)
+        if cached is None:
+            return None
+        plan, similarity, matched_task = cached
+        print(f"行動規劃: 使用快取計劃（相似度 {similarity:.2f}，對應「{matched_task}」）")
+        return plan
+
+    def handle_movement(self, text, stream=False):
+        """處理行動命令：先查計劃快取，未命中才請 Claude 規劃
+
+        回傳經過驗證、代號與說明對齊的計劃；stream=True 時回傳 PlanStream，
+        模型每產生一步就可以取出並開始執行。
         """
+        plan = self.cached_plan(text)
+        if plan is not None:
+            return PlanStream.from_plan(plan, self.actions) if stream else plan
+
+        # ✅ 使用 AssetRegistry 預先組好的動作清單與任務範例
+        prompt = self.assets.render(MOVEMENT_PROMPT, text)
 
         # print("\n=== 行動規劃提示詞內容 ===")
         # print(prompt)
         # print("=== 提示詞結束 ===\n")
 
-        result = self._send_to_model(prompt).strip()
-        #print(f"Claude回應: {result}\n")
+        if stream:
+            return PlanStream(ReplyStream("plan").wrap(self._stream_from_model(prompt)), self.actions,
+                              on_complete=lambda plan: self.remember_plan(text, plan))
 
+        with span("plan"):
+            result = self._send_to_model(prompt)
+        #print(f"Claude回應: {result}\n")
+        return self.accept_movement(text, self.parse_movement_plan(result.strip()))
+
+    def accept_movement(self, text, plan):
+        """編譯模型規劃的計劃並加入計劃快取"""
+        plan = self.compile_movement(plan)
+        self.remember_plan(text, plan)
+        return plan
+
+    @property
+    def actions(self):
+        return self.assets.movement_data['動作清單']
+
+    def compile_movement(self, plan):
+        """依動作清單驗證並修正計劃（未知代號、代號與說明數量不一致）"""
+        program = compile_plan(plan, self.actions)
+        if program.warnings:
+            print(f"⚠️ 動作計劃已修正：{'；'.join(program.warnings)}")
+        return program.to_plan()
+
+    def parse_movement_plan(self, result):
+        """解析行動規劃回應，格式不符時回傳空計劃"""
         try:
-            if "```json" in result:
-                json_str = result.split("```json")[1].split("```")[0].strip()
-            else:
-                json_str = result.strip()
-
-            movement_plan = json.loads(json_str)
+            movement_plan = json.loads(self._extract_json(result))
 
             if not isinstance(movement_plan, dict) or '動作順序' not in movement_plan or '說明' not in movement_plan:
                 raise ValueError("JSON格式不符合要求")
@@ -247,20 +668,9 @@ class CommandClassifier:
             print(f"警告：無法解析回應為JSON格式 - {str(e)}")
             return {"動作順序": [], "說明": ["無法生成有效的動作計劃"]}
 
-    def save_movement_history(self, command, response, command_type):
+    def save_movement_history(self, command, response, command_type, session_id=None):
         """保存行動歷史"""
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        movement_data = {"timestamp": timestamp, "command": command, "movement_plan": response, "command_type": command_type}
-
-        # ✅ 保存到 data/movement_history
-        save_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'movement_history'))
-        os.makedirs(save_dir, exist_ok=True)
-
-        file_path = os.path.join(save_dir, f"movement_{timestamp}.json")
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(movement_data, f, ensure_ascii=False, indent=2)
-
-        #print(f"行動計劃已保存至: {file_path}\n")
+        self.history.record('movement', command, command_type, response, session_id)
 
 if __name__ == "__main__":
     classifier = CommandClassifier()
@@ -0,0 +1,176 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def estimate_tokens(text):
+    """粗估 token 數：中日韓字元 1 字 1 token，其他字元 4 字 1 token"""
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if ord(ch) > 0x2E80)
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+_summary_executor = None
+_summary_lock = threading.Lock()
+
+
+def summary_executor():
+    """所有 session 共用的摘要執行緒池（MEMORY_SUMMARY_WORKERS），摘要的模型呼叫不佔用對話 worker"""
+    global _summary_executor
+    with _summary_lock:
+        if _summary_executor is None:
+            _summary_executor = ThreadPoolExecutor(max_workers=int(os.getenv('MEMORY_SUMMARY_WORKERS', '2')),
+                                                   thread_name_prefix="memory-summary")
+        return _summary_executor
+
+
+class ConversationMemory:
+    """單一 session 的對話記憶，轉成 Bedrock messages 陣列
+
+    - 最近的輪次原文保留，總長度超過 max_tokens 時最舊的輪次移出並併入摘要
+    - 摘要由 summarize_fn(舊摘要, 移出的輪次) 產生（通常是一次 LLM 呼叫），
+      未提供或失敗時退回擷取式摘要；摘要長度上限為 summary_tokens
+    - summarize_fn 在背景執行緒池中呼叫，add_turn 不會等模型；摘要完成前要移出的輪次
+      仍保留在 messages() 中，下一輪的提示詞不會少掉這段對話
+    - 超過 idle_reset 秒沒有對話視為新的對話，清空記憶
+    未指定的上限由 MEMORY_MAX_TOKENS / MEMORY_IDLE_RESET 環境變數決定。
+    """
+
+    def __init__(self, max_tokens=None, summary_tokens=200, max_turn_tokens=300, idle_reset=None,
+                 summarize_fn=None):
+        self.max_tokens = max_tokens or int(os.getenv('MEMORY_MAX_TOKENS', '1200'))
+        self.summary_tokens = summary_tokens
+        self.max_turn_tokens = max_turn_tokens
+        self.idle_reset = idle_reset or float(os.getenv('MEMORY_IDLE_RESET', '600'))
+        self.summarize_fn = summarize_fn
+        self.summary = ""
+        self._turns = deque()  # (用戶文字, 助手文字, token 數)
+        self._tokens = 0
+        self._last_turn = 0.0
+        self._lock = threading.Lock()
+        self._summarizing = False
+        self._epoch = 0  # clear / 閒置重置時遞增，讓進行中的摘要作廢
+        self.summarized_turns = 0
+
+    def _clip(self, text, budget):
+        """把單段文字截到 budget token 以內（保留開頭）"""
+        if estimate_tokens(text) <= budget:
+            return text
+        clipped = []
+        used = 0
+        for ch in text:
+            used += 1 if ord(ch) > 0x2E80 else 0.25
+            if used > budget:
+                break
+            clipped.append(ch)
+        return "".join(clipped) + "…"
+
+    def _expire(self):
+        if self._last_turn and time.time() - self._last_turn > self.idle_reset:
+            self._reset()
+
+    def _reset(self):
+        self._turns.clear()
+        self._tokens = 0
+        self.summary = ""
+        self._epoch += 1
+
+    def add_turn(self, user_text, assistant_text):
+        """記錄一輪對話；超出預算時把最舊的輪次併入摘要（有 summarize_fn 時在背景進行）"""
+        if not user_text or not assistant_text:
+            return
+        user_text = self._clip(user_text, self.max_turn_tokens)
+        assistant_text = self._clip(assistant_text, self.max_turn_tokens)
+        with self._lock:
+            self._expire()
+            tokens = estimate_tokens(user_text) + estimate_tokens(assistant_text)
+            self._turns.append((user_text, assistant_text, tokens))
+            self._tokens += tokens
+            self._last_turn = time.time()
+            job = self._evict_job()
+        if job is None:
+            return
+        if self.summarize_fn:
+            summary_executor().submit(self._compact, *job)
+        else:
+            self._compact(*job)
+
+    def _evict_job(self):
+        """（持有鎖）超出預算且沒有進行中的摘要時，回傳要併入摘要的 (epoch, 舊摘要, 最舊的輪次)"""
+        if self._summarizing or self._tokens <= self.max_tokens:
+            return None
+        evicted = []
+        remaining = self._tokens
+        for user, assistant, size in self._turns:
+            if remaining <= self.max_tokens or len(evicted) == len(self._turns) - 1:
+                break
+            evicted.append((user, assistant))
+            remaining -= size
+        if not evicted:
+            return None
+        self._summarizing = True
+        return self._epoch, self.summary, evicted
+
+    def _compact(self, epoch, previous_summary, evicted):
+        """產生摘要後才把對應的輪次移出；期間若記憶被清空則丟棄結果"""
+        summary = self._summarize(previous_summary, evicted)
+        with self._lock:
+            self._summarizing = False
+            if epoch == self._epoch:
+                for _ in evicted:
+                    _, _, size = self._turns.popleft()
+                    self._tokens -= size
+                self.summary = summary
+                self.summarized_turns += len(evicted)
+            job = self._evict_job()
+        if job is not None:
+            # 摘要期間又累積了超出預算的輪次
+            self._compact(*job)
+
+    def _summarize(self, previous_summary, turns):
+        if self.summarize_fn:
+            try:
+                summary = self.summarize_fn(previous_summary, turns)
+                if summary:
+                    return self._clip(summary.strip(), self.summary_tokens)
+            except Exception as e:
+                print(f"⚠️ 對話摘要失敗，改用擷取式摘要：{e}")
+        lines = [previous_summary] if previous_summary else []
+        lines.extend(f"用戶：{user}／助手：{self._clip(assistant, 40)}" for user, assistant in turns)
+        # 擷取式摘要保留最新的內容
+        summary = "\n".join(lines)
+        while estimate_tokens(summary) > self.summary_tokens and "\n" in summary:
+            summary = summary.split("\n", 1)[1]
+        return self._clip(summary, self.summary_tokens)
+
+    def messages(self):
+        """最近輪次的 messages（user / assistant 交替），不含本輪輸入"""
+        with self._lock:
+            self._expire()
+            messages = []
+            for user, assistant, _ in self._turns:
+                messages.append({"role": "user", "content": user})
+                messages.append({"role": "assistant", "content": assistant})
+            return messages
+
+    def system_suffix(self):
+        """接在固定系統提示詞之後的摘要段落；固定前綴不變，方便重複使用"""
+        with self._lock:
+            return f"\n\n先前對話摘要：\n{self.summary}" if self.summary else ""
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "turns": len(self._turns),
+                "tokens": self._tokens,
+                "summary_tokens": estimate_tokens(self.summary),
+                "summarized_turns": self.summarized_turns,
+                "summarizing": self._summarizing,
+            }
@@ -0,0 +1,304 @@
+"""回音消除與插話（barge-in）
+
+播放端把實際送到喇叭的 PCM 記在 PlaybackReference（附播放開始時間），錄音端每幀以同一時間軸取出參考訊號，
+EchoCanceller 用分段頻域 NLMS（partitioned-block frequency-domain adaptive filter，overlap-save）估計喇叭
+經過房間傳回麥克風的回音並扣掉；扣完後仍有明顯語音（BargeInDetector）就代表使用者在插話。
+
+合成訊號自我檢查（不需要麥克風與喇叭）：
+
+    python echo_canceller.py
+"""
+import threading
+import time
+from collections import deque
+from math import gcd
+import numpy as np
+
+try:
+    from scipy.signal import resample_poly
+except ImportError:
+    resample_poly = None
+
+
+def _rms(samples):
+    return float(np.sqrt(np.mean(np.square(samples, dtype=np.float64)))) if len(samples) else 0.0
+
+
+def to_mono_16k(samples, sample_rate, target_rate=16000):
+    """int16（可多聲道）→ target_rate 單聲道 float32（-1 ~ 1）"""
+    samples = np.asarray(samples, dtype=np.float32) / 32768.0
+    if samples.ndim > 1:
+        samples = samples.mean(axis=1)
+    if sample_rate == target_rate:
+        return samples
+    if resample_poly is not None:
+        factor = gcd(int(sample_rate), int(target_rate))
+        return resample_poly(samples, target_rate // factor, int(sample_rate) // factor).astype(np.float32)
+    positions = np.arange(0, len(samples), sample_rate / target_rate)
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+
+class PlaybackReference:
+    """播放中的音訊時間軸（16 kHz 單聲道）：play() 登記一段從 started_at 開始播的 PCM，read() 依時間取樣本"""
+
+    def __init__(self, sample_rate=16000, keep_seconds=30.0):
+        self.sample_rate = sample_rate
+        self.keep_seconds = keep_seconds
+        self._segments = deque()  # [開始時間, 結束時間, 樣本]，依時間排序（播放引擎每 10 ms 登記一小段）
+        self._lock = threading.Lock()
+
+    def play(self, samples, sample_rate, started_at=None):
+        started_at = started_at or time.time()
+        pcm = to_mono_16k(samples, sample_rate, self.sample_rate)
+        with self._lock:
+            self._segments.append([started_at, started_at + len(pcm) / self.sample_rate, pcm])
+            cutoff = started_at - self.keep_seconds
+            while self._segments and self._segments[0][1] < cutoff:
+                self._segments.popleft()
+
+    def stop(self, at=None):
+        """播放中止：at 之後的參考訊號作廢"""
+        at = at or time.time()
+        with self._lock:
+            for segment in self._segments:
+                if segment[1] > at:
+                    keep = max(0, int((at - segment[0]) * self.sample_rate))
+                    segment[2] = segment[2][:keep]
+                    segment[1] = segment[0] + keep / self.sample_rate
+
+    def read(self, start_time, count):
+        """[start_time, start_time + count / sample_rate) 期間播放的樣本，沒有播放的部分為 0"""
+        out = np.zeros(count, dtype=np.float32)
+        end_time = start_time + count / self.sample_rate
+        with self._lock:
+            segments = [segment for segment in self._recent(start_time) if segment[0] < end_time]
+        for seg_start, _, pcm in segments:
+            offset = int(round((seg_start - start_time) * self.sample_rate))
+            src_start = max(0, -offset)
+            dst_start = max(0, offset)
+            n = min(count - dst_start, len(pcm) - src_start)
+            if n > 0:
+                out[dst_start:dst_start + n] += pcm[src_start:src_start + n]
+        return out
+
+    def active(self, at=None, tail=0.3):
+        """at 之前 tail 秒內是否有播放（回音可能還在房間裡）"""
+        at = at or time.time()
+        with self._lock:
+            return any(start <= at for start, _, _ in self._recent(at - tail))
+
+    def _recent(self, since):
+        """結束時間晚於 since 的段落；段落依序播放不重疊，從最新的往回找即可"""
+        recent = []
+        for segment in reversed(self._segments):
+            if segment[1] <= since:
+                break
+            recent.append(segment)
+        return recent
+
+
+class EchoCanceller:
+    """分段頻域 NLMS 回音消除，一次處理一幀（frame_size 個樣本）
+
+    濾波器長度 = frame_size × partitions（30 ms × 8 = 240 ms），涵蓋輸出 / 輸入延遲與房間殘響。
+    參考訊號沒有聲音或偵測到近端語音（插話）時凍結調適，避免濾波器被使用者的聲音帶偏。
+    """
+
+    def __init__(self, reference=None, frame_size=480, partitions=8, step=0.8, sample_rate=16000,
+                 barge_in=None):
+        self.reference = reference
+        self.frame_size = frame_size
+        self.partitions = partitions
+        self.step = step
+        self.sample_rate = sample_rate
+        self.detector = barge_in if barge_in is not None else BargeInDetector(frame_ms=frame_size * 1000 // sample_rate)
+        bins = frame_size + 1
+        self._weights = np.zeros((partitions, bins), dtype=np.complex128)
+        self._history = np.zeros((partitions, bins), dtype=np.complex128)
+        self._previous = np.zeros(frame_size, dtype=np.float64)
+        self._power = np.full(bins, 1e-3)
+        self.barge_in = False  # 這一幀是否剛偵測到插話
+        self.echo_rms = 0.0
+        self.residual_rms = 0.0
+        self.frames = 0
+        self.barge_ins = 0
+
+    def reset(self):
+        self._weights[:] = 0
+        self._history[:] = 0
+        self._previous[:] = 0
+        self._power[:] = 1e-3
+        self.detector.reset()
+
+    def process(self, mic, ref, playing=True):
+        """mic：int16 幀；ref：同一時間播放的 float 參考樣本；回傳扣掉回音後的 int16 幀"""
+        n = self.frame_size
+        d = np.asarray(mic, dtype=np.float64) / 32768.0
+        x = np.asarray(ref, dtype=np.float64)
+        spectrum = np.fft.rfft(np.concatenate([self._previous, x]))
+        self._previous = x
+        self._history = np.roll(self._history, 1, axis=0)
+        self._history[0] = spectrum
+
+        echo = np.fft.irfft((self._history * self._weights).sum(axis=0), 2 * n)[n:]
+        error = d - echo
+        self.echo_rms = _rms(echo) * 32768.0
+        self.residual_rms = _rms(error) * 32768.0
+        residual = np.clip(error * 32768.0, -32768, 32767).astype(np.int16)
+
+        near_end = self.detector.update(residual, self.residual_rms, _rms(d) * 32768.0, playing)
+        self.barge_in = self.detector.fired_now
+        if self.barge_in:
+            self.barge_ins += 1
+        if playing and not near_end and _rms(x) > 1e-4:
+            self._adapt(spectrum, error)
+        self.frames += 1
+        return residual
+
+    def _adapt(self, spectrum, error):
+        n = self.frame_size
+        self._power = 0.9 * self._power + 0.1 * np.abs(spectrum) ** 2
+        error_spectrum = np.fft.rfft(np.concatenate([np.zeros(n), error]))
+        gradient = self.step * np.conj(self._history) * error_spectrum / (self._power * self.partitions + 1e-6)
+        # 梯度限制：只保留前半（線性卷積部分），避免循環卷積的誤差
+        constrained = np.fft.irfft(gradient, 2 * n, axis=1)
+        constrained[:, n:] = 0
+        self._weights += np.fft.rfft(constrained, axis=1)
+
+    def process_at(self, mic, captured_at):
+        """錄音端使用：以 captured_at（這一幀開始的時間）從 PlaybackReference 取參考訊號"""
+        if self.reference is None:
+            return mic
+        playing = self.reference.active(captured_at)
+        if not playing and not self.detector.active:
+            if self.detector.fired or self.detector._run:
+                self.detector.end_playback()
+            self.barge_in = False
+            self._previous[:] = 0
+            return mic
+        ref = self.reference.read(captured_at, len(mic))
+        return self.process(mic, ref, playing)
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "barge_ins": self.barge_ins,
+            "echo_rms": round(self.echo_rms, 1),
+            "residual_rms": round(self.residual_rms, 1),
+        }
+
+
+class BargeInDetector:
+    """播放中判斷使用者是否插話
+
+    追蹤「殘餘 / 麥克風」音量比在只有回音時的典型值（= 回音抑制量）；某幀的比值超過典型值 ratio 倍、
+    殘餘音量超過 min_rms（且 vad 判定為語音）時視為近端語音，連續 min_ms 即判定插話。
+    濾波器還沒收斂（典型比值高於 max_floor）時不判定，此時仍照舊忽略播放中的語句，不會被自己的聲音打斷。
+    """
+
+    def __init__(self, vad=None, ratio=3.0, min_rms=400.0, min_ms=150, frame_ms=30, max_floor=0.5,
+                 echo_rms=300.0):
+        self.vad = vad
+        self.ratio = ratio
+        self.min_rms = min_rms
+        self.min_frames = max(1, int(np.ceil(min_ms / frame_ms)))
+        self.max_floor = max_floor
+        self.echo_rms = echo_rms
+        self.reset()
+
+    def reset(self):
+        self.floor = 1.0
+        self.end_playback()
+
+    def end_playback(self):
+        """播放結束：清掉這次播放的判定狀態，回音抑制量（floor）保留給下一次播放"""
+        self._run = 0
+        self.active = False
+        self.fired = False
+        self.fired_now = False
+
+    @property
+    def converged(self):
+        return self.floor <= self.max_floor
+
+    def update(self, residual, level, mic_level, playing):
+        """回傳這一幀是否為近端語音；剛達到判定條件的那一幀 fired_now 為 True"""
+        self.fired_now = False
+        if not playing and not self.active:
+            self.end_playback()
+            return False
+        share = level / max(mic_level, 1.0)
+        candidate = (self.converged and level > self.min_rms
+                     and share > min(1.0, self.ratio * self.floor))
+        if candidate and self.vad is not None:
+            candidate = self.vad.is_speech(residual)
+        if candidate:
+            self._run += 1
+        else:
+            self._run = 0
+            self.active = False
+            if mic_level > self.echo_rms:
+                # 只在有明顯回音的幀更新（下降快、上升慢）
+                alpha = 0.2 if share < self.floor else 0.02
+                self.floor += alpha * (share - self.floor)
+        if self._run >= self.min_frames:
+            self.active = True
+            if not self.fired:
+                self.fired = self.fired_now = True
+        return candidate
+
+
+# ---- 合成訊號自我檢查 ----
+
+def _speech_like(seconds, rng, sample_rate=16000, f0=150.0):
+    """有音節起伏的諧波訊號（模擬語音的頻譜與包絡）"""
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    pitch = f0 * (1 + 0.1 * np.sin(2 * np.pi * 0.7 * t))
+    phase = 2 * np.pi * np.cumsum(pitch) / sample_rate
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 20))
+    envelope = np.clip(np.sin(2 * np.pi * 3.0 * t + rng.uniform(0, 6)), 0, None) ** 0.5
+    return voiced * envelope + 0.05 * rng.normal(size=len(t))
+
+
+def self_check(seed=0):
+    rng = np.random.default_rng(seed)
+    sample_rate, frame = 16000, 480
+    far = 0.3 * _speech_like(8.0, rng) / 2
+    # 房間脈衝響應：20 ms 延遲 + 80 ms 指數衰減的殘響
+    taps = np.zeros(int(0.1 * sample_rate))
+    tail = rng.normal(size=int(0.08 * sample_rate)) * np.exp(-np.arange(int(0.08 * sample_rate)) / 300)
+    taps[320:320 + len(tail)] = tail
+    taps *= 0.6 / np.sqrt(np.sum(taps ** 2))
+    echo = np.convolve(far, taps)[:len(far)]
+    near = np.zeros_like(far)
+    near_start, near_end = 5.0, 6.5
+    burst = _speech_like(near_end - near_start, rng, f0=220.0) * 0.25
+    near[int(near_start * sample_rate):int(near_start * sample_rate) + len(burst)] = burst
+    mic = np.clip((echo + near + 0.002 * rng.normal(size=len(far))) * 32768, -32768, 32767).astype(np.int16)
+
+    canceller = EchoCanceller(frame_size=frame)
+    residual = np.zeros(len(mic), dtype=np.int16)
+    fired_at = []
+    for i in range(0, len(mic) - frame + 1, frame):
+        residual[i:i + frame] = canceller.process(mic[i:i + frame], far[i:i + frame])
+        if canceller.barge_in:
+            fired_at.append((i + frame) / sample_rate)
+
+    def erle(start, end):
+        a, b = int(start * sample_rate), int(end * sample_rate)
+        return 10 * np.log10(np.sum(mic[a:b].astype(np.float64) ** 2) / max(1.0, np.sum(residual[a:b].astype(np.float64) ** 2)))
+
+    results = [
+        ("回音抑制（ERLE 3~5 s）", erle(3.0, 5.0), erle(3.0, 5.0) >= 15.0, "dB"),
+        ("插話前沒有誤觸發", sum(t < near_start for t in fired_at), not any(t < near_start for t in fired_at), "次"),
+    ]
+    delay = (fired_at[0] - near_start) * 1000 if fired_at and fired_at[0] >= near_start else None
+    results.append(("插話偵測延遲", delay if delay is not None else float("nan"),
+                    delay is not None and delay <= 300, "ms"))
+    for name, value, passed, unit in results:
+        print(f"{'✅' if passed else '❌'} {name}：{value:.1f} {unit}")
+    return all(passed for _, _, passed, _ in results)
+
+
+if __name__ == "__main__":
+    raise SystemExit(0 if self_check() else 1)
@@ -0,0 +1,57 @@
+"""離線評估本機意圖分類器的準確率、涵蓋率與延遲
+
+以 command_type.json 範例加上 data/*_history 的歷史紀錄做 leave-one-out 驗證：
+
+    python eval_intent.py --thresholds 0.6 0.7 0.8 0.85 0.9
+"""
+import argparse
+import os
+import tempfile
+import time
+from opencc import OpenCC
+from intent_classifier import IntentClassifier
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def leave_one_out(examples):
+    predictions = []
+    latencies = []
+    for i, (text, label) in enumerate(examples):
+        model = IntentClassifier().fit(examples[:i] + examples[i + 1:])
+        model.predict("")  # 先建立索引，只量測預測本身
+        started = time.perf_counter()
+        predicted, confidence = model.predict(text)
+        latencies.append((time.perf_counter() - started) * 1000)
+        predictions.append((label, predicted, confidence))
+    return predictions, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本機意圖分類器評估")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.6, 0.7, 0.8, 0.85, 0.9, 0.95])
+    parser.add_argument("--no-history", action="store_true", help="只使用 command_type.json 範例")
+    args = parser.parse_args()
+
+    # 舊版歷史紀錄匯入暫存資料庫，不動到正式的 history.db
+    os.environ['HISTORY_DB'] = os.path.join(tempfile.mkdtemp(prefix="eval-intent-"), "history.db")
+    examples = IntentClassifier.load_examples(include_history=not args.no_history, converter=OpenCC('s2tw'))
+    predictions, latencies = leave_one_out(examples)
+
+    correct = sum(1 for label, predicted, _ in predictions if label == predicted)
+    print(f"樣本數: {len(examples)}")
+    print(f"整體準確率: {correct / len(predictions):.1%}")
+    print(f"預測延遲: p50 {percentile(latencies, 50):.3f} ms, p99 {percentile(latencies, 99):.3f} ms")
+    print()
+    print(f"{'門檻':>6} {'本機涵蓋率':>10} {'本機準確率':>10}")
+    for threshold in args.thresholds:
+        handled = [(label, predicted) for label, predicted, confidence in predictions if confidence >= threshold]
+        accuracy = sum(1 for label, predicted in handled if label == predicted) / len(handled) if handled else 0.0
+        print(f"{threshold:>6.2f} {len(handled) / len(predictions):>10.1%} {accuracy:>10.1%}")
+
+
+if __name__ == "__main__":
+    main()
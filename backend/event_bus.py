@@ -0,0 +1,102 @@
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+
+
+class EventBus:
+    """有序事件紀錄，供 SSE 推播使用
+
+    每個事件有遞增的 id；客戶端自己保存游標（SSE 的 Last-Event-ID），
+    因此多個客戶端互不影響，斷線重連也能從游標之後補齊（保留最近 max_events 筆）。
+    執行緒端用 wait / stream，asyncio 端用 wait_async / stream_async，兩邊可同時訂閱。
+    """
+
+    def __init__(self, max_events=1000):
+        self._events = deque(maxlen=max_events)
+        self._cond = threading.Condition()
+        self._next_id = 1
+        self._async_waiters = set()  # (event loop, future)
+
+    def publish(self, event_type, data=None):
+        with self._cond:
+            event = {"id": self._next_id, "type": event_type, "data": data, "time": time.time()}
+            self._next_id += 1
+            self._events.append(event)
+            self._cond.notify_all()
+            for loop, future in self._async_waiters:
+                loop.call_soon_threadsafe(_resolve, future)
+            return event["id"]
+
+    @property
+    def latest_id(self):
+        with self._cond:
+            return self._next_id - 1
+
+    def latest(self, event_type):
+        """最近一筆指定類型的事件，沒有則回傳 None"""
+        with self._cond:
+            for event in reversed(self._events):
+                if event["type"] == event_type:
+                    return event
+        return None
+
+    def events_after(self, cursor):
+        with self._cond:
+            return [event for event in self._events if event["id"] > cursor]
+
+    def wait(self, cursor, timeout=None):
+        """等待游標之後的新事件；逾時回傳空列表"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._next_id - 1 > cursor, timeout)
+            return [event for event in self._events if event["id"] > cursor]
+
+    async def wait_async(self, cursor, timeout=None):
+        """wait 的 asyncio 版本，不佔用執行緒"""
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            if self._next_id - 1 > cursor:
+                return [event for event in self._events if event["id"] > cursor]
+            waiter = (loop, loop.create_future())
+            self._async_waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                self._async_waiters.discard(waiter)
+        return self.events_after(cursor)
+
+    @staticmethod
+    def format_sse(event):
+        payload = json.dumps(event["data"], ensure_ascii=False)
+        return f"id: {event['id']}\nevent: {event['type']}\ndata: {payload}\n\n"
+
+    def stream(self, cursor=0, heartbeat=15.0):
+        """SSE 產生器：依序送出游標之後的事件，閒置時送出註解行保持連線"""
+        while True:
+            events = self.wait(cursor, timeout=heartbeat)
+            if not events:
+                yield ": keep-alive\n\n"
+                continue
+            for event in events:
+                cursor = event["id"]
+                yield self.format_sse(event)
+
+    async def stream_async(self, cursor=0, heartbeat=15.0):
+        """stream 的 asyncio 版本（async generator）"""
+        while True:
+            events = await self.wait_async(cursor, timeout=heartbeat)
+            if not events:
+                yield ": keep-alive\n\n"
+                continue
+            for event in events:
+                cursor = event["id"]
+                yield self.format_sse(event)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
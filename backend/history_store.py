@@ -0,0 +1,220 @@
+import os
+import glob
+import json
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+# 舊版「一輪一個 JSON 檔」的資料夾與對應的紀錄種類
+LEGACY_DIRS = {
+    'chat_history': 'chat',
+    'query_history': 'query',
+    'movement_history': 'movement',
+    'transcripts': 'transcript',
+}
+TURN_KINDS = ('chat', 'query', 'movement')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    session_id TEXT,
+    created_at REAL NOT NULL,
+    command TEXT,
+    command_type TEXT,
+    response TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_history_session_time ON history(session_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_history_kind_time ON history(kind, created_at);
+CREATE INDEX IF NOT EXISTS idx_history_type_time ON history(command_type, created_at);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+class HistoryStore:
+    """SQLite（WAL）歷史紀錄：聊天 / 查詢 / 行動 / 轉寫文字共用一張有索引的表
+
+    record() 只把紀錄放進佇列就返回，背景執行緒每 batch_size 筆或每 flush_interval 秒
+    以單一交易寫入，因此寫歷史不會卡住對話；query() 依 session、時間、類型篩選。
+    第一次開啟時會匯入舊版 data/*_history 與 data/transcripts 的 JSON 檔。
+    """
+
+    def __init__(self, db_path=None, batch_size=64, flush_interval=0.5, max_pending=10000, import_legacy=True):
+        self.db_path = db_path or os.getenv('HISTORY_DB') or os.path.join(BASE_DIR, 'data', 'history.db')
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._local = threading.local()
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        if import_legacy:
+            self._import_legacy(conn)
+
+        self._writer = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    # ---- 寫入 ----
+
+    def record(self, kind, command=None, command_type=None, response=None, session_id=None,
+               extra=None, created_at=None):
+        """非阻塞地加入一筆紀錄；佇列滿時丟棄並計數"""
+        row = (kind, session_id, created_at or time.time(), command, command_type,
+               None if response is None else json.dumps(response, ensure_ascii=False),
+               None if extra is None else json.dumps(extra, ensure_ascii=False))
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write(self, conn, rows):
+        with conn:
+            conn.executemany(
+                "INSERT INTO history (kind, session_id, created_at, command, command_type, response, extra) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self.written += len(rows)
+        self.batches += 1
+
+    def _run(self):
+        conn = self._connect()
+        while True:
+            rows = [self._queue.get()]
+            deadline = time.time() + self.flush_interval
+            while len(rows) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    rows.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._write(conn, rows)
+            except sqlite3.Error as e:
+                print(f"⚠️ 歷史紀錄寫入失敗：{e}")
+                self.dropped += len(rows)
+            finally:
+                for _ in rows:
+                    self._queue.task_done()
+
+    def flush(self):
+        """等待佇列中的紀錄全部寫入（測試與關閉前使用）"""
+        self._queue.join()
+
+    # ---- 查詢 ----
+
+    @staticmethod
+    def _decode(row):
+        record = dict(row)
+        for key in ("response", "extra"):
+            if record[key] is not None:
+                record[key] = json.loads(record[key])
+        return record
+
+    def query(self, kind=None, session_id=None, command_type=None, since=None, until=None,
+              text=None, limit=50, newest_first=True):
+        """依條件查詢紀錄，回傳 dict 列表；text 比對 command 子字串"""
+        clauses, params = [], []
+        for column, value in (("kind", kind), ("session_id", session_id), ("command_type", command_type)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            clauses.append("created_at >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("created_at < ?")
+            params.append(until)
+        if text:
+            clauses.append("command LIKE ?")
+            params.append(f"%{text}%")
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        order = "DESC" if newest_first else "ASC"
+        sql = f"SELECT * FROM history {where} ORDER BY created_at {order}, id {order} LIMIT ?"
+        rows = self._connect().execute(sql, (*params, limit)).fetchall()
+        return [self._decode(row) for row in rows]
+
+    def examples(self, limit=None):
+        """聊天 / 查詢 / 行動紀錄的 (文字, 類型)，供本機意圖模型訓練"""
+        placeholders = ",".join("?" for _ in TURN_KINDS)
+        sql = (f"SELECT command, command_type FROM history WHERE kind IN ({placeholders}) "
+               "AND command IS NOT NULL AND command_type IS NOT NULL ORDER BY created_at")
+        params = list(TURN_KINDS)
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [(row["command"], row["command_type"]) for row in self._connect().execute(sql, params)]
+
+    def stats(self):
+        counts = {row["kind"]: row["n"] for row in
+                  self._connect().execute("SELECT kind, COUNT(*) AS n FROM history GROUP BY kind")}
+        return {
+            "pending": self._queue.qsize(),
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "rows": counts,
+        }
+
+    # ---- 舊資料匯入 ----
+
+    def _import_legacy(self, conn, base_dir=None):
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_imported'").fetchone():
+            return
+        base_dir = base_dir or os.path.join(BASE_DIR, 'data')
+        rows = []
+        for dir_name, kind in LEGACY_DIRS.items():
+            for path in sorted(glob.glob(os.path.join(base_dir, dir_name, '*.json'))):
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                    created_at = datetime.strptime(data['timestamp'], "%Y%m%d_%H%M%S").timestamp()
+                except (OSError, ValueError, KeyError):
+                    continue
+                if kind == 'transcript':
+                    rows.append((kind, None, created_at, data.get('transcript'), None, None,
+                                 json.dumps({"audio_file": data.get('audio_file'),
+                                             "confidence": data.get('confidence')}, ensure_ascii=False)))
+                else:
+                    response = data.get('movement_plan', data.get('response'))
+                    rows.append((kind, None, created_at, data.get('command'), data.get('command_type'),
+                                 json.dumps(response, ensure_ascii=False), None))
+        with conn:
+            conn.executemany(
+                "INSERT INTO history (kind, session_id, created_at, command, command_type, response, extra) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_imported', ?)", (str(len(rows)),))
+        if rows:
+            print(f"📚 已匯入 {len(rows)} 筆舊版歷史紀錄")
+
+
+_default_store = None
+_default_lock = threading.Lock()
+
+
+def default_store():
+    """整個行程共用一個 HistoryStore（同一個背景寫入執行緒）"""
+    global _default_store
+    with _default_lock:
+        if _default_store is None:
+            _default_store = HistoryStore()
+        return _default_store
@@ -0,0 +1,181 @@
+import os
+import json
+import math
+import re
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from history_store import default_store
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+# 關鍵詞特徵：命中時額外加入 "KW:類型" 特徵，補足少量範例時的判斷力
+KEYWORDS = {
+    '查詢': ('查', '搜尋', '天氣', '新聞', '附近', '幾點', '多少', '哪裡', '請問', '推薦', '營業'),
+    '行動': ('幫我去', '幫我拿', '幫我送', '拿給', '送給', '拿到', '送去', '泡', '倒', '走到', '放下', '拿起', '按下'),
+    '聊天': ('你覺得', '你好', '心情', '介紹', '喜歡', '聊天', '早安', '晚安'),
+}
+
+_STRIP = re.compile(r"[\s\W_]+", re.UNICODE)
+
+
+def normalize(text):
+    """去除空白與標點並轉小寫"""
+    return _STRIP.sub("", text or "").lower()
+
+
+class IntentClassifier:
+    """字元 n-gram + 關鍵詞特徵的 TF-IDF 最近鄰分類器
+
+    在本機判斷 聊天/查詢/行動，單次預測遠低於 1 ms。predict() 回傳 (類型, 信心值)：
+    信心值 = 前 k 個最近鄰中該類型的相似度佔比 × 最近鄰相似度（以 full_similarity 為滿分），
+    呼叫端低於門檻時再交給 LLM 判斷。
+
+    可在多個執行緒同時預測與學習：索引建好後整份替換，預測只讀取當時的索引；
+    執行中學到的範例去重並以 max_learned 為上限，累積 rebuild_every 筆或超過
+    rebuild_interval 秒才重建一次索引。
+    """
+
+    LABELS = ('聊天', '查詢', '行動')
+
+    def __init__(self, ngram_range=(1, 3), k=3, full_similarity=0.5, max_learned=None, rebuild_every=20,
+                 rebuild_interval=30.0):
+        self.ngram_range = ngram_range
+        self.k = k
+        self.full_similarity = full_similarity
+        self.max_learned = max_learned or int(os.getenv('INTENT_MAX_LEARNED', '1000'))
+        self.rebuild_every = rebuild_every
+        self.rebuild_interval = rebuild_interval
+        self.documents = []            # fit() 載入的範例 [(特徵, 類型)]
+        self.learned = OrderedDict()   # 執行中學到的範例：正規化文字 -> (特徵, 類型)，最舊的先移除
+        self._labels = {}              # documents 的正規化文字 -> 類型，用來去重
+        self._index = None             # (範例, idf, 預設 idf, 倒排索引)，整份替換
+        self._pending = 0
+        self._built_at = 0.0
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+
+    def features(self, text):
+        text = normalize(text)
+        feats = set()
+        low, high = self.ngram_range
+        for n in range(low, high + 1):
+            feats.update(text[i:i + n] for i in range(len(text) - n + 1))
+        for label, words in KEYWORDS.items():
+            if any(word in text for word in words):
+                feats.add(f"KW:{label}")
+        return feats
+
+    def add_example(self, text, label):
+        """執行中以 LLM 的分類結果持續學習；已有相同文字與類型的範例時不重複加入"""
+        if label not in self.LABELS:
+            return
+        key = normalize(text)
+        feats = self.features(text)
+        if not feats:
+            return
+        with self._lock:
+            if self._labels.get(key) == label:
+                return
+            if key in self.learned:
+                self.learned.move_to_end(key)
+                if self.learned[key][1] == label:
+                    return
+            self.learned[key] = (feats, label)
+            while len(self.learned) > self.max_learned:
+                self.learned.popitem(last=False)
+            self._pending += 1
+
+    def fit(self, examples):
+        with self._lock:
+            for text, label in examples:
+                if label not in self.LABELS:
+                    continue
+                feats = self.features(text)
+                if feats:
+                    self.documents.append((feats, label))
+                    self._labels[normalize(text)] = label
+            self._index = None
+        return self
+
+    @staticmethod
+    def _vector(feats, idf, default_idf):
+        weights = {f: idf.get(f, default_idf) for f in feats}
+        norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+        return {f: w / norm for f, w in weights.items()}
+
+    def _build_index(self, documents):
+        doc_freq = Counter()
+        for feats, _ in documents:
+            doc_freq.update(feats)
+        total = len(documents)
+        idf = {f: math.log((total + 1) / (df + 1)) + 1 for f, df in doc_freq.items()}
+        default_idf = math.log(total + 1) + 1
+        index = defaultdict(list)
+        for doc_id, (feats, _) in enumerate(documents):
+            for f, w in self._vector(feats, idf, default_idf).items():
+                index[f].append((doc_id, w))
+        return documents, idf, default_idf, dict(index)
+
+    def _current_index(self):
+        """回傳目前的索引；需要重建時由一個執行緒在鎖外重建，其他執行緒繼續使用舊索引"""
+        current = self._index
+        stale = self._pending and (self._pending >= self.rebuild_every
+                                   or time.time() - self._built_at >= self.rebuild_interval)
+        if current is not None and not stale:
+            return current
+        if not self._build_lock.acquire(blocking=current is None):
+            return current
+        try:
+            with self._lock:
+                current = self._index
+                if current is not None and not self._pending:
+                    return current
+                documents = self.documents + list(self.learned.values())
+                self._pending = 0
+            current = self._build_index(documents)
+            self._index = current
+            self._built_at = time.time()
+            return current
+        finally:
+            self._build_lock.release()
+
+    def predict(self, text):
+        documents, idf, default_idf, index = self._current_index()
+        if not documents:
+            return '聊天', 0.0
+
+        query = self._vector(self.features(text), idf, default_idf)
+        similarities = Counter()
+        for f, w in query.items():
+            for doc_id, doc_weight in index.get(f, ()):
+                similarities[doc_id] += w * doc_weight
+        neighbours = similarities.most_common(self.k)
+        if not neighbours:
+            return '聊天', 0.0
+
+        votes = Counter()
+        for doc_id, similarity in neighbours:
+            votes[documents[doc_id][1]] += similarity
+        best, score = votes.most_common(1)[0]
+        share = score / sum(votes.values())
+        return best, share * min(1.0, neighbours[0][1] / self.full_similarity)
+
+    @staticmethod
+    def load_examples(reference_data=None, include_history=True, converter=None):
+        """讀取 command_type.json 範例與 HistoryStore 中的歷史紀錄，回傳 [(文字, 類型)]"""
+        if reference_data is None:
+            with open(os.path.join(BASE_DIR, 'assets', 'command_type.json'), 'r', encoding='utf-8') as f:
+                reference_data = json.load(f)
+        examples = [(item['command'], item['command_type']) for item in reference_data]
+
+        if include_history:
+            for command, command_type in default_store().examples():
+                if converter:
+                    command = converter.convert(command)
+                examples.append((command, command_type))
+        return examples
+
+    @classmethod
+    def from_data(cls, reference_data=None, include_history=True, converter=None):
+        return cls().fit(cls.load_examples(reference_data, include_history, converter))
@@ -0,0 +1,336 @@
+"""裝置端關鍵詞偵測（MFCC + DTW 樣板比對），控制指令不必等雲端 STT
+
+錄音端每幀呼叫 KeywordSpotter.feed(幀, 是否為語音)：一段短語音（min_ms ~ max_ms）後接著 trailing_ms 的靜音時，
+把這段語音的 MFCC 與每個關鍵詞的樣板做 DTW 比對，距離低於門檻就回傳關鍵詞，
+從說完到觸發約 trailing_ms + 數 ms 運算時間。
+
+樣板是使用者自己錄的 WAV（預設 data/keywords/<關鍵詞>_<編號>.wav），錄製方式：
+
+    python keyword_spotter.py enroll 停 --count 3
+    python keyword_spotter.py listen
+"""
+import argparse
+import os
+import time
+import wave
+from collections import Counter
+import numpy as np
+from audio_buffer import wav_bytes_from_array
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_TEMPLATE_DIR = os.path.join(BASE_DIR, 'data', 'keywords')
+
+# 控制指令（與 session_manager.parse_control 對應）
+CONTROL_KEYWORDS = ("停", "慢一點", "快一點", "恢復正常")
+
+
+class MFCCExtractor:
+    """numpy 實作的 MFCC：pre-emphasis → 25 ms Hamming 窗（10 ms 位移）→ mel 濾波器組 → log → DCT
+
+    不含 c0（音量），並做倒頻譜平均值正規化（CMN），對麥克風與距離的差異較不敏感。
+    """
+
+    def __init__(self, sample_rate=16000, n_mfcc=13, n_mels=26, win_ms=25, hop_ms=10, n_fft=512,
+                 fmin=80.0, fmax=None):
+        self.sample_rate = sample_rate
+        self.win = int(sample_rate * win_ms / 1000)
+        self.hop = int(sample_rate * hop_ms / 1000)
+        self.n_fft = n_fft
+        self.window = np.hamming(self.win).astype(np.float32)
+        self.filters = self._mel_filters(sample_rate, n_fft, n_mels, fmin, fmax or sample_rate / 2)
+        n = np.arange(n_mels)
+        self.dct = np.cos(np.pi / n_mels * (n[None, :] + 0.5) * np.arange(1, n_mfcc)[:, None]).astype(np.float32)
+
+    @staticmethod
+    def _mel_filters(sample_rate, n_fft, n_mels, fmin, fmax):
+        to_mel = lambda hz: 2595.0 * np.log10(1.0 + hz / 700.0)
+        to_hz = lambda mel: 700.0 * (10 ** (mel / 2595.0) - 1.0)
+        points = to_hz(np.linspace(to_mel(fmin), to_mel(fmax), n_mels + 2))
+        bins = np.floor((n_fft + 1) * points / sample_rate).astype(int)
+        filters = np.zeros((n_mels, n_fft // 2 + 1), dtype=np.float32)
+        for m in range(1, n_mels + 1):
+            left, center, right = bins[m - 1], bins[m], bins[m + 1]
+            if center > left:
+                filters[m - 1, left:center] = (np.arange(left, center) - left) / (center - left)
+            if right > center:
+                filters[m - 1, center:right] = (right - np.arange(center, right)) / (right - center)
+        return filters
+
+    def __call__(self, samples):
+        """int16 樣本 → (幀數, n_mfcc - 1) 特徵"""
+        x = np.asarray(samples, dtype=np.float32) / 32768.0
+        if len(x) < self.win:
+            x = np.pad(x, (0, self.win - len(x)))
+        x = np.append(x[0], x[1:] - 0.97 * x[:-1])
+        count = 1 + (len(x) - self.win) // self.hop
+        index = np.arange(self.win)[None, :] + self.hop * np.arange(count)[:, None]
+        spectrum = np.abs(np.fft.rfft(x[index] * self.window, self.n_fft)) ** 2 / self.n_fft
+        features = np.log(spectrum @ self.filters.T + 1e-10) @ self.dct.T
+        return features - features.mean(axis=0)
+
+
+def dtw_distance(a, b, max_ratio=2.0):
+    """兩段特徵序列的 DTW 距離（歐氏距離，以路徑長 n + m 正規化）；長度相差超過 max_ratio 倍回傳 inf
+
+    沿反對角線向量化，n + m 次 numpy 運算即可完成，不需要逐格的 Python 迴圈。
+    """
+    n, m = len(a), len(b)
+    if not n or not m or max(n, m) > max_ratio * min(n, m):
+        return float("inf")
+    cost = np.sqrt(((a[:, None, :] - b[None, :, :]) ** 2).sum(axis=2))
+    acc = np.full((n + 1, m + 1), np.inf, dtype=np.float64)
+    acc[0, 0] = 0.0
+    for d in range(2, n + m + 1):
+        i = np.arange(max(1, d - m), min(n, d - 1) + 1)
+        j = d - i
+        acc[i, j] = cost[i - 1, j - 1] + np.minimum(np.minimum(acc[i - 1, j - 1], acc[i - 1, j]), acc[i, j - 1])
+    return float(acc[n, m] / (n + m))
+
+
+class KeywordSpotter:
+    """孤立詞的關鍵詞偵測：每個關鍵詞有一到多個樣板，取最近的樣板
+
+    - threshold：DTW 距離門檻（未指定時由 KWS_THRESHOLD 決定）；同一關鍵詞有兩個以上樣板時，
+      門檻改為樣板彼此距離的最大值 × 1.3，與錄音者的聲音、環境一起校正
+    - margin：最佳關鍵詞的距離必須小於次佳關鍵詞 × margin，兩個關鍵詞都很像時不觸發
+    - 一段語音超過 max_ms（一般句子）就不比對，因此「停車場在哪」不會觸發「停」
+    """
+
+    def __init__(self, keywords=None, sample_rate=16000, threshold=None, margin=0.85, trailing_ms=120,
+                 min_ms=150, max_ms=1500, pre_roll_ms=60):
+        self.keywords = tuple(keywords) if keywords else None
+        self.sample_rate = sample_rate
+        self.threshold = threshold or float(os.getenv('KWS_THRESHOLD', '4.0'))
+        self.margin = margin
+        self.trailing_ms = trailing_ms
+        self.min_samples = int(sample_rate * min_ms / 1000)
+        self.max_samples = int(sample_rate * max_ms / 1000)
+        self.pre_roll_samples = int(sample_rate * pre_roll_ms / 1000)
+        self.extract = MFCCExtractor(sample_rate)
+        self.templates = {}  # 關鍵詞 -> [特徵]
+        self.thresholds = {}
+        self.detections = Counter()
+        self.rejected = 0
+        self.compute_ms = 0.0
+        self.last_match = None
+        self.reset()
+
+    def __bool__(self):
+        return bool(self.templates)
+
+    def reset(self):
+        self._frames = []
+        self._length = 0
+        self._previous = None
+        self._voiced = False
+        self._overlong = False
+        self._silence = 0.0
+
+    # ---- 樣板 ----
+
+    def add_template(self, keyword, samples):
+        if self.keywords and keyword not in self.keywords:
+            return False
+        self.templates.setdefault(keyword, []).append(self.extract(samples))
+        self._calibrate(keyword)
+        return True
+
+    def _calibrate(self, keyword):
+        templates = self.templates[keyword]
+        if len(templates) < 2:
+            self.thresholds[keyword] = self.threshold
+            return
+        spread = max(dtw_distance(a, b, max_ratio=float("inf"))
+                     for index, a in enumerate(templates) for b in templates[index + 1:])
+        self.thresholds[keyword] = spread * 1.3
+
+    def load(self, directory=None):
+        """讀取 <關鍵詞>.wav 或 <關鍵詞>_<編號>.wav，回傳載入的樣板數"""
+        directory = directory or os.getenv('KWS_TEMPLATE_DIR') or DEFAULT_TEMPLATE_DIR
+        if not os.path.isdir(directory):
+            return 0
+        loaded = 0
+        for name in sorted(os.listdir(directory)):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() != ".wav":
+                continue
+            keyword = stem.rsplit("_", 1)[0] if stem.rsplit("_", 1)[-1].isdigit() else stem
+            try:
+                with wave.open(os.path.join(directory, name), "rb") as wav:
+                    if wav.getframerate() != self.sample_rate or wav.getsampwidth() != 2 or wav.getnchannels() != 1:
+                        print(f"⚠️ 關鍵詞樣板 {name} 需為 {self.sample_rate} Hz 16-bit 單聲道，略過")
+                        continue
+                    samples = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+            except (OSError, wave.Error, EOFError) as e:
+                print(f"⚠️ 無法讀取關鍵詞樣板 {name}：{e}")
+                continue
+            loaded += self.add_template(keyword, samples)
+        return loaded
+
+    # ---- 比對 ----
+
+    def match(self, samples):
+        """回傳 (關鍵詞, 距離)；沒有關鍵詞達到門檻時回傳 None"""
+        started = time.perf_counter()
+        features = self.extract(samples)
+        scores = {keyword: min(dtw_distance(features, template) for template in templates)
+                  for keyword, templates in self.templates.items()}
+        self.compute_ms = (time.perf_counter() - started) * 1000
+        if not scores:
+            return None
+        ranked = sorted(scores.items(), key=lambda item: item[1])
+        keyword, distance = ranked[0]
+        self.last_match = (keyword, round(distance, 3))
+        if distance > self.thresholds[keyword]:
+            return None
+        if len(ranked) > 1 and distance > ranked[1][1] * self.margin:
+            return None
+        return keyword, distance
+
+    def feed(self, samples, is_speech):
+        """錄音端每幀呼叫；一段短語音結束（靜音 trailing_ms）時比對，命中回傳關鍵詞"""
+        if not self.templates:
+            return None
+        if not is_speech and not self._voiced:
+            self._previous = samples
+            return None
+
+        self._frames.append(np.array(samples, dtype=np.int16))
+        self._length += len(samples)
+        if is_speech:
+            if not self._voiced and self._previous is not None:
+                # 語音起點前保留一點音訊，避免吃掉子音
+                self._frames.insert(0, np.array(self._previous[-self.pre_roll_samples:], dtype=np.int16))
+                self._length += len(self._frames[0])
+            self._voiced = True
+            self._silence = 0.0
+            if self._length > self.max_samples:
+                # 長句子：丟掉累積的音訊，這段語音結束前都不比對
+                self._frames, self._length, self._overlong = [], 0, True
+            return None
+
+        self._silence += len(samples) * 1000 / self.sample_rate
+        if self._silence < self.trailing_ms:
+            return None
+        overlong = self._overlong
+        segment = np.concatenate(self._frames) if self._frames else np.zeros(0, dtype=np.int16)
+        trailing = int(self._silence * self.sample_rate / 1000)
+        segment = segment[:max(0, len(segment) - trailing)]
+        self.reset()
+        if overlong or not (self.min_samples <= len(segment) <= self.max_samples):
+            return None
+        found = self.match(segment)
+        if found is None:
+            self.rejected += 1
+            return None
+        self.detections[found[0]] += 1
+        return found[0]
+
+    def stats(self):
+        return {
+            "templates": {keyword: len(templates) for keyword, templates in self.templates.items()},
+            "thresholds": {keyword: round(value, 3) for keyword, value in self.thresholds.items()},
+            "detections": dict(self.detections),
+            "rejected": self.rejected,
+            "last_match": self.last_match,
+            "compute_ms": round(self.compute_ms, 1),
+        }
+
+
+def create_spotter(keywords=CONTROL_KEYWORDS, directory=None, sample_rate=16000):
+    """載入樣板；沒有任何樣板時回傳 None（等同關閉，控制指令照舊走雲端 STT）"""
+    spotter = KeywordSpotter(keywords, sample_rate=sample_rate)
+    if not spotter.load(directory):
+        return None
+    print(f"✅ 關鍵詞偵測已啟用：{spotter.stats()['templates']}")
+    return spotter
+
+
+# ---- 錄製樣板與試聽 ----
+
+def _record_segment(stream, frame_size, vad, timeout=4.0):
+    """從麥克風錄一段語音（以 VAD 裁掉前後靜音）"""
+    frames, voiced, silence = [], False, 0
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        frame, _ = stream.read(frame_size)
+        samples = frame[:, 0].copy()
+        speech = vad.is_speech(samples)
+        if speech:
+            voiced, silence = True, 0
+        elif voiced:
+            silence += 1
+            if silence >= 10:
+                break
+        if voiced:
+            frames.append(samples)
+    if not frames:
+        return None
+    return np.concatenate(frames[:len(frames) - silence])
+
+
+def enroll(keyword, count, directory, sample_rate=16000, frame_ms=30):
+    import sounddevice as sd
+    from vad import create_vad
+
+    os.makedirs(directory, exist_ok=True)
+    frame_size = int(sample_rate * frame_ms / 1000)
+    vad = create_vad("energy", sample_rate=sample_rate)
+    existing = sum(1 for name in os.listdir(directory) if name.startswith(f"{keyword}_"))
+    with sd.InputStream(samplerate=sample_rate, channels=1, dtype='int16', blocksize=frame_size) as stream:
+        for index in range(existing + 1, existing + count + 1):
+            input(f"按 Enter 後說「{keyword}」（第 {index} 次）")
+            samples = _record_segment(stream, frame_size, vad)
+            if samples is None:
+                print("⚠️ 沒有偵測到語音，略過")
+                continue
+            path = os.path.join(directory, f"{keyword}_{index}.wav")
+            with open(path, "wb") as f:
+                f.write(wav_bytes_from_array(samples, sample_rate))
+            print(f"✅ 已儲存 {path}（{len(samples) / sample_rate:.2f} 秒）")
+
+
+def listen(directory, sample_rate=16000, frame_ms=30):
+    import sounddevice as sd
+    from vad import create_vad
+
+    spotter = create_spotter(keywords=None, directory=directory, sample_rate=sample_rate)
+    if spotter is None:
+        print(f"❌ {directory} 沒有關鍵詞樣板，請先執行 enroll")
+        return
+    frame_size = int(sample_rate * frame_ms / 1000)
+    vad = create_vad("auto", sample_rate=sample_rate)
+    print("🎧 試聽中（Ctrl+C 結束）...")
+    with sd.InputStream(samplerate=sample_rate, channels=1, dtype='int16', blocksize=frame_size) as stream:
+        try:
+            while True:
+                frame, _ = stream.read(frame_size)
+                samples = frame[:, 0]
+                keyword = spotter.feed(samples, vad.is_speech(samples))
+                if keyword:
+                    print(f"🔑 {keyword}（{spotter.last_match[1]:.2f}，運算 {spotter.compute_ms:.1f} ms）")
+                elif spotter.last_match:
+                    print(f"   最接近：{spotter.last_match}")
+                    spotter.last_match = None
+        except KeyboardInterrupt:
+            print(spotter.stats())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="關鍵詞樣板錄製與試聽")
+    sub = parser.add_subparsers(dest="command", required=True)
+    enroll_parser = sub.add_parser("enroll", help="錄製關鍵詞樣板")
+    enroll_parser.add_argument("keyword")
+    enroll_parser.add_argument("--count", type=int, default=3)
+    listen_parser = sub.add_parser("listen", help="即時偵測並顯示比對距離")
+    for command_parser in (enroll_parser, listen_parser):
+        command_parser.add_argument("--dir", default=os.getenv('KWS_TEMPLATE_DIR') or DEFAULT_TEMPLATE_DIR)
+    args = parser.parse_args()
+    if args.command == "enroll":
+        enroll(args.keyword, args.count, args.dir)
+    else:
+        listen(args.dir)
+
+
+if __name__ == "__main__":
+    main()
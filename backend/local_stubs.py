@@ -0,0 +1,279 @@
+import io
+import json
+import random
+import time
+import numpy as np
+from scipy.io import wavfile
+
+
+class LocalWhisperRuntime:
+    """SageMaker Whisper endpoint 的本地替身，介面與 sagemaker-runtime client 的 invoke_endpoint 相同
+
+    - register(samples, text)：登記一段參考音訊與其逐字稿；之後送來的任何片段（包含串流時的重疊切片）
+      會在參考音訊中定位，依時間比例回傳對應的文字，因此可以離線驗證串流拼接結果。
+    - 延遲模型：base_latency + rtf × 音訊長度 + 高斯抖動（秒）。
+    """
+
+    def __init__(self, base_latency=0.3, rtf=0.08, jitter=0.03, default_text="你好", seed=None):
+        self.base_latency = base_latency
+        self.rtf = rtf
+        self.jitter = jitter
+        self.default_text = default_text
+        self._references = []
+        self._random = random.Random(seed)
+        self.calls = 0
+        self.audio_seconds = 0.0
+
+    def register(self, samples, text):
+        self._references.append((np.asarray(samples, dtype=np.int16), text))
+
+    def _locate(self, samples):
+        probe = samples[:32]
+        if len(probe) < 32:
+            return None
+        for reference, text in self._references:
+            candidates = np.flatnonzero(reference[:len(reference) - len(probe) + 1] == probe[0])
+            for offset in candidates:
+                if np.array_equal(reference[offset:offset + len(probe)], probe):
+                    return reference, text, int(offset)
+        return None
+
+    def transcribe_samples(self, samples):
+        """依片段在參考音訊中的位置回傳文字；未登記的音訊回傳 default_text"""
+        found = self._locate(samples)
+        if found is None:
+            return self.default_text
+        reference, text, offset = found
+        start = int(round(offset / len(reference) * len(text)))
+        end = int(round(min(len(reference), offset + len(samples)) / len(reference) * len(text)))
+        return text[start:end]
+
+    def invoke_endpoint(self, EndpointName=None, ContentType=None, Body=None, **kwargs):
+        sample_rate, samples = wavfile.read(io.BytesIO(bytes(Body)))
+        if samples.ndim > 1:
+            samples = samples[:, 0]
+        duration = len(samples) / sample_rate
+
+        delay = self.base_latency + self.rtf * duration + self._random.gauss(0, self.jitter)
+        time.sleep(max(0.0, delay))
+        self.calls += 1
+        self.audio_seconds += duration
+
+        payload = json.dumps({"text": [self.transcribe_samples(samples)]}, ensure_ascii=False)
+        return {"Body": io.BytesIO(payload.encode("utf-8"))}
+
+
+class LocalBedrockRuntime:
+    """Bedrock Runtime（Claude）的本地替身，介面與 bedrock-runtime client 的 invoke_model 相同
+
+    依提示詞內容辨識是哪一種呼叫（分類、單次分類+回應、聊天/查詢摘要、行動規劃）並回傳對應格式的內容；
+    labels 為 {用戶輸入: 類型}，未列出的輸入視為聊天。
+    延遲模型：base_latency + 輸入 token × per_input_token + 輸出 token × per_output_token + 高斯抖動（秒），
+    token 數以中日韓字元 1 字 1 token、其他字元 4 字 1 token 估算。
+    """
+
+    def __init__(self, labels=None, base_latency=0.5, per_input_token=0.00005, per_output_token=0.015,
+                 jitter=0.05, reply_text="好的，這是根據你的問題整理的簡短回答。", seed=None):
+        self.labels = labels or {}
+        self.base_latency = base_latency
+        self.per_input_token = per_input_token
+        self.per_output_token = per_output_token
+        self.jitter = jitter
+        self.reply_text = reply_text
+        self._random = random.Random(seed)
+        self.calls = 0
+
+    @staticmethod
+    def estimate_tokens(text):
+        cjk = sum(1 for ch in text if ord(ch) > 0x2E80)
+        return cjk + (len(text) - cjk) / 4
+
+    @staticmethod
+    def _user_text(prompt):
+        for marker in ('用戶輸入："', '輸入："'):
+            if marker in prompt:
+                return prompt.rsplit(marker, 1)[1].split('"', 1)[0]
+        for marker in ('當前用戶任務：', '用戶說：', '問題：'):
+            if marker in prompt:
+                return prompt.rsplit(marker, 1)[1].split("\n", 1)[0].strip()
+        return ""
+
+    @staticmethod
+    def _prompt(request):
+        """system 與所有 messages 串成一段文字（延遲依整段輸入估算）"""
+        parts = [request["system"]] if request.get("system") else []
+        parts.extend(m["content"] if isinstance(m["content"], str) else json.dumps(m["content"], ensure_ascii=False)
+                     for m in request.get("messages", []))
+        return "\n".join(parts)
+
+    def _plan(self):
+        return {"動作順序": ["1", "2", "1", "3", "8"],
+                "說明": ["從原點走到使用者位置", "拿起物品", "從使用者位置走到目標位置", "放下物品", "說話，通知對方"]}
+
+    def respond(self, prompt):
+        """依提示詞種類產生回應文字"""
+        text = self._user_text(prompt)
+        label = self.labels.get(text, '聊天')
+
+        if '依類型輸出' in prompt:
+            data = {"type": label}
+            if label == '聊天':
+                data["response"] = self.reply_text
+            elif label == '查詢':
+                data["search_query"] = text
+            else:
+                data["movement_plan"] = self._plan()
+            return "```json\n" + json.dumps(data, ensure_ascii=False) + "\n```"
+        if '請只回復以下三種類型之一' in prompt:
+            return label
+        if '機器人動作規劃助手' in prompt:
+            return "```json\n" + json.dumps(self._plan(), ensure_ascii=False) + "\n```"
+        return self.reply_text
+
+    def _delay(self, prompt, output):
+        delay = (self.base_latency + self.per_input_token * self.estimate_tokens(prompt)
+                 + self.per_output_token * self.estimate_tokens(output) + self._random.gauss(0, self.jitter))
+        time.sleep(max(0.0, delay))
+
+    def invoke_model(self, body=None, modelId=None, contentType=None, **kwargs):
+        prompt = self._prompt(json.loads(body))
+        output = self.respond(prompt)
+        self._delay(prompt, output)
+        self.calls += 1
+        payload = json.dumps({"content": [{"type": "text", "text": output}]}, ensure_ascii=False)
+        return {"body": io.BytesIO(payload.encode("utf-8"))}
+
+    def invoke_model_with_response_stream(self, body=None, modelId=None, contentType=None, chunk_chars=3, **kwargs):
+        """串流版本：先等待 base_latency（首 token 延遲），之後每 chunk_chars 字依輸出速度送出一個事件"""
+        prompt = self._prompt(json.loads(body))
+        output = self.respond(prompt)
+        self.calls += 1
+
+        def events():
+            time.sleep(max(0.0, self.base_latency + self.per_input_token * self.estimate_tokens(prompt)
+                           + self._random.gauss(0, self.jitter)))
+            for i in range(0, len(output), chunk_chars):
+                piece = output[i:i + chunk_chars]
+                time.sleep(self.per_output_token * self.estimate_tokens(piece))
+                delta = {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": piece}}
+                yield {"chunk": {"bytes": json.dumps(delta, ensure_ascii=False).encode("utf-8")}}
+            yield {"chunk": {"bytes": json.dumps({"type": "message_stop"}).encode("utf-8")}}
+
+        return {"body": events()}
+
+
+class LocalPollyRuntime:
+    """Polly 的本地替身，介面與 polly client 的 synthesize_speech 相同
+
+    回傳假的音訊 bytes（長度約為 bytes_per_char × 字數），延遲模型：base_latency + per_char × 字數 + 高斯抖動（秒），
+    字數不含 SSML 標籤。
+    """
+
+    def __init__(self, base_latency=0.12, per_char=0.004, jitter=0.02, bytes_per_char=600, seed=None):
+        self.base_latency = base_latency
+        self.per_char = per_char
+        self.jitter = jitter
+        self.bytes_per_char = bytes_per_char
+        self._random = random.Random(seed)
+        self.calls = 0
+        self.characters = 0
+
+    @staticmethod
+    def _plain_text(text):
+        plain, depth = [], 0
+        for ch in text:
+            if ch == "<":
+                depth += 1
+            elif ch == ">":
+                depth = max(0, depth - 1)
+            elif not depth:
+                plain.append(ch)
+        return "".join(plain).strip()
+
+    def synthesize_speech(self, Text=None, OutputFormat="mp3", VoiceId=None, TextType="text", **kwargs):
+        text = self._plain_text(Text) if TextType == "ssml" else Text
+        time.sleep(max(0.0, self.base_latency + self.per_char * len(text) + self._random.gauss(0, self.jitter)))
+        self.calls += 1
+        self.characters += len(text)
+        header = b"ID3" if OutputFormat == "mp3" else b""
+        return {"AudioStream": io.BytesIO(header + bytes(self.bytes_per_char * max(1, len(text))))}
+
+
+class _SearchResponse:
+    def __init__(self, payload):
+        self._payload = payload
+        self.status_code = 200
+
+    def json(self):
+        return self._payload
+
+
+class LocalSearchApi:
+    """Google Custom Search 的本地替身，介面與 requests.Session 的 get 相同（CommandClassifier.http）
+
+    回傳三筆以查詢字串組成的結果；延遲模型：base_latency + 高斯抖動（秒）。
+    """
+
+    def __init__(self, base_latency=0.3, jitter=0.05, seed=None):
+        self.base_latency = base_latency
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self.calls = 0
+
+    def get(self, url, params=None, timeout=None, **kwargs):
+        query = (params or {}).get("q", "")
+        time.sleep(max(0.0, self.base_latency + self._random.gauss(0, self.jitter)))
+        self.calls += 1
+        items = [{"title": f"{query} 相關資料 {i}", "snippet": f"關於「{query}」的第 {i} 筆摘要。",
+                  "link": f"https://example.com/{i}"} for i in range(1, 4)]
+        return _SearchResponse({"items": items})
+
+
+class InjectedFault(ConnectionError):
+    """FaultInjectingClient 故意製造的錯誤"""
+
+
+class FaultInjectingClient:
+    """包住任何 client（真的 boto3 client 或上面的本地替身），依機率注入錯誤與延遲，用來驗證逾時、hedging 與斷路器
+
+    - error_rate：呼叫失敗的機率（等待 error_latency 秒後拋出 InjectedFault）
+    - slow_rate：呼叫變慢的機率（先多等 slow_seconds 秒，模擬長尾延遲）
+    - outage(seconds)：接下來 seconds 秒內所有呼叫都失敗
+    - error_type：拋出的例外類別（例如包住 LocalSearchApi 時用 requests.ConnectionError）
+    """
+
+    def __init__(self, client, error_rate=0.0, slow_rate=0.0, slow_seconds=2.0, error_latency=0.05, seed=None,
+                 error_type=InjectedFault):
+        self.client = client
+        self.error_type = error_type
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_seconds = slow_seconds
+        self.error_latency = error_latency
+        self._random = random.Random(seed)
+        self._outage_until = 0.0
+        self.calls = 0
+        self.errors = 0
+        self.slow = 0
+
+    def outage(self, seconds):
+        self._outage_until = time.time() + seconds
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self.calls += 1
+            roll = self._random.random()
+            if time.time() < self._outage_until or roll < self.error_rate:
+                self.errors += 1
+                time.sleep(self.error_latency)
+                raise self.error_type(f"注入的 {name} 錯誤")
+            if roll < self.error_rate + self.slow_rate:
+                self.slow += 1
+                time.sleep(self.slow_seconds)
+            return attr(*args, **kwargs)
+
+        return call
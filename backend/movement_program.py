@@ -0,0 +1,462 @@
+import json
+import os
+import queue
+import re
+import threading
+
+# 依關鍵詞判斷動作種類；同時用於動作清單的模板與 LLM 產生的說明（順序有意義：「停止倒」要先於「倒」）
+KIND_KEYWORDS = (
+    ("pour_stop", ("停止倒",)),
+    ("pour", ("倒",)),
+    ("press", ("按下",)),
+    ("release", ("放開",)),
+    ("pick", ("拿起", "拿取")),
+    ("place", ("放下", "放到", "放回")),
+    ("say", ("說話", "通知", "告訴")),
+    ("move", ("走到", "走道", "走回", "走去", "前往")),
+)
+
+# 模板字面字的常見變體（例如說明寫成「走道」）
+LITERAL_ALIASES = {
+    "走到": ("走到", "走道", "走回", "走去"),
+}
+
+_PARAM = re.compile(r"\b([A-Z])\b")
+
+
+class MovementError(RuntimeError):
+    """執行器無法完成某個動作步驟"""
+
+
+def action_kind(text):
+    for kind, keywords in KIND_KEYWORDS:
+        if any(keyword in text for keyword in keywords):
+            return kind
+    return None
+
+
+class ActionTemplate:
+    """動作清單中的一個動作，例如 "1": "從 A 走到 B"，可從說明文字中取出 A / B 的值"""
+
+    def __init__(self, code, text):
+        self.code = code
+        self.text = text
+        self.kind = action_kind(text) or "custom"
+        self.params = _PARAM.findall(text)
+        # 參數之間的字面字（去空白），literals[0] 在第一個參數之前、literals[-1] 在最後一個參數之後
+        self.literals = [part.replace(" ", "") for part in _PARAM.split(text)[::2]]
+        self._pattern = self._compile()
+
+    def _compile(self):
+        pattern = ""
+        for i, literal in enumerate(self.literals):
+            options = "|".join(re.escape(alias) for alias in LITERAL_ALIASES.get(literal, (literal,)))
+            if i == 0:
+                pattern += f"(?:{options})" if literal else ""
+            elif i == len(self.literals) - 1:
+                pattern += f"(?:{options})?" if literal else ""
+            else:
+                pattern += f"(?:{options})"
+            if i < len(self.params):
+                pattern += f"(?P<{self.params[i]}>.+?)"
+        return re.compile(f"^{pattern}$")
+
+    def bind(self, description):
+        """回傳參數 dict；對不上模板時回傳 None"""
+        text = re.sub(r"\s+", "", description)
+        match = self._pattern.match(text)
+        if match:
+            return match.groupdict()
+        if len(self.params) != 1:
+            return None
+        # 只有一個參數時放寬開頭：保留與模板共同的前綴（「說話，通知工讀生」對「說話，說話內容為 A」）
+        lead = self.literals[0]
+        common = os.path.commonprefix([lead, text])
+        value = text[len(common):]
+        trail = self.literals[-1]
+        if trail and value.endswith(trail):
+            value = value[:-len(trail)]
+        return {self.params[0]: value} if common and value else None
+
+
+class ActionStep:
+    """編譯後的單一步驟"""
+
+    def __init__(self, index, template, description=None, params=None, inferred=False):
+        self.index = index
+        self.code = template.code
+        self.kind = template.kind
+        self.template = template
+        self.description = description
+        self.params = params or {}
+        # inferred：動作順序缺少、依說明補上的步驟；bound：參數已全部取出
+        self.inferred = inferred
+        self.bound = set(self.params) == set(template.params)
+
+    @property
+    def text(self):
+        if self.description:
+            return self.description
+        return self.template.text
+
+    def to_dict(self):
+        return {
+            "index": self.index,
+            "code": self.code,
+            "kind": self.kind,
+            "params": dict(self.params),
+            "description": self.text,
+            "inferred": self.inferred,
+            "bound": self.bound,
+        }
+
+    def __repr__(self):
+        return f"ActionStep({self.index}, {self.code}/{self.kind}, {self.params}, {self.text!r})"
+
+
+class PlanCompiler:
+    """把 {動作順序, 說明} 逐步編譯成 ActionStep
+
+    說明可以一筆一筆加入（串流時邊產生邊編譯），每筆說明依動作種類與目前的代號對齊：
+    - 種類相符：配對並從說明取出參數
+    - 下一個代號不符、再下一個相符：前一個代號視為缺少說明，先輸出
+    - 都不相符但說明本身看得出動作種類：依動作清單補上代號（inferred）
+    未知代號直接丟棄並記錄警告，代號比說明多時剩下的代號在 finish() 輸出。
+    """
+
+    def __init__(self, actions):
+        self.templates = {str(code): ActionTemplate(str(code), text) for code, text in actions.items()}
+        self.by_kind = {}
+        for template in self.templates.values():
+            self.by_kind.setdefault(template.kind, template)
+        self.codes = None
+        self.steps = []
+        self.warnings = []
+        self._pending_descriptions = []
+
+    def set_codes(self, codes):
+        """設定動作順序，回傳可以立即輸出的步驟（先前已收到的說明）"""
+        self.codes = []
+        for code in codes:
+            code = str(code)
+            if code in self.templates:
+                self.codes.append(code)
+            else:
+                self.warnings.append(f"未定義的動作代號 {code}，已略過")
+        pending, self._pending_descriptions = self._pending_descriptions, []
+        steps = []
+        for description in pending:
+            steps.extend(self.add_description(description))
+        return steps
+
+    def _emit(self, template, description=None, inferred=False):
+        params = template.bind(description) if description else None
+        if description and params is None:
+            self.warnings.append(f"第 {len(self.steps) + 1} 步的說明對不上動作模板：{description}")
+        step = ActionStep(len(self.steps), template, description, params, inferred)
+        self.steps.append(step)
+        return step
+
+    def add_description(self, description):
+        """加入一筆說明，回傳因此完成的步驟"""
+        if self.codes is None:
+            self._pending_descriptions.append(description)
+            return []
+        kind = action_kind(description)
+        codes = self.codes
+        templates = self.templates
+        if codes and (kind is None or templates[codes[0]].kind == kind):
+            return [self._emit(templates[codes.pop(0)], description)]
+        if len(codes) > 1 and templates[codes[1]].kind == kind:
+            missing = self._emit(templates[codes.pop(0)])
+            self.warnings.append(f"代號 {missing.code} 缺少說明")
+            return [missing, self._emit(templates[codes.pop(0)], description)]
+        if kind in self.by_kind:
+            self.warnings.append(f"說明「{description}」缺少對應代號，補上 {self.by_kind[kind].code}")
+            return [self._emit(self.by_kind[kind], description, inferred=True)]
+        if codes:
+            return [self._emit(templates[codes.pop(0)], description)]
+        self.warnings.append(f"說明「{description}」沒有對應的動作，已略過")
+        return []
+
+    def finish(self):
+        """輸出剩下沒有說明的代號"""
+        steps = []
+        if self.codes is None:
+            self.codes = []
+            if self._pending_descriptions:
+                self.warnings.append("缺少動作順序")
+        for code in self.codes:
+            self.warnings.append(f"代號 {code} 缺少說明")
+            steps.append(self._emit(self.templates[code]))
+        self.codes = []
+        return steps
+
+    def program(self):
+        return MovementProgram(self.steps, self.warnings)
+
+
+class MovementProgram:
+    """編譯完成的動作程式"""
+
+    def __init__(self, steps, warnings=None):
+        self.steps = list(steps)
+        self.warnings = list(warnings or [])
+
+    def to_plan(self):
+        """修正後的 {動作順序, 說明}（兩者長度一致），沒有步驟時回傳空計劃"""
+        if not self.steps:
+            return {"動作順序": [], "說明": ["無法生成有效的動作計劃"]}
+        return {"動作順序": [step.code for step in self.steps], "說明": [step.text for step in self.steps]}
+
+    def speech_lines(self):
+        return [f"{step.code}，{step.text}" for step in self.steps]
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    def __len__(self):
+        return len(self.steps)
+
+
+def compile_plan(plan, actions):
+    """一次編譯完整的 {動作順序, 說明}"""
+    compiler = PlanCompiler(actions)
+    if isinstance(plan, dict):
+        compiler.set_codes(plan.get('動作順序') or [])
+        for description in plan.get('說明') or []:
+            if isinstance(description, str) and description != "無法生成有效的動作計劃":
+                compiler.add_description(description)
+    compiler.finish()
+    return compiler.program()
+
+
+_CODES = re.compile(r'"動作順序"\s*:\s*\[(.*?)\]', re.S)
+_DESCRIPTIONS = re.compile(r'"說明"\s*:\s*\[', re.S)
+_STRING = re.compile(r'"((?:[^"\\]|\\.)*)"|(\])')
+
+
+class PlanStream:
+    """從串流的模型文字邊讀邊編譯動作計劃，可迭代取得 ActionStep
+
+    動作順序的陣列一結束、每筆說明字串一收完就輸出對應的步驟，執行器可在模型
+    還在產生後面的說明時就開始執行第一步。迭代結束後 plan() 回傳修正後的計劃。
+    """
+
+    def __init__(self, chunks, actions, on_complete=None):
+        self.chunks = chunks
+        self.compiler = PlanCompiler(actions)
+        self.on_complete = on_complete
+        self.done = False
+        self._buffer = ""
+        self._read = 0
+        self._closed = False
+
+    @classmethod
+    def from_plan(cls, plan, actions):
+        """已經有完整計劃（快取命中、單次呼叫）時，包成相同介面"""
+        return cls([json.dumps(plan, ensure_ascii=False)], actions)
+
+    def _parse(self):
+        compiler = self.compiler
+        steps = []
+        if compiler.codes is None:
+            match = _CODES.search(self._buffer)
+            if match:
+                try:
+                    codes = json.loads(f"[{match.group(1)}]")
+                except ValueError:
+                    codes = re.findall(r"\d+", match.group(1))
+                steps.extend(compiler.set_codes(codes))
+        start = None if self._closed else _DESCRIPTIONS.search(self._buffer)
+        if start is None:
+            return steps
+        position = max(self._read, start.end())
+        for match in _STRING.finditer(self._buffer, position):
+            if match.group(2):
+                # 說明陣列結束
+                self._closed = True
+                break
+            self._read = match.end()
+            try:
+                description = json.loads(f'"{match.group(1)}"')
+            except ValueError:
+                description = match.group(1)
+            steps.extend(compiler.add_description(description))
+        return steps
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self._buffer += chunk
+            yield from self._parse()
+        yield from self.compiler.finish()
+        self.done = True
+        if self.on_complete:
+            self.on_complete(self.plan())
+
+    def program(self):
+        return self.compiler.program()
+
+    def plan(self):
+        return self.program().to_plan()
+
+
+class MovementExecutor:
+    """執行器介面：execute(step) 阻塞到該步驟完成，無法完成時拋出 MovementError；stop() 立即停止"""
+
+    def execute(self, step):
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+    def state(self):
+        return {}
+
+
+class SimulatedRobot(MovementExecutor):
+    """模擬機器人：記錄位置、手上物品、按住的按鈕與說過的話，並檢查動作前提
+
+    每種動作的耗時為 STEP_SECONDS × time_scale（預設由 ROBOT_TIME_SCALE 決定，0 表示立即完成）。
+    """
+
+    STEP_SECONDS = {"move": 3.0, "pick": 1.0, "place": 1.0, "pour": 2.0, "pour_stop": 0.5,
+                    "press": 0.5, "release": 0.5, "say": 1.0, "custom": 1.0}
+
+    def __init__(self, time_scale=None, location="原點"):
+        self.time_scale = float(os.getenv('ROBOT_TIME_SCALE', '0')) if time_scale is None else time_scale
+        self.location = location
+        self.holding = None
+        self.pouring = None
+        self.pressed = set()
+        self.said = []
+        self.log = []
+        self._stop = threading.Event()
+
+    def execute(self, step):
+        self._stop.clear()
+        params = step.params
+        kind = step.kind
+        if kind == "move":
+            self.location = params.get("B") or step.text
+        elif kind == "pick":
+            if self.holding is not None:
+                raise MovementError(f"手上已經拿著 {self.holding}")
+            self.holding = params.get("A") or "物品"
+        elif kind == "place":
+            if self.holding is None:
+                raise MovementError("手上沒有東西可以放下")
+            self.holding = None
+        elif kind == "pour":
+            self.pouring = params.get("A") or "液體"
+        elif kind == "pour_stop":
+            self.pouring = None
+        elif kind == "press":
+            self.pressed.add(params.get("A") or step.text)
+        elif kind == "release":
+            self.pressed.discard(params.get("A") or step.text)
+        elif kind == "say":
+            self.said.append(params.get("A") or step.text)
+
+        if self._stop.wait(self.STEP_SECONDS.get(kind, 1.0) * self.time_scale):
+            raise MovementError("已被中斷")
+        self.log.append((step.code, step.text))
+
+    def stop(self):
+        self._stop.set()
+
+    def state(self):
+        return {"location": self.location, "holding": self.holding, "pouring": self.pouring,
+                "pressed": sorted(self.pressed), "steps": len(self.log)}
+
+
+class MovementRunner:
+    """在背景執行緒依序把步驟交給執行器；步驟可以邊產生邊送入
+
+    每次 follow() 是一個新程式，某一步失敗或被 stop() 中斷時，同一程式剩下的步驟不再執行。
+    on_event(類型, 資料) 在步驟開始、完成、失敗時呼叫（例如推送 SSE 事件）。
+    """
+
+    def __init__(self, executor=None, on_event=None):
+        self.executor = executor or SimulatedRobot()
+        self.on_event = on_event
+        self._queue = queue.Queue()
+        self._program = 0
+        self._aborted = set()
+        self._aborted_before = 0
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.failed = 0
+        self.skipped = 0
+        self._worker = threading.Thread(target=self._run, name="movement-runner", daemon=True)
+        self._worker.start()
+
+    def _publish(self, event, step, **extra):
+        if self.on_event:
+            self.on_event(event, {**step.to_dict(), **extra})
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            program, step = item
+            try:
+                with self._lock:
+                    aborted = program < self._aborted_before or program in self._aborted
+                if aborted:
+                    self.skipped += 1
+                    continue
+                self._publish("action_start", step)
+                try:
+                    self.executor.execute(step)
+                except MovementError as e:
+                    print(f"⚠️ 動作第 {step.index + 1} 步失敗：{e}")
+                    self.failed += 1
+                    with self._lock:
+                        self._aborted.add(program)
+                    self._publish("action_failed", step, error=str(e))
+                else:
+                    self.executed += 1
+                    self._publish("action_done", step)
+            finally:
+                self._queue.task_done()
+
+    def follow(self, steps):
+        """把步驟依序送去執行，同時逐行產生「代號，說明」的播報文字"""
+        with self._lock:
+            self._program += 1
+            program = self._program
+            self._aborted = {p for p in self._aborted if p >= self._aborted_before}
+        for step in steps:
+            self._queue.put((program, step))
+            yield f"{step.code}，{step.text}\n"
+
+    def run(self, program):
+        """送出整個程式並等待執行完畢"""
+        for _ in self.follow(program):
+            pass
+        self.wait()
+
+    def wait(self):
+        self._queue.join()
+
+    def stop(self):
+        """中斷目前與排隊中的所有步驟"""
+        with self._lock:
+            self._aborted_before = self._program + 1
+        self.executor.stop()
+
+    def close(self):
+        self.stop()
+        self._queue.put(None)
+
+    def stats(self):
+        return {
+            "pending": self._queue.qsize(),
+            "executed": self.executed,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "state": self.executor.state(),
+        }
@@ -0,0 +1,171 @@
+import threading
+import time
+from collections import deque
+
+
+class UtteranceQueue:
+    """錄音執行緒與處理執行緒之間的有界佇列
+
+    put() 永不阻塞錄音端；佇列滿時依 policy 處理：
+    - "drop_oldest"：丟掉最舊的一段（預設，保留使用者最新說的話）
+    - "drop_newest"：丟掉剛進來的這一段
+    - "merge"：把新語句併入佇列中最後一段（需提供 merge_fn）
+    """
+
+    POLICIES = ("drop_oldest", "drop_newest", "merge")
+
+    def __init__(self, maxsize=4, policy="drop_oldest", merge_fn=None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"未知的佇列策略: {policy}")
+        if policy == "merge" and merge_fn is None:
+            raise ValueError("merge 策略需要提供 merge_fn")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.merge_fn = merge_fn
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self.enqueued = 0
+        self.dropped = 0
+        self.merged = 0
+        self.max_depth = 0
+
+    def put(self, item):
+        """放入一段語句，回傳是否被接受（合併也算接受）"""
+        with self._cond:
+            if len(self._items) >= self.maxsize:
+                if self.policy == "drop_newest":
+                    self.dropped += 1
+                    return False
+                if self.policy == "merge":
+                    last, enqueued_at = self._items[-1]
+                    self._items[-1] = (self.merge_fn(last, item), enqueued_at)
+                    self.merged += 1
+                    self._cond.notify()
+                    return True
+                self._items.popleft()
+                self.dropped += 1
+
+            self._items.append((item, time.time()))
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, len(self._items))
+            self._cond.notify()
+            return True
+
+    def get(self, timeout=None):
+        """取出 (item, 入佇列時間)；逾時或已關閉回傳 None"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._items or self._closed, timeout):
+                return None
+            if not self._items:
+                return None
+            return self._items.popleft()
+
+    def clear(self):
+        with self._cond:
+            self.dropped += len(self._items)
+            self._items.clear()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def reopen(self):
+        with self._cond:
+            self._closed = False
+
+    def __len__(self):
+        with self._cond:
+            return len(self._items)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "depth": len(self._items),
+                "maxsize": self.maxsize,
+                "policy": self.policy,
+                "enqueued": self.enqueued,
+                "dropped": self.dropped,
+                "merged": self.merged,
+                "max_depth": self.max_depth,
+            }
+
+
+class WorkerPool:
+    """從 UtteranceQueue 取語句並執行 handler（STT → 分類 → 回應）的執行緒池"""
+
+    def __init__(self, utterance_queue, handler, num_workers=1, name="pipeline-worker"):
+        self.queue = utterance_queue
+        self.handler = handler
+        self.num_workers = max(1, num_workers)
+        self.name = name
+        self._threads = []
+        self._lock = threading.Lock()
+        self._running = False
+
+        self.busy = 0
+        self.processed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_process = 0.0
+
+    def start(self):
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            if self._running and self._threads:
+                return
+            self._running = True
+            self.queue.reopen()
+            for i in range(self.num_workers):
+                thread = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        self._running = False
+        self.queue.close()
+
+    def is_running(self):
+        return self._running and any(t.is_alive() for t in self._threads)
+
+    def _run(self):
+        while self._running:
+            entry = self.queue.get(timeout=0.5)
+            if entry is None:
+                continue
+            item, enqueued_at = entry
+            started = time.time()
+            wait = started - enqueued_at
+            with self._lock:
+                self.busy += 1
+            try:
+                self.handler(item)
+                ok = True
+            except Exception as e:
+                print(f"❌ 處理語句時發生錯誤: {str(e)}")
+                ok = False
+            with self._lock:
+                self.busy -= 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.total_process += time.time() - started
+                if ok:
+                    self.processed += 1
+                else:
+                    self.failed += 1
+
+    def stats(self):
+        with self._lock:
+            done = self.processed + self.failed
+            return {
+                "workers": self.num_workers,
+                "busy": self.busy,
+                "processed": self.processed,
+                "failed": self.failed,
+                "avg_wait_ms": round(self.total_wait / done * 1000, 1) if done else 0.0,
+                "max_wait_ms": round(self.max_wait * 1000, 1),
+                "avg_process_ms": round(self.total_process / done * 1000, 1) if done else 0.0,
+            }
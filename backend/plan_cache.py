@@ -0,0 +1,149 @@
+import threading
+from collections import Counter, OrderedDict
+from intent_classifier import normalize
+from movement_program import compile_plan
+
+
+def edit_distance(a, b, limit=None):
+    """字元層級的 Levenshtein 距離；超過 limit 時提早結束並回傳 limit + 1"""
+    if len(a) < len(b):
+        a, b = b, a
+    if limit is not None and len(a) - len(b) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if limit is not None and min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def validate_plan(plan, actions):
+    """檢查動作計劃：動作順序非空、代號都在動作清單中、說明為非空字串陣列；回傳整理後的新 dict"""
+    if not isinstance(plan, dict):
+        raise ValueError("動作計劃不是物件")
+    codes = plan.get('動作順序')
+    descriptions = plan.get('說明')
+    if not isinstance(codes, list) or not codes:
+        raise ValueError("動作順序為空")
+    if not isinstance(descriptions, list) or not descriptions or not all(isinstance(d, str) for d in descriptions):
+        raise ValueError("說明格式錯誤")
+    codes = [str(code) for code in codes]
+    unknown = [code for code in codes if code not in actions]
+    if unknown:
+        raise ValueError(f"未定義的動作代號: {unknown}")
+    return {"動作順序": codes, "說明": list(descriptions)}
+
+
+class PlanCache:
+    """行動計劃快取：相同或幾乎相同的任務直接回傳之前驗證過的計劃，不呼叫 LLM
+
+    - 任務以 normalizer 正規化後比對，完全相同即命中
+    - 否則找編輯距離相似度（1 - 距離 / 較長字串長度）最高且達 threshold 的任務；
+      兩者不同的字若出現在舊計劃的說明中（例如「溫開水」改成「熱開水」），代表計劃內容
+      與任務細節綁在一起，不算命中
+    - 來源：assets 的任務拆解（source="assets"，資產更新時整批替換）與成功規劃過的任務
+    """
+
+    def __init__(self, threshold=0.85, max_items=512, normalizer=normalize):
+        self.threshold = threshold
+        self.max_items = max_items
+        self.normalizer = normalizer
+        self._entries = OrderedDict()  # 正規化任務 -> (原任務, 計劃, 來源)
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.rejected = 0
+
+    def add(self, task, plan, actions, source="llm"):
+        """驗證並編譯後加入；計劃不合法時忽略並回傳 False
+
+        存的是代號與說明已對齊的編譯結果（與 CommandClassifier.compile_movement 相同），
+        命中時回傳的計劃可以直接執行與播報。
+        """
+        key = self.normalizer(task)
+        if not key:
+            return False
+        try:
+            plan = compile_plan(validate_plan(plan, actions), actions).to_plan()
+        except ValueError:
+            return False
+        if not plan["動作順序"]:
+            return False
+        with self._lock:
+            self._entries[key] = (task, plan, source)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+        return True
+
+    def load(self, tasks, actions, source):
+        """以 [(任務, 計劃), ...] 取代同一來源的所有項目，回傳加入的筆數"""
+        with self._lock:
+            for key in [key for key, (_, _, entry_source) in self._entries.items() if entry_source == source]:
+                del self._entries[key]
+        return sum(self.add(task, plan, actions, source) for task, plan in tasks)
+
+    def _unmatched_in_plan(self, key, matched_key, plan):
+        """舊任務有、新任務沒有的字是否出現在舊計劃的說明裡"""
+        removed = Counter(matched_key) - Counter(key)
+        descriptions = self.normalizer("".join(plan["說明"]))
+        return any(ch in descriptions for ch in removed)
+
+    def lookup(self, task):
+        """回傳 (計劃副本, 相似度, 對應的任務) 或 None"""
+        key = self.normalizer(task)
+        with self._lock:
+            entry = self._entries.get(key) if key else None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return self._copy(entry[1]), 1.0, entry[0]
+            candidates = list(self._entries.items())
+
+        best = None
+        for matched_key, (matched_task, plan, _) in candidates:
+            longest = max(len(key), len(matched_key))
+            if not key or not longest:
+                continue
+            limit = int(longest * (1 - self.threshold))
+            distance = edit_distance(key, matched_key, limit)
+            if distance > limit:
+                continue
+            similarity = 1 - distance / longest
+            if best is None or similarity > best[0]:
+                best = (similarity, matched_key, matched_task, plan)
+
+        with self._lock:
+            if best is None:
+                self.misses += 1
+                return None
+            similarity, matched_key, matched_task, plan = best
+            if self._unmatched_in_plan(key, matched_key, plan):
+                self.rejected += 1
+                self.misses += 1
+                return None
+            self.near_hits += 1
+        return self._copy(plan), similarity, matched_task
+
+    @staticmethod
+    def _copy(plan):
+        return {"動作順序": list(plan["動作順序"]), "說明": list(plan["說明"])}
+
+    def stats(self):
+        with self._lock:
+            lookups = self.exact_hits + self.near_hits + self.misses
+            sources = Counter(source for _, _, source in self._entries.values())
+            return {
+                "entries": len(self._entries),
+                "sources": dict(sources),
+                "exact_hits": self.exact_hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "rejected": self.rejected,
+                "hit_rate": round((self.exact_hits + self.near_hits) / lookups, 3) if lookups else 0.0,
+            }
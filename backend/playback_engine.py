@@ -0,0 +1,369 @@
+"""低延遲 PCM 播放引擎
+
+Polly 直接輸出 16 kHz 16-bit PCM（不必解碼 MP3），各段依序接在同一條 sounddevice 輸出串流上（段落之間沒有空隙）。
+語速不再寫進 SSML，而是在本機用 WSOLA（waveform similarity overlap-add）做時間伸縮：
+- 「慢一點 / 快一點」對正在播放、已經在緩衝區的句子立即生效
+- 語音一律以 100% 語速合成，快取的音訊在任何語速下都能重用
+播放執行緒只預先算好 lead_ms 的輸出，中止時清空即可，停止延遲約為一個輸出區塊加上裝置延遲（< 50 ms）。
+
+合成訊號自我檢查（不需要喇叭）：
+
+    python playback_engine.py
+"""
+import threading
+import time
+from collections import deque
+import numpy as np
+
+
+def parse_rate(rate):
+    """Polly 語速字串（"80%"）→ 播放倍率（0.8）"""
+    if isinstance(rate, str):
+        rate = float(rate.strip().rstrip('%')) / 100
+    return min(4.0, max(0.25, float(rate)))
+
+
+class WSOLAStretcher:
+    """串流 WSOLA 時間伸縮：不改變音高，rate > 1 變快、< 1 變慢，rate 可以隨時修改
+
+    每一步輸出 hop（frame 的一半）個樣本、讀取 hop × rate 個輸入樣本；下一個分析幀在名義位置 ± tolerance 內
+    選和上一幀「自然延續」最相似（正規化互相關最大）的位置，加 Hann 窗重疊相加，接縫處不會有相位跳動。
+    rate 為 1 時直接取自然延續，輸出與輸入逐樣本相同。
+    """
+
+    def __init__(self, sample_rate=16000, frame_ms=30, tolerance_ms=8):
+        self.sample_rate = sample_rate
+        self.frame = int(sample_rate * frame_ms / 1000) // 2 * 2
+        self.hop = self.frame // 2
+        self.tolerance = int(sample_rate * tolerance_ms / 1000)
+        # 週期性 Hann 窗，50% 重疊相加後總和為 1
+        self.window = np.hanning(self.frame + 1)[:self.frame].astype(np.float32)
+        self.rate = 1.0
+        self.reset()
+
+    def reset(self):
+        pad = self.tolerance + self.hop
+        self._input = np.zeros(pad, dtype=np.float32)
+        self._offset = -pad           # _input[0] 的絕對位置（0 = 第一個送進來的樣本）
+        self._pushed = 0              # 已送進來的樣本數
+        self._position = -float(self.hop)  # 下一個分析幀的名義起點
+        self._natural = None          # 上一幀的自然延續起點
+        self._tail = np.zeros(self.hop, dtype=np.float32)
+        self._primed = False
+
+    @property
+    def position(self):
+        """目前讀到的輸入位置（絕對樣本數）"""
+        return self._position
+
+    @property
+    def pending(self):
+        """還沒輸出的輸入樣本數"""
+        return max(0, self._pushed - int(max(0.0, self._position)))
+
+    def push(self, samples):
+        samples = np.asarray(samples, dtype=np.float32)
+        self._input = np.concatenate([self._input, samples])
+        self._pushed += len(samples)
+
+    def _slice(self, start, end):
+        return self._input[start - self._offset:end - self._offset]
+
+    def step(self):
+        """輸出下一個 hop 個樣本；輸入不夠時回傳 None"""
+        nominal = int(round(self._position))
+        if self._natural is None or self.rate == 1.0:
+            chosen = self._natural if self._natural is not None else nominal
+            if chosen + self.frame > self._pushed:
+                return None
+        else:
+            if max(nominal + self.tolerance, self._natural) + self.frame > self._pushed:
+                return None
+            template = self._slice(self._natural, self._natural + self.frame)
+            region = self._slice(nominal - self.tolerance, nominal + self.tolerance + self.frame)
+            correlation = np.correlate(region, template, mode='valid')
+            energy = np.concatenate([[0.0], np.cumsum(np.square(region, dtype=np.float64))])
+            energy = energy[self.frame:] - energy[:-self.frame]
+            best = int(np.argmax(correlation / np.sqrt(np.maximum(energy, 1e-9))))
+            chosen = nominal - self.tolerance + best
+
+        frame = self._slice(chosen, chosen + self.frame) * self.window
+        output = self._tail + frame[:self.hop]
+        self._tail = frame[self.hop:].copy()
+        self._natural = chosen + self.hop
+        self._position += self.hop * self.rate
+
+        # 丟掉之後不會再用到的輸入
+        keep_from = min(int(self._position) - self.tolerance, self._natural)
+        if keep_from - self._offset > 4 * self.frame:
+            self._input = self._input[keep_from - self._offset:]
+            self._offset = keep_from
+
+        if not self._primed:
+            # 第一個區塊只有開頭補的零
+            self._primed = True
+            return self.step()
+        return output
+
+    def flush(self):
+        """輸入結束：補零把剩下的樣本全部輸出，之後重新開始"""
+        end = self._pushed
+        blocks = []
+        if end > 0:
+            self.push(np.zeros(self.frame * 2 + self.tolerance * 2 + int(self.hop * self.rate), dtype=np.float32))
+            while self._position < end:
+                block = self.step()
+                if block is None:
+                    break
+                blocks.append(block)
+        self.reset()
+        return blocks
+
+
+class PCMPlayer:
+    """sounddevice 輸出串流上的段落佇列播放器
+
+    enqueue() 排入一段 int16 PCM，段落依序無縫播放；set_rate() 立即改變語速；stop() 清空所有段落。
+    音訊 callback 只從預先算好的輸出緩衝複製資料，時間伸縮在背景執行緒計算（最多領先 lead_ms）。
+    有 reference（echo_canceller.PlaybackReference）時，實際送到喇叭的樣本連同播放時間都會登記進去。
+    """
+
+    def __init__(self, sample_rate=16000, block_ms=10, lead_ms=40, reference=None, device=None):
+        self.sample_rate = sample_rate
+        self.block_size = int(sample_rate * block_ms / 1000)
+        self.lead = int(sample_rate * lead_ms / 1000)
+        self.reference = reference
+        self.stretcher = WSOLAStretcher(sample_rate)
+        self.rate = 1.0
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._segments = deque()   # 等待送進時間伸縮的段落：(PCM, on_start)
+        self._starts = deque()     # 已送進時間伸縮的段落起點：(絕對位置, on_start)
+        self._output = deque()     # 算好的輸出區塊：[樣本, on_start 列表]
+        self._output_samples = 0
+        self._cursor = 0           # _output[0] 已播放的樣本數
+        self._played = deque()     # callback 播出的區塊：(播放時間, 樣本)，交給 reference
+        self._started = deque()    # callback 播到段落開頭時要呼叫的 on_start
+        self._generation = 0
+        self._rendering = False
+        self._closed = False
+
+        self.segments = 0
+        self.underruns = 0
+        self.stops = 0
+        self.played_seconds = 0.0
+
+        import sounddevice as sd
+
+        self.stream = sd.OutputStream(samplerate=sample_rate, channels=1, dtype='int16',
+                                      blocksize=self.block_size, latency='low', device=device,
+                                      callback=self._callback)
+        self._renderer = threading.Thread(target=self._render_loop, daemon=True)
+        self._renderer.start()
+        self.stream.start()
+
+    # ---- 控制 ----
+
+    def enqueue(self, pcm, on_start=None):
+        """排入一段 16-bit 單聲道 PCM（bytes 或 int16 陣列）"""
+        if isinstance(pcm, (bytes, bytearray)):
+            pcm = np.frombuffer(pcm, dtype='<i2')
+        samples = np.asarray(pcm, dtype=np.float32) / 32768.0
+        if not len(samples):
+            return
+        with self._lock:
+            self._segments.append((samples, on_start))
+            self.segments += 1
+        self._wakeup.set()
+
+    def set_rate(self, rate):
+        """立即套用到還沒播出的音訊（包含正在播放的這一句）"""
+        self.rate = parse_rate(rate)
+        self.stretcher.rate = self.rate
+
+    def stop(self):
+        """中止播放並丟棄所有段落；下一個 callback（block_ms 內）起輸出靜音"""
+        with self._lock:
+            self._generation += 1
+            self._segments.clear()
+            self._output.clear()
+            self._output_samples = 0
+            self._cursor = 0
+            self._started.clear()
+            self._rendering = False
+            self.stops += 1
+        self._wakeup.set()
+
+    @property
+    def busy(self):
+        """是否還有聲音要播（含尚未伸縮的段落）"""
+        with self._lock:
+            return bool(self._segments or self._output or self._rendering)
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        self.stream.stop()
+        self.stream.close()
+
+    def stats(self):
+        return {
+            "rate": self.rate,
+            "segments": self.segments,
+            "stops": self.stops,
+            "underruns": self.underruns,
+            "played_seconds": round(self.played_seconds, 1),
+            "latency_ms": round(float(self.stream.latency) * 1000, 1),
+        }
+
+    # ---- 音訊 callback（不做任何計算，只複製緩衝） ----
+
+    def _callback(self, outdata, frames, time_info, status):
+        out = outdata[:, 0]
+        filled = 0
+        with self._lock:
+            while filled < frames and self._output:
+                block, callbacks = self._output[0]
+                if self._cursor == 0 and callbacks:
+                    self._started.extend(callbacks)
+                n = min(frames - filled, len(block) - self._cursor)
+                out[filled:filled + n] = block[self._cursor:self._cursor + n]
+                filled += n
+                self._cursor += n
+                self._output_samples -= n
+                if self._cursor >= len(block):
+                    self._output.popleft()
+                    self._cursor = 0
+            if filled < frames and self._rendering:
+                # 還有輸入但時間伸縮沒跟上
+                self.underruns += 1
+        out[filled:] = 0
+        if filled:
+            self.played_seconds += filled / self.sample_rate
+            if self.reference is not None:
+                latency = time_info.outputBufferDacTime - time_info.currentTime
+                if not 0 <= latency < 1:
+                    latency = float(self.stream.latency)
+                self._played.append((time.time() + latency, out[:filled].copy()))
+        self._wakeup.set()
+
+    # ---- 背景執行緒：時間伸縮與通知 ----
+
+    def _render_loop(self):
+        generation = self._generation
+        while not self._closed:
+            self._wakeup.wait(0.01)
+            self._wakeup.clear()
+            if generation != self._generation:
+                generation = self._generation
+                self.stretcher.reset()
+                self._starts.clear()
+            self._notify()
+            while self._output_samples < self.lead:
+                blocks = self._render()
+                if not blocks:
+                    break
+                with self._lock:
+                    if generation != self._generation:
+                        break
+                    for block, callbacks in blocks:
+                        pcm = np.clip(block * 32768.0, -32768, 32767).astype(np.int16)
+                        self._output.append((pcm, callbacks))
+                        self._output_samples += len(pcm)
+            with self._lock:
+                self._rendering = self.stretcher.pending > 0 and generation == self._generation
+
+    def _render(self):
+        """算出下一個輸出區塊（回傳 [(樣本, on_start 列表)]）；沒有輸入時回傳空列表"""
+        stretcher = self.stretcher
+        block = stretcher.step()
+        while block is None:
+            with self._lock:
+                segment = self._segments.popleft() if self._segments else None
+            if segment is None:
+                break
+            samples, on_start = segment
+            self._starts.append((stretcher._pushed, on_start))
+            stretcher.push(samples)
+            block = stretcher.step()
+        if block is not None:
+            return [(block, self._take_starts(stretcher.position))]
+        if stretcher.pending and self._output_samples < self.block_size * 2:
+            # 沒有下一段了（或合成還沒跟上）：把最後幾十毫秒補零輸出，避免卡在緩衝裡
+            blocks = stretcher.flush()
+            callbacks = self._take_starts(float('inf'))
+            return [(block, callbacks if i == 0 else []) for i, block in enumerate(blocks)]
+        return []
+
+    def _take_starts(self, position):
+        callbacks = []
+        while self._starts and self._starts[0][0] <= position:
+            on_start = self._starts.popleft()[1]
+            if on_start:
+                callbacks.append(on_start)
+        return callbacks
+
+    def _notify(self):
+        """把 callback 記下的事件帶出音訊執行緒：段落開始通知、回音消除參考訊號"""
+        while self._started:
+            on_start = self._started.popleft()
+            try:
+                on_start()
+            except Exception as e:
+                print(f"⚠️ 播放開始通知失敗：{e}")
+        if self.reference is None:
+            self._played.clear()
+            return
+        chunk_start, chunks = None, []
+        while self._played:
+            played_at, samples = self._played.popleft()
+            if chunks and abs(played_at - (chunk_start + sum(map(len, chunks)) / self.sample_rate)) > 0.002:
+                self.reference.play(np.concatenate(chunks), self.sample_rate, chunk_start)
+                chunks = []
+            if not chunks:
+                chunk_start = played_at
+            chunks.append(samples)
+        if chunks:
+            self.reference.play(np.concatenate(chunks), self.sample_rate, chunk_start)
+
+
+def _dominant_frequency(samples, sample_rate):
+    spectrum = np.abs(np.fft.rfft(samples * np.hanning(len(samples))))
+    return np.argmax(spectrum) * sample_rate / len(samples)
+
+
+def self_check():
+    sample_rate = 16000
+    t = np.arange(int(2.0 * sample_rate)) / sample_rate
+    tone = (0.5 * np.sin(2 * np.pi * 220 * t) + 0.2 * np.sin(2 * np.pi * 660 * t)).astype(np.float32)
+
+    def stretch(rate, chunk=1000):
+        stretcher = WSOLAStretcher(sample_rate)
+        stretcher.rate = rate
+        blocks = []
+        for i in range(0, len(tone), chunk):
+            stretcher.push(tone[i:i + chunk])
+            block = stretcher.step()
+            while block is not None:
+                blocks.append(block)
+                block = stretcher.step()
+        blocks += stretcher.flush()
+        return np.concatenate(blocks)
+
+    identity = stretch(1.0)
+    results = [("語速 100% 與原音相同（最大誤差）", float(np.max(np.abs(identity[:len(tone)] - tone))),
+                np.allclose(identity[:len(tone)], tone, atol=1e-5), "")]
+    for rate in (0.8, 1.3):
+        out = stretch(rate)
+        ratio = len(tone) / rate / len(out)
+        results.append((f"語速 {rate:.0%} 長度比例", ratio, abs(ratio - 1) < 0.05, ""))
+        frequency = _dominant_frequency(out[sample_rate // 4:-sample_rate // 4], sample_rate)
+        results.append((f"語速 {rate:.0%} 音高", frequency, abs(frequency - 220) < 5, "Hz"))
+    for name, value, passed, unit in results:
+        print(f"{'✅' if passed else '❌'} {name}：{value:.4g} {unit}")
+    return all(passed for _, _, passed, _ in results)
+
+
+if __name__ == "__main__":
+    raise SystemExit(0 if self_check() else 1)
@@ -1,33 +1,68 @@
 # ===== 更新版 recorder.py =====
 
 import sounddevice as sd
-import numpy as np
 import time
 import os
-from scipy.io.wavfile import write
-from datetime import datetime
+from vad import RingBuffer, Endpointer, create_vad
+from audio_buffer import Utterance, AudioArchiver
 
 class AudioRecorder:
-    def __init__(self, sample_rate=16000, channels=1, silence_threshold=70000, silence_duration=1.5):
+    def __init__(self, sample_rate=16000, channels=1, frame_ms=30, vad=None, vad_mode="auto",
+                 pre_roll=0.3, hangover=0.3, min_speech=0.15, max_utterance=30.0, archive=False,
+                 keyword_spotter=None, wake_gate=None, echo_canceller=None):
         self.sample_rate = sample_rate
         self.channels = channels
-        self.silence_threshold = silence_threshold
-        self.silence_duration = silence_duration
+        # 10/20/30 ms 幀，端點判定精度約等於幀長
+        self.frame_ms = frame_ms
+        self.vad = vad if vad is not None else create_vad(vad_mode, sample_rate=sample_rate)
+        self.pre_roll = pre_roll
+        self.hangover = hangover
+        self.min_speech = min_speech
+        self.max_utterance = max_utterance
         self.audio_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'audio_input'))
         os.makedirs(self.audio_dir, exist_ok=True)
+        # ✅ 存檔改為可選、背景寫入，不再每段覆寫 recording.wav
+        self.archiver = AudioArchiver(self.audio_dir) if archive else None
+        # ✅ 裝置端關鍵詞偵測（keyword_spotter.KeywordSpotter），控制指令不送雲端 STT
+        self.keyword_spotter = keyword_spotter
+        self.keyword_skipped = 0
+        # ✅ 喚醒詞閘門（wake_gate.WakeWordGate）：休眠時的語句不送 STT
+        self.wake_gate = wake_gate
+        # ✅ 回音消除（echo_canceller.EchoCanceller）：播放中先扣掉喇叭回音再做 VAD，並偵測插話
+        self.echo_canceller = echo_canceller
 
 
-    def listen_forever(self, on_heard_callback):
+    def listen_forever(self, on_heard_callback, on_speech_start=None, on_speech_frame=None,
+                       on_speech_discard=None, on_keyword=None, on_barge_in=None):
+        """持續監聽；語句結束時以 Utterance 呼叫 on_heard_callback
+
+        on_speech_start / on_speech_frame / on_speech_discard 為可選掛勾，
+        讓串流辨識等下游在語句進行中就能讀取正在累積的 Utterance。
+        有 keyword_spotter 時，偵測到關鍵詞立即呼叫 on_keyword(關鍵詞)（喚醒 / 結束詞交給 wake_gate）；
+        觸發後沒有再說話的語句只有關鍵詞本身，直接丟棄不送 STT。
+        有 wake_gate 時，休眠中的語句不開串流辨識，結束時也不交給 on_heard_callback。
+        有 echo_canceller 時，之後的處理都用消除回音後的訊號；播放中偵測到使用者插話就呼叫 on_barge_in()。
+        """
         print("🎧 進入持續監聽模式...")
 
-        frame_duration = 0.3
-        frame_size = int(self.sample_rate * frame_duration)
-        stream = sd.InputStream(samplerate=self.sample_rate, channels=self.channels, dtype='int16')
+        frame_size = int(self.sample_rate * self.frame_ms / 1000)
+        stream = sd.InputStream(samplerate=self.sample_rate, channels=self.channels, dtype='int16',
+                                blocksize=frame_size)
         stream.start()
 
-        recording = []
-        last_voice_time = time.time()
-        speaking = False
+        # ✅ 預先配置 pre-roll 緩衝，避免吃掉字首
+        pre_roll = RingBuffer(int(self.sample_rate * self.pre_roll))
+        endpointer = Endpointer(frame_ms=self.frame_ms,
+                                hangover_ms=self.hangover * 1000,
+                                min_speech_ms=self.min_speech * 1000)
+        self.vad.reset()
+
+        utterance = None
+        gate = self.wake_gate
+        spotter = self.keyword_spotter if on_keyword or gate else None
+        keyword_only = False  # 目前語句在關鍵詞之後還沒有新的語音
+        if spotter:
+            spotter.reset()
 
         try:
             while True:
@@ -35,26 +70,71 @@ class AudioRecorder:
                 if overflowed:
                     print("⚠️ 音訊 overflow!")
 
-                volume = np.linalg.norm(frame)
-                #debug用音量
-                # print(volume)
-
-                if volume > self.silence_threshold:
-                    if not speaking:
-                        speaking = True
-                    recording.append(frame)
-                    last_voice_time = time.time()
-                else:
-                    if speaking and (time.time() - last_voice_time) > self.silence_duration:
-                        audio_data = np.concatenate(recording, axis=0)
-                        filename = os.path.join(self.audio_dir, f"recording.wav")
-                        write(filename, self.sample_rate, audio_data)
-
-                        if on_heard_callback:
-                            on_heard_callback(filename)
-
-                        recording = []
-                        speaking = False
+                samples = frame[:, 0]
+                if self.echo_canceller:
+                    # 這一幀的錄音時間約為讀取前 frame_ms
+                    captured_at = time.time() - self.frame_ms / 1000
+                    samples = self.echo_canceller.process_at(samples, captured_at)
+                    if self.echo_canceller.barge_in and on_barge_in:
+                        on_barge_in()
+                speech = self.vad.is_speech(samples)
+                event = endpointer.update(speech)
+
+                if spotter:
+                    keyword = spotter.feed(samples, speech)
+                    if keyword:
+                        if not (gate and gate.on_keyword(keyword)) and on_keyword:
+                            on_keyword(keyword)
+                        keyword_only = utterance is not None
+                    elif speech:
+                        keyword_only = False
+                # 說話中重新計時；靜音時檢查是否閒置逾時
+                if gate and speech:
+                    gate.touch()
+                elif gate:
+                    gate.poll()
+
+                if event == "start":
+                    utterance = Utterance(self.sample_rate, self.max_utterance)
+                    utterance.append_ring(pre_roll)
+                    utterance.append(samples)
+                    pre_roll.clear()
+                    if on_speech_start and (gate is None or gate.awake):
+                        on_speech_start(utterance)
+                    continue
+
+                if utterance is None:
+                    pre_roll.push(samples)
+                    continue
+
+                utterance.append(samples)
+                if on_speech_frame:
+                    on_speech_frame(utterance)
+
+                if event == "discard" or (event == "end" and keyword_only):
+                    if event == "end":
+                        self.keyword_skipped += 1
+                    if on_speech_discard:
+                        on_speech_discard(utterance)
+                    utterance = None
+                    keyword_only = False
+                elif gate and (event == "end" or utterance.is_full()) and not gate.allow(utterance):
+                    if event != "end":
+                        endpointer.reset()
+                    if on_speech_discard:
+                        on_speech_discard(utterance)
+                    utterance = None
+                elif event == "end" or utterance.is_full():
+                    if event != "end":
+                        endpointer.reset()
+                    utterance.finish(self.hangover if event == "end" else 0.0)
+                    if self.archiver:
+                        self.archiver.submit(utterance)
+
+                    if on_heard_callback:
+                        on_heard_callback(utterance)
+
+                    utterance = None
 
         except KeyboardInterrupt:
             print("👋 停止持續監聽")
@@ -0,0 +1,155 @@
+import time
+import threading
+import hashlib
+import json
+from collections import OrderedDict
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from intent_classifier import normalize
+
+# 查詢類型與快取秒數：依序比對關鍵詞，第一個命中的類型決定 TTL
+QUERY_CLASSES = (
+    ("realtime", ("股價", "匯率", "幾點", "時間", "比分", "即時", "路況"), 60),
+    ("weather", ("天氣", "氣溫", "溫度", "下雨", "降雨", "颱風", "空氣品質"), 600),
+    ("news", ("新聞", "最新", "今天", "最近"), 1800),
+    ("place", ("在哪", "哪裡", "地址", "怎麼去", "營業時間", "電話"), 86400),
+)
+DEFAULT_QUERY_CLASS = ("general", 6 * 3600)
+
+# 不影響查詢意思的客套詞與語尾
+FILLERS = ("請問", "幫我查一下", "幫我查", "查一下", "告訴我", "我想知道", "一下")
+TRAILING = "呢嗎啊呀吧"
+
+
+def normalize_query(text):
+    """快取 key 用的查詢正規化：去標點空白、轉小寫、去掉客套詞與語尾助詞"""
+    text = normalize(text)
+    for filler in FILLERS:
+        text = text.replace(filler, "")
+    return text.rstrip(TRAILING) or text
+
+
+def classify_query(text):
+    """回傳 (查詢類型, TTL 秒數)"""
+    for name, keywords, ttl in QUERY_CLASSES:
+        if any(keyword in text for keyword in keywords):
+            return name, ttl
+    return DEFAULT_QUERY_CLASS
+
+
+def create_http_session(pool_size=10, retries=2, backoff=0.3):
+    """keep-alive 連線池 + 對暫時性錯誤（連線失敗、429、5xx）自動重試的 requests.Session"""
+    retry = Retry(total=retries, connect=retries, read=retries, backoff_factor=backoff,
+                  status_forcelist=(429, 500, 502, 503, 504), allowed_methods=frozenset(["GET"]),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class TTLCache:
+    """每筆各自到期時間的 LRU 快取"""
+
+    def __init__(self, max_items=512):
+        self.max_items = max_items
+        self._items = OrderedDict()  # key -> (到期時間, 值)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._items[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl):
+        with self._lock:
+            self._items[key] = (time.time() + ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._items),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "expired": self.expired,
+                "evictions": self.evictions,
+            }
+
+
+class SearchCache:
+    """查詢快取：搜尋結果以正規化後的搜尋詞為 key，最終摘要答案以正規化後的問題為 key
+
+    兩者都依查詢類型決定 TTL（天氣短、地點長）。答案 key 另外帶入搜尋結果的指紋，
+    搜尋結果更新後舊答案自然失效。
+    """
+
+    def __init__(self, max_items=512):
+        self.results = TTLCache(max_items)
+        self.answers = TTLCache(max_items)
+        self.by_class = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(search_results):
+        raw = json.dumps(search_results, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+    def _count(self, query_class, hit):
+        with self._lock:
+            counts = self.by_class.setdefault(query_class, {"hits": 0, "misses": 0})
+            counts["hits" if hit else "misses"] += 1
+
+    def get_results(self, query):
+        query_class, _ = classify_query(query)
+        results = self.results.get(normalize_query(query))
+        self._count(query_class, results is not None)
+        return results
+
+    def put_results(self, query, results):
+        # 空結果多半是暫時性失敗，不快取
+        if results:
+            _, ttl = classify_query(query)
+            self.results.put(normalize_query(query), results, ttl)
+
+    def answer_key(self, text, search_results):
+        return f"{normalize_query(text)}|{self.fingerprint(search_results)}"
+
+    def get_answer(self, text, search_results):
+        return self.answers.get(self.answer_key(text, search_results))
+
+    def put_answer(self, text, search_results, answer):
+        if answer:
+            _, ttl = classify_query(text)
+            self.answers.put(self.answer_key(text, search_results), answer, ttl)
+
+    def stats(self):
+        with self._lock:
+            by_class = {name: dict(counts) for name, counts in self.by_class.items()}
+        return {"results": self.results.stats(), "answers": self.answers.stats(), "by_class": by_class}
@@ -0,0 +1,439 @@
+import io
+import threading
+import time
+import uuid
+import wave
+from collections import OrderedDict
+import numpy as np
+from audio_buffer import Utterance
+from aws_clients import turn_budget
+from tracing import current_trace, default_tracer, span
+from conversation_memory import ConversationMemory
+from event_bus import EventBus
+from movement_program import MovementRunner, PlanStream, SimulatedRobot
+from pipeline import UtteranceQueue, WorkerPool
+from text_to_speech_test import ResponseSpeaker
+
+
+# 語音控制指令：不經過分類器，直接停止朗讀或調整語速
+CONTROL_RATES = (("慢一點", "80%"), ("快一點", "130%"), ("恢復正常", "100%"), ("正常", "100%"))
+
+
+class SessionLimitError(RuntimeError):
+    """同時存在的 session 數已達上限"""
+
+
+def parse_control(text):
+    """回傳 ("stop", None)、("rate", 語速) 或 None（不是控制指令）"""
+    if "停" in text:
+        return "stop", None
+    for keyword, rate in CONTROL_RATES:
+        if keyword in text:
+            return "rate", rate
+    return None
+
+
+class ClipStore:
+    """保留最近 max_clips 段合成好的語音，供遠端裝置依 id 下載"""
+
+    def __init__(self, max_clips=32):
+        self.max_clips = max_clips
+        self._clips = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_id = 1
+
+    def add(self, audio):
+        with self._lock:
+            clip_id = self._next_id
+            self._next_id += 1
+            self._clips[clip_id] = audio
+            while len(self._clips) > self.max_clips:
+                self._clips.popitem(last=False)
+            return clip_id
+
+    def get(self, clip_id):
+        with self._lock:
+            return self._clips.get(clip_id)
+
+
+def utterance_from_upload(data, sample_rate=16000, content_type=None, max_seconds=30.0):
+    """把上傳的音訊（WAV 或 16-bit mono PCM）轉成 Utterance
+
+    WAV 會依檔頭取樣率與聲道數解析（多聲道取平均）；其他內容視為 sample_rate 的原始 PCM。
+    """
+    if data[:4] == b"RIFF" or content_type in ("audio/wav", "audio/x-wav", "audio/wave"):
+        try:
+            with wave.open(io.BytesIO(data), "rb") as wav:
+                if wav.getsampwidth() != 2:
+                    raise ValueError("只支援 16-bit WAV")
+                sample_rate = wav.getframerate()
+                channels = wav.getnchannels()
+                pcm = wav.readframes(wav.getnframes())
+        except wave.Error as e:
+            raise ValueError(f"無法解析 WAV：{e}")
+        samples = np.frombuffer(pcm, dtype=np.int16)
+        if channels > 1:
+            samples = samples[:len(samples) // channels * channels].reshape(-1, channels).mean(axis=1).astype(np.int16)
+    else:
+        if len(data) % 2:
+            raise ValueError("PCM 資料長度必須是偶數位元組（16-bit）")
+        samples = np.frombuffer(data, dtype=np.int16)
+
+    if len(samples) == 0:
+        raise ValueError("音訊內容為空")
+    if len(samples) > int(sample_rate * max_seconds):
+        raise ValueError(f"音訊超過 {max_seconds:.0f} 秒上限")
+    utterance = Utterance(sample_rate, max_seconds=(len(samples) + 1) / sample_rate)
+    utterance.append(samples)
+    utterance.finish()
+    return utterance
+
+
+class Session:
+    """單一裝置的對話管線狀態：自己的佇列、狀態、事件與語速，STT / LLM / TTS 客戶端則共用
+
+    local=True 的 session 用本機喇叭播放；其他 session 把合成好的語音段落存成 clip，
+    以 reply_audio 事件通知裝置下載播放。
+    同一個 session 的各輪一律依序處理（num_workers > 1 時也不會同時回應兩句話）。
+    """
+
+    def __init__(self, session_id, manager, local=False, num_workers=1, queue_size=4,
+                 queue_policy="merge", max_clips=32):
+        self.session_id = session_id
+        self.manager = manager
+        self.local = local
+        self.state = "idle"
+        self.created_at = time.time()
+        self.last_active = self.created_at
+        self.events = EventBus()
+        self.memory = ConversationMemory(summarize_fn=manager.classifier.summarize_conversation)
+        self.turns = 0
+        self.keyword_commands = 0
+        self.barge_ins = 0
+
+        self.clips = ClipStore(max_clips)
+        # 行動計劃交給執行器（預設為模擬機器人），步驟開始 / 完成 / 失敗以 action_* 事件推送
+        self.robot = MovementRunner(manager.executor_factory(), on_event=self.events.publish)
+
+        if local:
+            self.speaker = ResponseSpeaker(client=manager.polly_client, cache=manager.tts_cache)
+        else:
+            self.speaker = ResponseSpeaker(client=manager.polly_client, cache=manager.tts_cache,
+                                           audio_sink=self._store_clip)
+
+        self._turn_lock = threading.Lock()
+        self.queue = UtteranceQueue(maxsize=queue_size, policy=queue_policy, merge_fn=Utterance.concat)
+        self.workers = WorkerPool(self.queue, self.handle_utterance, num_workers=num_workers,
+                                  name=f"session-{session_id}")
+        self.workers.start()
+
+    # ---- 狀態與事件 ----
+
+    def touch(self):
+        self.last_active = time.time()
+
+    def set_state(self, state):
+        """切換 idle / thinking / talking，狀態有變才推送事件"""
+        if self.state != state:
+            self.state = state
+            self.events.publish("state", {"state": state})
+
+    def _store_clip(self, audio, text):
+        clip_id = self.clips.add(audio)
+        self.events.publish("reply_audio", {
+            "clip": clip_id,
+            "text": text,
+            "format": self.speaker.output_format,
+            "url": f"/sessions/{self.session_id}/clips/{clip_id}",
+        })
+
+    # ---- 管線 ----
+
+    def submit(self, utterance):
+        """放入一段語句（來自本機錄音或裝置上傳），回傳是否被接受"""
+        self.touch()
+        return self.queue.put(utterance)
+
+    def start_streaming(self, utterance):
+        """語句開始時建立串流辨識，即時辨識結果以 transcript 事件推送"""
+        if self.manager.streaming_transcriber:
+            utterance.stream_session = self.manager.streaming_transcriber.start(
+                utterance, on_partial=lambda text: self.events.publish("transcript", {"text": text, "final": False}),
+                session_id=self.session_id)
+
+    def handle_utterance(self, utterance):
+        # ✅ 每輪一個 trace：起點為使用者停止說話，各階段耗時與 first_audio 匯出到 /metrics
+        tracer = self.manager.tracer
+        ended_at = utterance.ended_at or time.time()
+        with self._turn_lock:
+            trace = tracer.start(self.session_id, started_at=utterance.speech_ended_at or ended_at)
+            trace.add_span("vad_endpoint", trace.started_at, ended_at)
+            trace.add_span("queue_wait", ended_at, time.time())
+            # 整輪（STT → 分類 → 回應）的 AWS 呼叫期限不超過 turn_budget 秒
+            with tracer.activate(trace), turn_budget(self.manager.turn_budget):
+                self._handle_utterance(utterance, trace)
+
+    def in_turn(self):
+        """是否正在處理一輪對話（STT → 分類 → 回應）"""
+        return self._turn_lock.locked()
+
+    def busy(self):
+        """有排隊中的語句、worker 正在處理、正在進行一輪對話或正在播放；state 在 STT 期間仍是 idle，不能只看它"""
+        return (bool(len(self.queue)) or self.workers.stats()["busy"] > 0 or self.in_turn()
+                or self.speaker.check_audio())
+
+    def _handle_utterance(self, utterance, trace):
+        with span("stt"):
+            if utterance.stream_session:
+                transcript_text = utterance.stream_session.finish()
+            else:
+                transcript_text = self.manager.transcriber.transcribe_utterance(utterance, self.session_id)
+        if not transcript_text:
+            trace.set(command_type="empty")
+            return
+        trace.mark("transcript")
+        self.events.publish("transcript", {"text": transcript_text, "final": True, "turn_id": trace.turn_id})
+
+        if self.process_command(transcript_text):
+            trace.set(command_type="control")
+            return
+        if self.speaker.check_audio():
+            trace.set(command_type="ignored")
+            return
+
+        # 本機播放的第一段音訊由播放執行緒非同步通知，這一輪的紀錄等到 first_audio 才寫出
+        trace.hold_until("first_audio")
+        with self.manager.turn_slots:
+            try:
+                self.respond(transcript_text)
+            finally:
+                if not self.speaker.check_audio():
+                    # 沒有產生任何音訊（合成全部失敗、回應為空）時不會進入 talking，直接回到 idle
+                    trace.release("first_audio")
+                    if self.state == "thinking":
+                        self.set_state("idle")
+        self.turns += 1
+        self.touch()
+
+    def respond(self, transcript_text):
+        classifier = self.manager.classifier
+        speaker = self.speaker
+        trace = current_trace()
+        self.set_state("thinking")
+        command_type, response = classifier.respond(transcript_text, stream=True, memory=self.memory)
+        if trace:
+            trace.set(command_type=command_type)
+
+        def mark_talking():
+            # 本機播放時由播放執行緒呼叫，沒有 contextvars，直接記到這一輪的 trace
+            if trace:
+                trace.mark("first_audio")
+            self.set_state("talking")
+
+        def publish_segment(segment):
+            self.events.publish("reply_delta", {"text": segment})
+
+        if command_type == "行動" and response is not None:
+            # ✅ 計劃每產生一步就交給執行器並播報，不等整份計劃
+            steps = response if isinstance(response, PlanStream) else PlanStream.from_plan(response, classifier.actions)
+            response_text = speaker.speak_stream(self.robot.follow(steps), on_first_audio=mark_talking,
+                                                 on_segment=publish_segment).strip()
+            response = steps.plan()
+            if not response_text:
+                response_text = "無法生成有效的動作計劃"
+                speaker.speak(response_text, on_first_audio=mark_talking, on_segment=publish_segment)
+        elif isinstance(response, str):
+            response_text = response
+            speaker.speak(response_text, on_first_audio=mark_talking, on_segment=publish_segment)
+        elif response is not None and not isinstance(response, dict):
+            # ✅ 串流回應：第一句生成並合成完就開始播放
+            response_text = speaker.speak_stream(response, on_first_audio=mark_talking,
+                                                 on_segment=publish_segment).strip()
+            response = response_text
+        else:
+            response_text = "⚠️ 無法識別命令"
+            speaker.speak(response_text, on_first_audio=mark_talking, on_segment=publish_segment)
+        self.events.publish("reply", {"text": response_text, "command_type": command_type,
+                                      "turn_id": trace.turn_id if trace else None})
+        if command_type in ('聊天', '查詢') and response is not None:
+            # 行動的播報不是對話內容，不放進記憶；摘要在背景進行，不佔用這個 worker
+            self.memory.add_turn(transcript_text, response_text)
+
+        if command_type == '聊天':
+            classifier.save_chat_history(transcript_text, response, command_type, self.session_id)
+        elif command_type == '查詢':
+            classifier.save_query_history(transcript_text, response, command_type, self.session_id)
+        elif command_type == '行動':
+            classifier.save_movement_history(transcript_text, response, command_type, self.session_id)
+
+    def handle_keyword(self, keyword):
+        """裝置端關鍵詞偵測到的控制指令（不經過 STT），在錄音執行緒上直接執行"""
+        self.touch()
+        if not self.process_command(keyword):
+            return False
+        self.keyword_commands += 1
+        self.events.publish("transcript", {"text": keyword, "final": True, "source": "keyword"})
+        return True
+
+    def barge_in(self):
+        """播放中偵測到使用者插話（回音消除後仍有語音）：立即停止朗讀，讓接下來的語句照常處理"""
+        if not self.speaker.check_audio():
+            return
+        self.barge_ins += 1
+        self.speaker.stop_audio()
+        self.events.publish("barge_in", {})
+        self.set_state("idle")
+
+    def process_command(self, text):
+        """根據語音指令調整朗讀速度或中斷朗讀"""
+        control = parse_control(text)
+        if control is None:
+            return False
+        action, rate = control
+        if action == "stop":
+            self.speaker.stop_audio()
+            self.robot.stop()
+            self.events.publish("stop", {})
+            self.set_state("idle")
+        else:
+            self.speaker.set_rate(rate)
+        return True
+
+    def close(self):
+        self.workers.stop()
+        self.speaker.stop_audio()
+        self.robot.close()
+        self.queue.clear()
+        self.events.publish("closed", {})
+
+    def stats(self):
+        return {
+            "session_id": self.session_id,
+            "local": self.local,
+            "state": self.state,
+            "turns": self.turns,
+            "keyword_commands": self.keyword_commands,
+            "barge_ins": self.barge_ins,
+            "rate": self.speaker.current_rate,
+            "idle_seconds": round(time.time() - self.last_active, 1),
+            "queue": self.queue.stats(),
+            "workers": self.workers.stats(),
+            "memory": self.memory.stats(),
+            "robot": self.robot.stats(),
+        }
+
+
+class SessionManager:
+    """依 session id 建立互相隔離的管線狀態，所有 session 共用 STT / 分類器 / Polly 客戶端與語音快取
+
+    - max_sessions：同時存在的 session 上限，滿了會先回收已逾時的閒置 session，仍然滿時拒絕建立
+    - idle_timeout：超過此秒數沒有活動（且不在本機）的 session 會被回收
+    - max_concurrent_turns：同時進行 LLM / TTS 回應的輪數上限，避免超過共用連線池
+    """
+
+    def __init__(self, transcriber, classifier, polly_client, tts_cache, streaming_transcriber=None,
+                 max_sessions=64, idle_timeout=600.0, max_concurrent_turns=16, session_workers=1,
+                 queue_size=4, queue_policy="merge", executor_factory=SimulatedRobot, turn_budget=None,
+                 tracer=None):
+        self.transcriber = transcriber
+        self.classifier = classifier
+        self.polly_client = polly_client
+        self.tts_cache = tts_cache
+        self.streaming_transcriber = streaming_transcriber
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.session_workers = session_workers
+        self.queue_size = queue_size
+        self.queue_policy = queue_policy
+        self.executor_factory = executor_factory
+        self.turn_budget = turn_budget
+        self.tracer = tracer or default_tracer()
+        self.turn_slots = threading.BoundedSemaphore(max_concurrent_turns)
+
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.expired = 0
+
+        self._watcher = threading.Thread(target=self._watch, daemon=True)
+        self._watcher.start()
+
+    def create(self, session_id=None, local=False, num_workers=None):
+        """建立新 session；id 已存在時直接回傳該 session"""
+        session_id = session_id or uuid.uuid4().hex
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session:
+                session.touch()
+                return session
+            if len(self._sessions) >= self.max_sessions:
+                self._expire_idle()
+            if len(self._sessions) >= self.max_sessions:
+                raise SessionLimitError(f"session 數已達上限 {self.max_sessions}")
+            session = Session(session_id, self, local=local,
+                              num_workers=num_workers or self.session_workers,
+                              queue_size=self.queue_size, queue_policy=self.queue_policy)
+            self._sessions[session_id] = session
+            self.created += 1
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session:
+            session.touch()
+        return session
+
+    def close(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session:
+            session.close()
+        return session is not None
+
+    def _expire_idle(self):
+        """回收超過 idle_timeout 沒有活動的非本機 session（呼叫端需持有 _lock）；處理中的 session 不回收"""
+        now = time.time()
+        expired = [s for s in self._sessions.values()
+                   if not s.local and s.state == "idle" and now - s.last_active > self.idle_timeout
+                   and not s.busy()]
+        for session in expired:
+            del self._sessions[session.session_id]
+            session.close()
+            self.expired += 1
+
+    def _watch(self):
+        """播放結束時把 talking 切回 idle，並定期回收閒置 session
+
+        本機播放的第一段音訊由播放執行緒非同步通知；回應結束後播放沒有真的開始時，
+        session 會停在 thinking，這裡在該輪結束且沒有播放時一併切回 idle。
+        """
+        last_sweep = time.time()
+        while True:
+            with self._lock:
+                sessions = list(self._sessions.values())
+            for session in sessions:
+                if session.speaker.check_audio():
+                    continue
+                if session.state == "talking" or (session.state == "thinking" and not session.in_turn()):
+                    session.set_state("idle")
+            if time.time() - last_sweep > 5.0:
+                with self._lock:
+                    self._expire_idle()
+                last_sweep = time.time()
+            time.sleep(0.1)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def stats(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return {
+            "active": len(sessions),
+            "max_sessions": self.max_sessions,
+            "created": self.created,
+            "expired": self.expired,
+            "sessions": [session.stats() for session in sessions],
+        }
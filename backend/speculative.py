@@ -0,0 +1,169 @@
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SpeculationStats:
+    """推測執行的成效：用到的分支省下多少等待時間，丟棄的分支浪費多少工作"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.turns = 0
+        self.total_decide = 0.0
+        self.branches = {}
+
+    def _branch(self, name):
+        return self.branches.setdefault(name, {
+            "launched": 0, "used": 0, "wasted": 0, "cancelled": 0,
+            "saved_seconds": 0.0, "wasted_seconds": 0.0,
+        })
+
+    def record_turn(self, decide_seconds, names):
+        with self._lock:
+            self.turns += 1
+            self.total_decide += decide_seconds
+            for name in names:
+                self._branch(name)["launched"] += 1
+
+    def record_used(self, name, saved_seconds):
+        with self._lock:
+            branch = self._branch(name)
+            branch["used"] += 1
+            branch["saved_seconds"] += saved_seconds
+
+    def record_wasted(self, name, seconds):
+        with self._lock:
+            branch = self._branch(name)
+            branch["wasted"] += 1
+            branch["wasted_seconds"] += seconds
+
+    def record_cancelled(self, name):
+        with self._lock:
+            self._branch(name)["cancelled"] += 1
+
+    def stats(self):
+        with self._lock:
+            branches = {}
+            for name, branch in self.branches.items():
+                branches[name] = {
+                    "launched": branch["launched"],
+                    "used": branch["used"],
+                    "wasted": branch["wasted"],
+                    "cancelled": branch["cancelled"],
+                    "hit_rate": round(branch["used"] / branch["launched"], 3) if branch["launched"] else 0.0,
+                    "saved_ms": round(branch["saved_seconds"] * 1000, 1),
+                    "wasted_ms": round(branch["wasted_seconds"] * 1000, 1),
+                }
+            return {
+                "turns": self.turns,
+                "avg_decide_ms": round(self.total_decide / self.turns * 1000, 1) if self.turns else 0.0,
+                "branches": branches,
+            }
+
+
+def _overlap(timing, decided_at):
+    """分支在決策完成前已經跑了多久（即省下的等待時間）"""
+    start = timing.get("start")
+    if start is None or start >= decided_at:
+        return 0.0
+    return min(timing.get("end", decided_at), decided_at) - start
+
+
+class SpeculativeExecutor:
+    """在決策（例如 LLM 分類）進行的同時先啟動可能用到的分支（例如網路搜尋）
+
+    run(decide, branches)：branches 為 {分支名稱: callable}，先丟進執行緒池，
+    decide() 在呼叫端執行並回傳分支名稱；命中的分支等待其結果，其餘分支尚未開始的取消、
+    已開始的結果直接丟棄。回傳 (決策, 分支結果, 是否命中)。
+    """
+
+    def __init__(self, max_workers=4, stats=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="speculative")
+        self.stats = stats or SpeculationStats()
+
+    def _submit(self, fn):
+        timing = {}
+
+        def task():
+            timing["start"] = time.time()
+            try:
+                return fn()
+            finally:
+                timing["end"] = time.time()
+
+        # 帶著呼叫端的 contextvars（例如追蹤中的這一輪），分支內的 span 才記得到
+        return self.executor.submit(contextvars.copy_context().run, task), timing
+
+    def _discard(self, name, future, timing):
+        if future.cancel():
+            self.stats.record_cancelled(name)
+            return
+        future.add_done_callback(
+            lambda _: self.stats.record_wasted(name, timing.get("end", time.time()) - timing.get("start", time.time())))
+
+    def run(self, decide, branches):
+        started = time.time()
+        pending = {name: self._submit(fn) for name, fn in branches.items()}
+        choice = decide()
+        decided_at = time.time()
+        self.stats.record_turn(decided_at - started, pending)
+
+        winner = pending.pop(choice, None)
+        for name, (future, timing) in pending.items():
+            self._discard(name, future, timing)
+        if winner is None:
+            return choice, None, False
+
+        future, timing = winner
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"⚠️ 推測分支 {choice} 失敗，改為正常執行：{e}")
+            self.stats.record_wasted(choice, timing.get("end", decided_at) - timing.get("start", decided_at))
+            return choice, None, False
+        self.stats.record_used(choice, _overlap(timing, decided_at))
+        return choice, result, True
+
+    async def run_async(self, decide, branches):
+        """run 的 asyncio 版本：decide 與 branches 的值皆為回傳 coroutine 的函式，落敗分支直接 cancel"""
+        async def timed(fn, timing):
+            timing["start"] = time.time()
+            try:
+                return await fn()
+            finally:
+                timing["end"] = time.time()
+
+        started = time.time()
+        pending = {}
+        for name, fn in branches.items():
+            timing = {}
+            pending[name] = (asyncio.create_task(timed(fn, timing)), timing)
+        try:
+            choice = await decide()
+        except BaseException:
+            for task, _ in pending.values():
+                task.cancel()
+            raise
+        decided_at = time.time()
+        self.stats.record_turn(decided_at - started, pending)
+
+        winner = pending.pop(choice, None)
+        for name, (task, timing) in pending.items():
+            if task.done():
+                self.stats.record_wasted(name, timing.get("end", decided_at) - timing.get("start", decided_at))
+            else:
+                task.cancel()
+                self.stats.record_cancelled(name)
+        if winner is None:
+            return choice, None, False
+
+        task, timing = winner
+        try:
+            result = await task
+        except Exception as e:
+            print(f"⚠️ 推測分支 {choice} 失敗，改為正常執行：{e}")
+            return choice, None, False
+        self.stats.record_used(choice, _overlap(timing, decided_at))
+        return choice, result, True
@@ -1,10 +1,11 @@
 import os
 import json
 import sys
-import boto3
+from aws_clients import create_client
 from dotenv import load_dotenv
-from datetime import datetime
 from opencc import OpenCC
+from audio_buffer import wav_bytes_from_array
+from history_store import default_store
 
 converter = OpenCC('s2tw')  # ✅ 注意這裡直接寫 's2t'，不用加 '.json'
 
@@ -13,73 +14,86 @@ env_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'config', '.e
 load_dotenv(env_path)
 
 class SpeechToText:
-    def __init__(self):
+    def __init__(self, runtime=None, save_transcripts=True, history=None):
         # Whisper 模型配置
         self.endpoint_name = os.getenv('SAGEMAKER_ENDPOINT_NAME', 'jumpstart-dft-hf-asr-whisper-large-20250426-025518')
         self.region = os.getenv('AWS_REGION', 'us-west-2')
 
-        # ✅ 創建 SageMaker 客戶端（加上明確金鑰）
-        self.runtime = boto3.client(
-            "sagemaker-runtime", 
-            region_name=self.region,
-            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
-        )
-
-        # ✅ 設定儲存路徑為 backend/data/transcripts
-        self.transcript_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'transcripts'))
-        os.makedirs(self.transcript_dir, exist_ok=True)
+        # ✅ 共用的 SageMaker 客戶端（逾時、重試、斷路器）；可注入本地替身（local_stubs.LocalWhisperRuntime）
+        self.runtime = runtime or create_client("sagemaker-runtime", self.region)
 
-    def save_transcript(self, transcript_text, audio_file_path, confidence=0.9):
-        """保存转写结果"""
-        audio_filename = os.path.basename(audio_file_path)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        transcript_filename = os.path.join(self.transcript_dir, f"transcript_{timestamp}.json")
+        # ✅ 轉寫結果寫入 HistoryStore（SQLite），第一次寫入時才開啟
+        self.save_transcripts = save_transcripts
+        self._history = history
 
-        data = {
-            'audio_file': audio_filename,
-            'timestamp': timestamp,
-            'transcript': transcript_text,
-            'confidence': confidence
-        }
+    @property
+    def history(self):
+        if self._history is None:
+            self._history = default_store()
+        return self._history
 
-        with open(transcript_filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-
-        # print(f"轉寫文本已保存至: {transcript_filename}")
-        return transcript_filename
+    def save_transcript(self, transcript_text, audio_file_path, confidence=0.9, session_id=None):
+        """保存转写结果（背景批次寫入 HistoryStore）"""
+        self.history.record('transcript', transcript_text, session_id=session_id,
+                            extra={'audio_file': os.path.basename(audio_file_path), 'confidence': confidence})
 
     def transcribe_file(self, audio_file_path):
         """將音頻文件轉換為文字"""
-        print("開始轉換語音為文字...")
-
         try:
             with open(audio_file_path, "rb") as audio_file:
                 audio_bytes = audio_file.read()
+        except OSError as e:
+            print(f"轉換過程中出現錯誤: {str(e)}")
+            return None
+        return self.transcribe_bytes(audio_bytes, audio_file_path)
+
+    def transcribe_array(self, samples, sample_rate=16000, source_name="memory.wav"):
+        """將 int16 音訊陣列轉換為文字（在記憶體中包成 WAV）"""
+        return self.transcribe_bytes(wav_bytes_from_array(samples, sample_rate), source_name)
+
+    def transcribe_utterance(self, utterance, session_id=None):
+        """轉換錄音端交來的 Utterance，直接使用其記憶體中的 WAV"""
+        return self.transcribe_bytes(utterance.wav_bytes(), utterance.name, session_id)
+
+    def invoke_endpoint(self, audio_bytes):
+        """呼叫 Whisper endpoint，回傳 (原始文字, 信心值)；錯誤直接拋出"""
+        # botocore 只接受 bytes/bytearray/檔案物件，memoryview 在此轉一次
+        if isinstance(audio_bytes, memoryview):
+            audio_bytes = audio_bytes.tobytes()
+
+        response = self.runtime.invoke_endpoint(
+            EndpointName=self.endpoint_name,
+            ContentType="audio/wav",
+            Body=audio_bytes
+        )
 
-            response = self.runtime.invoke_endpoint(
-                EndpointName=self.endpoint_name,
-                ContentType="audio/wav",
-                Body=audio_bytes
-            )
-
-            response_body = response["Body"].read().decode("utf-8")
-            result = json.loads(response_body)
+        return self.parse_endpoint_response(response["Body"].read())
 
-            transcript_text = ""
-            confidence = 0.9
+    @staticmethod
+    def parse_endpoint_response(body):
+        """解析 Whisper endpoint 回應，回傳 (原始文字, 信心值)"""
+        result = json.loads(body.decode("utf-8"))
 
-            if "text" in result and isinstance(result["text"], list) and len(result["text"]) > 0:
-                transcript_text = result["text"][0]
-                confidence = result.get("confidence", 0.9)
-                print(f"識別結果: {transcript_text}")
+        if "text" in result and isinstance(result["text"], list) and len(result["text"]) > 0:
+            return result["text"][0], result.get("confidence", 0.9)
+        return "", 0.9
 
-            #print("語音轉換完成!")
+    def finalize_transcript(self, transcript_text, source_name, confidence=0.9, session_id=None):
+        """保存並轉為繁體"""
+        if transcript_text:
+            print(f"識別結果: {transcript_text}")
+        if transcript_text and self.save_transcripts:
+            self.save_transcript(transcript_text, source_name, confidence, session_id)
+        return converter.convert(transcript_text)
 
-            if transcript_text:
-                self.save_transcript(transcript_text, audio_file_path, confidence)
+    def transcribe_bytes(self, audio_bytes, source_name="memory.wav", session_id=None):
+        """將記憶體中的 WAV bytes 轉換為文字"""
+        print("開始轉換語音為文字...")
 
-            return converter.convert(transcript_text)
+        try:
+            transcript_text, confidence = self.invoke_endpoint(audio_bytes)
+            #print("語音轉換完成!")
+            return self.finalize_transcript(transcript_text, source_name, confidence, session_id)
 
         except Exception as e:
             print(f"轉換過程中出現錯誤: {str(e)}")
@@ -0,0 +1,117 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from difflib import SequenceMatcher
+from audio_buffer import wav_bytes_from_array
+
+
+def stitch(previous, current, max_overlap=12, min_match=2):
+    """拼接兩段重疊切片的辨識結果
+
+    在 previous 的結尾與 current 的開頭（各最多 max_overlap 字）找最長共同片段，
+    以該片段為接點；找不到足夠長的共同片段時直接串接。
+    """
+    if not previous:
+        return current
+    if not current:
+        return previous
+
+    tail = previous[-max_overlap:]
+    head = current[:max_overlap]
+    match = SequenceMatcher(None, tail, head, autojunk=False).find_longest_match(0, len(tail), 0, len(head))
+    if match.size < min(min_match, len(head)):
+        return previous + current
+    cut = len(previous) - len(tail) + match.a
+    return previous[:cut] + current[match.b:]
+
+
+class StreamingSession:
+    """單一語句的串流辨識：使用者還在說話時就把重疊切片送去 endpoint"""
+
+    def __init__(self, owner, utterance, on_partial=None, session_id=None):
+        self.owner = owner
+        self.utterance = utterance
+        self.on_partial = on_partial
+        self.session_id = session_id
+        self.chunk = int(owner.chunk_seconds * utterance.sample_rate)
+        self.step = self.chunk - int(owner.overlap_seconds * utterance.sample_rate)
+        self._next_start = 0
+        self._last_end = 0
+        self._futures = []
+        self._results = []
+        self._emitted = 0
+        self._partial = ""
+        self._lock = threading.Lock()
+
+    def feed(self):
+        """錄音端每收到一幀呼叫一次；累積到一個切片長度就送出"""
+        while self.utterance.length - self._next_start >= self.chunk:
+            self._submit(self._next_start, self._next_start + self.chunk)
+            self._next_start += self.step
+
+    def _submit(self, start, end):
+        # 已寫入的樣本不會再變動，可以安全地取 view
+        wav = wav_bytes_from_array(self.utterance.samples[start:end], self.utterance.sample_rate)
+        index = len(self._futures)
+        self._results.append(None)
+        future = self.owner.executor.submit(self.owner.transcriber.invoke_endpoint, wav)
+        future.add_done_callback(lambda f, i=index: self._on_done(i, f))
+        self._futures.append(future)
+        self._last_end = end
+
+    def _on_done(self, index, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        with self._lock:
+            self._results[index] = future.result()
+            # 依序拼接已完成的連續前綴，避免亂序結果造成跳字
+            advanced = False
+            while self._emitted < len(self._results) and self._results[self._emitted] is not None:
+                self._partial = stitch(self._partial, self._results[self._emitted][0])
+                self._emitted += 1
+                advanced = True
+            partial = self._partial
+        if advanced and self.on_partial:
+            self.on_partial(partial)
+
+    def finish(self, timeout=None):
+        """語句結束：送出尾段、等待所有切片並回傳最終（繁體）逐字稿"""
+        if not self._futures or self.utterance.length > self._last_end:
+            start = self._next_start if self._futures else 0
+            self._submit(start, self.utterance.length)
+
+        done, pending = wait(self._futures, timeout=timeout)
+        if pending or any(f.exception() is not None for f in done):
+            print("⚠️ 串流辨識切片失敗，改用整段辨識")
+            self.cancel()
+            return self.owner.transcriber.transcribe_utterance(self.utterance, self.session_id)
+
+        text = ""
+        confidence = 1.0
+        for future in self._futures:
+            part, part_confidence = future.result()
+            text = stitch(text, part)
+            confidence = min(confidence, part_confidence)
+        return self.owner.transcriber.finalize_transcript(text, self.utterance.name, confidence, self.session_id)
+
+    def cancel(self):
+        for future in self._futures:
+            future.cancel()
+
+
+class StreamingTranscriber:
+    """在 SpeechToText 之上提供串流模式
+
+    chunk_seconds 長的切片每 (chunk_seconds - overlap_seconds) 送出一次，
+    語句結束後只需等待最後一個尾段，因此最終結果的延遲不再隨語句長度線性增加。
+    """
+
+    def __init__(self, transcriber, chunk_seconds=2.0, overlap_seconds=0.5, max_workers=4):
+        if overlap_seconds >= chunk_seconds:
+            raise ValueError("overlap_seconds 必須小於 chunk_seconds")
+        self.transcriber = transcriber
+        self.chunk_seconds = chunk_seconds
+        self.overlap_seconds = overlap_seconds
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stt-stream")
+
+    def start(self, utterance, on_partial=None, session_id=None):
+        return StreamingSession(self, utterance, on_partial, session_id)
@@ -0,0 +1,69 @@
+SENTENCE_ENDINGS = set("。！？!?；;\n")
+CLAUSE_BREAKS = set("，,、：:")
+CLOSING_MARKS = set("」』）)】\"'”’")
+
+
+class SentenceSegmenter:
+    """把串流進來的文字切成適合逐段合成語音的句子/子句
+
+    - 遇到 。！？ 等句末標點一定切段
+    - 遇到 ，、 等子句標點時，累積長度達 min_clause_chars 才切（第一段用 first_clause_chars，讓開口更快）
+    - 超過 max_chars 仍沒有標點時強制切段
+    """
+
+    def __init__(self, min_clause_chars=12, first_clause_chars=6, max_chars=80):
+        self.min_clause_chars = min_clause_chars
+        self.first_clause_chars = first_clause_chars
+        self.max_chars = max_chars
+        self._buffer = ""
+        self._emitted = 0
+
+    def _pop(self, end):
+        segment = self._buffer[:end].strip()
+        self._buffer = self._buffer[end:]
+        # 只剩標點（例如串流時晚一步到的右引號）不值得送去合成
+        if not any(ch.isalnum() for ch in segment):
+            return ""
+        if segment:
+            self._emitted += 1
+        return segment
+
+    def feed(self, text):
+        """加入一段增量文字，回傳已完整的段落列表"""
+        self._buffer += text
+        segments = []
+        i = 0
+        while i < len(self._buffer):
+            ch = self._buffer[i]
+            end = None
+            if ch in SENTENCE_ENDINGS:
+                end = i + 1
+            elif ch in CLAUSE_BREAKS:
+                threshold = self.first_clause_chars if self._emitted == 0 else self.min_clause_chars
+                if i + 1 >= threshold:
+                    end = i + 1
+            elif i + 1 >= self.max_chars:
+                end = i + 1
+
+            if end is not None:
+                # 句末標點後的引號、括號屬於同一段
+                while end < len(self._buffer) and self._buffer[end] in CLOSING_MARKS:
+                    end += 1
+                segment = self._pop(end)
+                if segment:
+                    segments.append(segment)
+                i = 0
+                continue
+            i += 1
+        return segments
+
+    def flush(self):
+        """取出剩下未結束的文字"""
+        segment = self._pop(len(self._buffer))
+        return [segment] if segment else []
+
+
+def segment_text(text, **kwargs):
+    """一次切分完整文字"""
+    segmenter = SentenceSegmenter(**kwargs)
+    return segmenter.feed(text) + segmenter.flush()
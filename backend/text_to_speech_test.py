@@ -1,13 +1,21 @@
 import os
 import io
 import json
+import queue
+import threading
+import time
 import requests
 from datetime import datetime
 import pygame
 from dotenv import load_dotenv
+import sys
 import base64
-import boto3
-
+from aws_clients import create_client
+from text_segmenter import SentenceSegmenter, segment_text
+from tts_cache import TTSCache
+from movement_program import compile_plan
+from tracing import span
+from playback_engine import PCMPlayer
 
 
 # ✅ 加載環境變量（正確路徑）
@@ -15,71 +23,276 @@ env_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'config', '.e
 load_dotenv(env_path)
 
 class ResponseSpeaker:
-    def __init__(self):
-        # 設置 AWS Polly 客戶端
-        self.client = boto3.client(
-            "polly",
-            region_name="us-east-1",
-            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
-        )
+    def __init__(self, client=None, cache=None, audio_sink=None):
+        # 設置 AWS Polly 客戶端（可注入本地替身或多個 session 共用的客戶端）
+        self.client = client or create_client("polly", "us-east-1")
 
         self.voice_id = "Zhiyu"  # 中文女聲
         self.language_code = "cmn-CN"
         self.output_format = "mp3"
+        self.sample_rate = "16000"  # PCM 輸出的取樣率
         self.current_rate = "100%"
 
-        pygame.mixer.init()
+        # ✅ audio_sink(audio, text)：遠端裝置的 session 不在本機播放，合成好的段落交給 sink 送回裝置
+        self.audio_sink = audio_sink
+
+        # ✅ 逐段播放佇列：每段合成完就排入，播放執行緒依序播放
+        self._playback_queue = queue.Queue()
+        self._playback_lock = threading.Lock()
+        self._generation = 0  # stop_audio 時遞增，丟棄已排入的舊段落
+        self._synthesizing = 0
+        self._playing = False
+        # ✅ 回音消除的參考訊號（echo_canceller.PlaybackReference）：播放的每段 PCM 連同開始時間記下來
+        self._reference = None
+        # ✅ 本機播放優先用 PCM 播放引擎：Polly 直接輸出 PCM、段落無縫銜接、語速在本機即時伸縮
+        self.player = self._create_player() if audio_sink is None else None
+        if self.player:
+            self.output_format = "pcm"
+        elif audio_sink is None:
+            pygame.mixer.init()
+            self._player = threading.Thread(target=self._playback_loop, daemon=True)
+            self._player.start()
 
         # ✅ 設定 audio_output 資料夾為絕對路徑
         self.audio_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'audio_output'))
         os.makedirs(self.audio_dir, exist_ok=True)
 
+        # ✅ 語音快取：相同文字/聲音/語速/格式不再重複呼叫 Polly（可與其他 session 共用）
+        self.cache = cache or TTSCache(
+            cache_dir=os.getenv('TTS_CACHE_DIR') or None,
+            max_disk_bytes=int(float(os.getenv('TTS_CACHE_MAX_MB', '200')) * 1024 * 1024)
+        )
+
+    def _create_player(self):
+        if os.getenv('PCM_PLAYBACK', 'true').lower() != 'true':
+            return None
+        try:
+            return PCMPlayer(sample_rate=int(self.sample_rate))
+        except Exception as e:
+            # 沒有 sounddevice / PortAudio 或沒有輸出裝置時退回 pygame 播放 MP3
+            print(f"⚠️ PCM 播放引擎無法啟動，改用 pygame 播放：{e}")
+            return None
+
+    @property
+    def reference(self):
+        return self._reference
+
+    @reference.setter
+    def reference(self, reference):
+        self._reference = reference
+        if self.player:
+            self.player.reference = reference
+
+    @property
+    def synthesis_rate(self):
+        """寫進 SSML 的語速；PCM 引擎在本機伸縮，一律以 100% 合成，快取的音訊任何語速都能用"""
+        return "100%" if self.player else self.current_rate
+
     def set_rate(self, rate):
-        """設定播放速度"""
+        """設定播放速度（PCM 引擎連正在播放的句子都立即改變）"""
         self.current_rate = rate
+        if self.player:
+            self.player.set_rate(rate)
         print(f"🎚️ 已設定播放速度為：{rate}")
 
     
-    def speak(self, text):
+    @staticmethod
+    def build_ssml(text, rate):
+        return f'<speak><prosody rate="{rate}">{text}</prosody></speak>'
+
+    def _synthesize(self, text):
+        """呼叫 Polly 合成一段文字（先查快取），回傳音訊 bytes；失敗回傳 None"""
+        rate = self.synthesis_rate
+        ssml_text = self.build_ssml(text, rate)
+        key = TTSCache.make_key(ssml_text, self.voice_id, rate, self.output_format)
+        audio = self.cache.get(key)
+        if audio is not None:
+            return audio
+        options = {"SampleRate": self.sample_rate} if self.output_format == "pcm" else {}
+        try:
+            with span("tts_synth"):
+                response = self.client.synthesize_speech(
+                    Text=ssml_text,
+                    OutputFormat=self.output_format,
+                    VoiceId=self.voice_id,
+                    LanguageCode=self.language_code,
+                    TextType="ssml",
+                    **options
+                )
+                audio = response["AudioStream"].read()
+            self.cache.put(key, audio, self.output_format)
+            return audio
+        except Exception as e:
+            print(f"⚠️ Polly 語音合成錯誤：{e}")
+            return None
+
+    def _playback_loop(self):
+        """依序播放佇列中的段落，播完一段才載入下一段"""
+        while True:
+            generation, audio, text, on_start = self._playback_queue.get()
+            with self._playback_lock:
+                if generation != self._generation:
+                    continue
+                self._playing = True
+                pygame.mixer.music.load(io.BytesIO(audio))
+                pygame.mixer.music.play()
+                if self.reference is not None:
+                    self._feed_reference(audio, time.time())
+            print(f"🔊 Polly 開始朗讀（語速 {self.current_rate}）：{text}")
+            if on_start:
+                on_start()
+            while pygame.mixer.music.get_busy() and generation == self._generation:
+                time.sleep(0.02)
+            self._playing = False
+
+    def _play(self, generation, audio, text, on_start):
+        """排入播放：PCM 引擎直接接在目前的輸出後面，否則交給 pygame 播放執行緒"""
+        if self.player is None:
+            self._playback_queue.put((generation, audio, text, on_start))
+            return
+
+        def started():
+            print(f"🔊 Polly 開始朗讀（語速 {self.current_rate}）：{text}")
+            if on_start:
+                on_start()
+
+        with self._playback_lock:
+            if generation == self._generation:
+                self.player.enqueue(audio, started)
+
+    def _feed_reference(self, audio, started_at):
+        """把這段 MP3 解碼成 PCM 交給回音消除當參考訊號"""
+        try:
+            import pygame.sndarray
+            frequency = pygame.mixer.get_init()[0]
+            pcm = pygame.sndarray.array(pygame.mixer.Sound(file=io.BytesIO(audio)))
+            self.reference.play(pcm, frequency, started_at)
+        except Exception as e:
+            print(f"⚠️ 回音消除參考訊號解碼失敗：{e}")
+
+    def speak(self, text, on_first_audio=None, on_segment=None):
         """用 Polly 直接朗讀文字，不存檔"""
         if not text:
             print("⚠️ 沒有文字內容，跳過朗讀")
             return
+        self.speak_stream([text], on_first_audio, on_segment)
+
+    def speak_stream(self, chunks, on_first_audio=None, on_segment=None):
+        """邊接收文字邊逐句合成並排入播放，第一句合成完就開始說話；回傳完整文字
+
+        on_segment(text) 在每段排入播放時呼叫，可用來即時推送字幕。
+        """
+        segmenter = SentenceSegmenter()
+        generation = self._generation
+        parts = []
+        first = [on_first_audio]
+
+        def enqueue(segment):
+            audio = self._synthesize(segment)
+            if audio and generation == self._generation:
+                if self.audio_sink:
+                    if first[0]:
+                        first[0]()
+                    self.audio_sink(audio, segment)
+                else:
+                    self._play(generation, audio, segment, first[0])
+                first[0] = None
+                if on_segment:
+                    on_segment(segment)
+
+        with self._playback_lock:
+            self._synthesizing += 1
         try:
-            ssml_text = f'<speak><prosody rate="{self.current_rate}">{text}</prosody></speak>'
-            response = self.client.synthesize_speech(
-                Text=ssml_text,
-                OutputFormat=self.output_format,
-                VoiceId=self.voice_id,
-                LanguageCode=self.language_code,
-                TextType="ssml"
-            )
-            audio_stream = response["AudioStream"].read()
-            pygame.mixer.music.load(io.BytesIO(audio_stream))
-            pygame.mixer.music.play()
-            print(f"🔊 Polly 開始朗讀（語速 {self.current_rate}）：{text}")
-        except Exception as e:
-            print(f"⚠️ Polly 語音合成錯誤：{e}")
+            for chunk in chunks:
+                parts.append(chunk)
+                if generation != self._generation:
+                    # 已被「停」中斷，不再合成後續段落
+                    break
+                for segment in segmenter.feed(chunk):
+                    enqueue(segment)
+            if generation == self._generation:
+                for segment in segmenter.flush():
+                    enqueue(segment)
+        finally:
+            with self._playback_lock:
+                self._synthesizing -= 1
+        return "".join(parts)
 
     def stop_audio(self):
-        """中止音訊播放"""
-        if pygame.mixer.music.get_busy():
-            pygame.mixer.music.stop()
-            print("音訊播放已中止")
+        """中止音訊播放，並丟棄尚未播放的段落"""
+        with self._playback_lock:
+            self._generation += 1
+            while not self._playback_queue.empty():
+                try:
+                    self._playback_queue.get_nowait()
+                except queue.Empty:
+                    break
+            if self.player:
+                # 引擎只登記實際送到喇叭的樣本，參考訊號不必另外截斷
+                self.player.stop()
+                return
+            if self.audio_sink is None and pygame.mixer.music.get_busy():
+                pygame.mixer.music.stop()
+                print("音訊播放已中止")
+            if self.reference is not None:
+                self.reference.stop()
 
     def check_audio(self):
-        return pygame.mixer.music.get_busy()
+        """是否正在播放、仍有段落待播或正在合成"""
+        if self.audio_sink:
+            return self._synthesizing > 0
+        if self.player:
+            return self.player.busy or self._synthesizing > 0
+        return (self._playing or pygame.mixer.music.get_busy()
+                or not self._playback_queue.empty() or self._synthesizing > 0)
+
+    def prewarm(self, texts, rates=("80%", "100%", "130%")):
+        """預先合成常用語句（依播放時的切段方式），回傳新合成的段落數"""
+        if self.player:
+            rates = (self.synthesis_rate,)
+        original_rate = self.current_rate
+        synthesized = 0
+        try:
+            for rate in rates:
+                self.current_rate = rate
+                for text in texts:
+                    for segment in segment_text(text):
+                        misses = self.cache.misses
+                        self._synthesize(segment)
+                        synthesized += self.cache.misses - misses
+        finally:
+            self.current_rate = original_rate
+        return synthesized
+
+
+def movement_phrases():
+    """movement_deployment.json 中所有任務的播報文字（與 app.py 的「代號，說明」格式一致）及固定提示語"""
+    movement_json_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'assets', 'movement_deployment.json'))
+    with open(movement_json_path, 'r', encoding='utf-8') as f:
+        movement_data = json.load(f)
+
+    phrases = ["⚠️ 無法識別命令", "查無確切結果", "無法獲取模型回應", "無法生成有效的動作計劃"]
+    for task in movement_data['任務拆解']:
+        lines = compile_plan(task, movement_data['動作清單']).speech_lines()
+        phrases.append("\n".join(lines))
+        phrases.extend(task['說明'])
+    return phrases
+
 
 def main():
     speaker = ResponseSpeaker()
 
+    # ✅ python text_to_speech_test.py prewarm：預先合成行動說明與固定提示語
+    if len(sys.argv) > 1 and sys.argv[1] == "prewarm":
+        synthesized = speaker.prewarm(movement_phrases())
+        print(f"✅ 預熱完成，新合成 {synthesized} 段，快取狀態：{speaker.cache.stats()}")
+        return
+
     # ✅ 測試直接語音合成
     test_text = "你好，我是你的語音助理，很高興為你服務！"
-    audio_file = speaker.text_to_speech(test_text)
-    if audio_file:
-        #print(f"語音文件已生成: {audio_file}")
-        speaker.play_audio(audio_file)
+    speaker.speak(test_text)
+    while speaker.check_audio():
+        time.sleep(0.1)
 
 
 if __name__ == "__main__":
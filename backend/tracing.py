@@ -0,0 +1,294 @@
+import os
+import json
+import time
+import uuid
+import threading
+import contextvars
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+
+# 秒；涵蓋 VAD 收尾（~0.3 s）到整輪對話（數秒）
+DEFAULT_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0)
+
+_current = contextvars.ContextVar("current_trace", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+class Histogram:
+    """Prometheus 格式的累積直方圖（依 label 分開計數），另外保留最近 window 筆樣本計算 p50 / p95 / p99"""
+
+    def __init__(self, name, help_text, label_name, buckets=DEFAULT_BUCKETS, window=1000):
+        self.name = name
+        self.help_text = help_text
+        self.label_name = label_name
+        self.buckets = tuple(buckets)
+        self.window = window
+        self._series = {}  # label 值 -> [各 bucket 計數, 總和, 筆數, 最近樣本]
+        self._lock = threading.Lock()
+
+    def observe(self, label, value):
+        with self._lock:
+            series = self._series.get(label)
+            if series is None:
+                series = self._series[label] = [[0] * len(self.buckets), 0.0, 0, deque(maxlen=self.window)]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+            series[3].append(value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {label: (list(counts), total, n) for label, (counts, total, n, _) in self._series.items()}
+        for label, (counts, total, n) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(((self.label_name, label), ("le", bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(((self.label_name, label), ('le', '+Inf')))} {n}")
+            lines.append(f"{self.name}_sum{_format_labels(((self.label_name, label),))} {total:.6f}")
+            lines.append(f"{self.name}_count{_format_labels(((self.label_name, label),))} {n}")
+        return lines
+
+    def summary(self):
+        """{label: {count, p50_ms, p95_ms, p99_ms}}，以最近 window 筆樣本計算"""
+        with self._lock:
+            samples = {label: sorted(series[3]) for label, series in self._series.items()}
+            counts = {label: series[2] for label, series in self._series.items()}
+        summary = {}
+        for label, values in samples.items():
+            if not values:
+                continue
+            pick = lambda p: round(values[min(len(values) - 1, int(len(values) * p / 100))] * 1000, 1)
+            summary[label] = {"count": counts[label], "p50_ms": pick(50), "p95_ms": pick(95), "p99_ms": pick(99)}
+        return summary
+
+
+class Counter:
+    def __init__(self, name, help_text, label_name):
+        self.name = name
+        self.help_text = help_text
+        self.label_name = label_name
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label, amount=1):
+        with self._lock:
+            self._values[label] = self._values.get(label, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        for label, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(((self.label_name, label),))} {value}")
+        return lines
+
+
+class Trace:
+    """一輪對話的追蹤：階段（span，有開始與結束）與里程碑（mark，相對於起點的時間）
+
+    起點是使用者說完話的時間（VAD 判斷語音結束），first_audio 里程碑即為 time-to-first-audio。
+    turn_id 作為關聯 id，會出現在事件、JSONL 紀錄與 log 中。
+    """
+
+    def __init__(self, tracer, session_id=None, started_at=None, turn_id=None):
+        self.tracer = tracer
+        self.session_id = session_id
+        self.turn_id = turn_id or uuid.uuid4().hex[:12]
+        self.started_at = started_at or time.time()
+        self.spans = []
+        self.marks = {}
+        self.attributes = {}
+        self._lock = threading.Lock()
+        self._finished = False
+        self._holds = {}  # 等待中的里程碑 -> 計時器
+        self._finish_requested = False
+
+    def add_span(self, name, start, end, **attributes):
+        if end < start:
+            return
+        with self._lock:
+            self.spans.append({"name": name, "start": round(start - self.started_at, 4),
+                               "duration": round(end - start, 4), **attributes})
+        self.tracer.stages.observe(name, end - start)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        start = time.time()
+        try:
+            yield self
+        finally:
+            self.add_span(name, start, time.time(), **attributes)
+
+    def mark(self, name, at=None):
+        """記錄里程碑（同名只記第一次）"""
+        at = at or time.time()
+        with self._lock:
+            if name in self.marks:
+                return
+            self.marks[name] = round(at - self.started_at, 4)
+        self.tracer.milestones.observe(name, at - self.started_at)
+        self.release(name)
+
+    def hold_until(self, name, timeout=10.0):
+        """finish() 之後仍等里程碑 name 記下（最多 timeout 秒）才寫出紀錄
+
+        本機播放由播放執行緒非同步通知 first_audio，worker 回傳時可能還沒開始播放。
+        """
+        with self._lock:
+            if self._finished or name in self.marks or name in self._holds:
+                return
+            timer = threading.Timer(timeout, self.release, args=(name,))
+            timer.daemon = True
+            self._holds[name] = timer
+        timer.start()
+
+    def release(self, name):
+        """不再等待里程碑 name（例如確定不會播放任何音訊）"""
+        with self._lock:
+            timer = self._holds.pop(name, None)
+            ready = timer is not None and self._finish_requested and not self._holds
+        if timer is not None:
+            timer.cancel()
+        if ready:
+            self._write()
+
+    def set(self, **attributes):
+        with self._lock:
+            self.attributes.update(attributes)
+
+    def finish(self):
+        """記下 turn_end；有 hold_until 等待中的里程碑時，等它們記下或逾時才寫出紀錄"""
+        with self._lock:
+            if self._finish_requested:
+                return
+            self._finish_requested = True
+        self.mark("turn_end")
+        with self._lock:
+            if self._holds:
+                return
+        self._write()
+
+    def _write(self):
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+        self.tracer.turns.inc(self.attributes.get("command_type", "none"))
+        record = self.to_dict()
+        self.tracer.write(record)
+        if self.tracer.on_finish:
+            self.tracer.on_finish(record)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "turn_id": self.turn_id,
+                "session_id": self.session_id,
+                "started_at": round(self.started_at, 4),
+                "attributes": dict(self.attributes),
+                "marks": dict(self.marks),
+                "spans": list(self.spans),
+            }
+
+
+class Tracer:
+    """收集所有 session 的追蹤：階段耗時與里程碑直方圖、每輪的 JSONL 紀錄（TRACE_LOG 有設定時）"""
+
+    def __init__(self, log_path=None, on_finish=None, window=1000):
+        self.stages = Histogram("voice_stage_duration_seconds", "Duration of each pipeline stage in a turn.", "stage",
+                                window=window)
+        self.milestones = Histogram("voice_turn_milestone_seconds",
+                                    "Time from end of user speech to each milestone (first_audio = time to first audio).",
+                                    "milestone", window=window)
+        self.turns = Counter("voice_turns_total", "Completed turns by command type.", "command_type")
+        self.log_path = log_path if log_path is not None else os.getenv('TRACE_LOG') or None
+        self.on_finish = on_finish  # on_finish(record)：每輪結束時呼叫（例如壓測工具等待回應完成）
+        self._log = None
+        self._log_lock = threading.Lock()
+
+    def start(self, session_id=None, started_at=None):
+        return Trace(self, session_id, started_at)
+
+    @contextmanager
+    def activate(self, trace):
+        """在這個範圍內（含以 contextvars 傳遞的執行緒）span() / mark() 都記到 trace"""
+        token = _current.set(trace)
+        try:
+            yield trace
+        finally:
+            _current.reset(token)
+            trace.finish()
+
+    def write(self, record):
+        if not self.log_path:
+            return
+        line = json.dumps(record, ensure_ascii=False)
+        with self._log_lock:
+            try:
+                if self._log is None:
+                    os.makedirs(os.path.dirname(os.path.abspath(self.log_path)), exist_ok=True)
+                    self._log = open(self.log_path, 'a', encoding='utf-8', buffering=1)
+                self._log.write(line + "\n")
+            except OSError as e:
+                print(f"⚠️ 追蹤紀錄寫入失敗：{e}")
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = self.stages.render() + self.milestones.render() + self.turns.render()
+        return "\n".join(lines) + "\n"
+
+    def stats(self):
+        return {"stages": self.stages.summary(), "milestones": self.milestones.summary()}
+
+
+def current_trace():
+    return _current.get()
+
+
+@contextmanager
+def span(name, **attributes):
+    """目前這輪的階段計時；沒有進行中的追蹤時不做任何事"""
+    trace = _current.get()
+    if trace is None:
+        yield None
+        return
+    with trace.span(name, **attributes):
+        yield trace
+
+
+def mark(name):
+    trace = _current.get()
+    if trace is not None:
+        trace.mark(name)
+
+
+_default_tracer = None
+_default_lock = threading.Lock()
+
+
+def default_tracer():
+    """整個行程共用一個 Tracer（/metrics 匯出的就是它）"""
+    global _default_tracer
+    with _default_lock:
+        if _default_tracer is None:
+            _default_tracer = Tracer()
+        return _default_tracer
@@ -0,0 +1,140 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Polly 輸出格式 -> 磁碟檔案副檔名
+FORMAT_EXTENSIONS = {"mp3": "mp3", "pcm": "pcm", "ogg_vorbis": "ogg"}
+
+
+class TTSCache:
+    """內容定址的語音快取
+
+    key 為 (SSML 文字, voice_id, 語速, 輸出格式) 的 SHA-256。
+    兩層：記憶體 LRU（memory_items 筆）與磁碟（總大小超過 max_disk_bytes 時淘汰最久未使用的檔案）。
+    副檔名依每筆的輸出格式決定（put 時指定，預設 extension），不同格式的項目可共用同一個目錄與容量上限。
+    """
+
+    def __init__(self, cache_dir=None, memory_items=64, max_disk_bytes=200 * 1024 * 1024, extension="mp3"):
+        self.cache_dir = cache_dir or os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'tts_cache'))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.memory_items = memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.extension = extension
+        self._memory = OrderedDict()
+        self._disk = OrderedDict()  # key -> (檔案大小, 副檔名)，依最近使用排序
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._load_index()
+
+    @staticmethod
+    def make_key(text, voice_id, rate, output_format):
+        raw = "\x1f".join([text, voice_id, rate, output_format])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key, extension):
+        return os.path.join(self.cache_dir, f"{key}.{extension}")
+
+    def _load_index(self):
+        extensions = set(FORMAT_EXTENSIONS.values()) | {self.extension}
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            key, _, extension = name.rpartition(".")
+            if extension not in extensions:
+                continue
+            stat = os.stat(os.path.join(self.cache_dir, name))
+            entries.append((stat.st_mtime, key, stat.st_size, extension))
+        for _, key, size, extension in sorted(entries):
+            self._disk[key] = (size, extension)
+            self._disk_bytes += size
+
+    def _remember(self, key, audio):
+        self._memory[key] = audio
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """依序查記憶體與磁碟，命中磁碟時提升到記憶體；未命中回傳 None"""
+        with self._lock:
+            audio = self._memory.get(key)
+            if audio is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return audio
+            entry = self._disk.get(key)
+
+        if entry is not None:
+            path = self._path(key, entry[1])
+            try:
+                with open(path, "rb") as f:
+                    audio = f.read()
+                os.utime(path)
+            except OSError:
+                audio = None
+            with self._lock:
+                if audio is not None:
+                    self._disk.move_to_end(key)
+                    self._remember(key, audio)
+                    self.disk_hits += 1
+                    return audio
+                size, _ = self._disk.pop(key, (0, None))
+                self._disk_bytes -= size
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, audio, output_format=None):
+        """output_format 為 Polly 的輸出格式，決定磁碟檔案的副檔名"""
+        if not audio:
+            return
+        extension = FORMAT_EXTENSIONS.get(output_format, self.extension)
+        with self._lock:
+            self._remember(key, audio)
+            if key in self._disk:
+                return
+        path = self._path(key, extension)
+        try:
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(audio)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"⚠️ 語音快取寫入失敗：{e}")
+            return
+
+        with self._lock:
+            self._disk[key] = (len(audio), extension)
+            self._disk_bytes += len(audio)
+            self._evict()
+
+    def _evict(self):
+        while self._disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+            key, (size, extension) = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key, extension))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,175 @@
+import math
+import numpy as np
+
+# webrtcvad 為可選依賴，未安裝時只使用能量 VAD
+try:
+    import webrtcvad
+except ImportError:
+    webrtcvad = None
+
+
+class RingBuffer:
+    """預先配置的 int16 環形緩衝區，用來保留語音起點前的 pre-roll"""
+
+    def __init__(self, capacity, dtype=np.int16):
+        self.capacity = int(capacity)
+        self._buf = np.zeros(self.capacity, dtype=dtype)
+        self._write = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def push(self, samples):
+        """寫入一段樣本，超出容量時覆蓋最舊的資料"""
+        n = len(samples)
+        if self.capacity == 0 or n == 0:
+            return
+        if n >= self.capacity:
+            self._buf[:] = samples[-self.capacity:]
+            self._write = 0
+            self._size = self.capacity
+            return
+
+        end = self._write + n
+        if end <= self.capacity:
+            self._buf[self._write:end] = samples
+        else:
+            first = self.capacity - self._write
+            self._buf[self._write:] = samples[:first]
+            self._buf[:n - first] = samples[first:]
+        self._write = end % self.capacity
+        self._size = min(self.capacity, self._size + n)
+
+    def read_into(self, out):
+        """依時間順序把內容複製到 out，回傳寫入的樣本數"""
+        start = (self._write - self._size) % self.capacity if self.capacity else 0
+        first = min(self._size, self.capacity - start)
+        out[:first] = self._buf[start:start + first]
+        out[first:self._size] = self._buf[:self._size - first]
+        return self._size
+
+    def read(self):
+        out = np.empty(self._size, dtype=self._buf.dtype)
+        self.read_into(out)
+        return out
+
+    def clear(self):
+        self._write = 0
+        self._size = 0
+
+
+class EnergyVAD:
+    """自適應噪音底的能量 VAD：RMS 超過 max(min_rms, 噪音底 × threshold_ratio) 視為語音"""
+
+    def __init__(self, threshold_ratio=3.0, min_rms=1000.0, initial_floor=200.0,
+                 floor_alpha=0.05, floor_rise_alpha=0.002):
+        # min_rms=1000 約等於舊版 300 ms 幀上 norm > 70000 的門檻
+        self.threshold_ratio = threshold_ratio
+        self.min_rms = min_rms
+        self.initial_floor = initial_floor
+        self.floor_alpha = floor_alpha
+        self.floor_rise_alpha = floor_rise_alpha
+        self.noise_floor = initial_floor
+
+    def rms(self, frame):
+        samples = np.asarray(frame, dtype=np.float32)
+        if samples.size == 0:
+            return 0.0
+        return float(np.sqrt(np.mean(samples * samples)))
+
+    def threshold(self):
+        return max(self.min_rms, self.noise_floor * self.threshold_ratio)
+
+    def is_speech(self, frame):
+        level = self.rms(frame)
+        speech = level > self.threshold()
+        # 靜音時快速追蹤噪音底；語音時只緩慢上升，避免環境噪音持續變大後永遠判定為語音
+        alpha = self.floor_rise_alpha if speech else self.floor_alpha
+        self.noise_floor += alpha * (level - self.noise_floor)
+        return speech
+
+    def reset(self):
+        self.noise_floor = self.initial_floor
+
+
+class WebRTCVAD:
+    """webrtcvad 逐幀分類（僅支援 10/20/30 ms 幀），並以能量 VAD 擋掉低音量雜訊"""
+
+    FRAME_MS = (10, 20, 30)
+
+    def __init__(self, sample_rate=16000, aggressiveness=2, energy_gate=None):
+        if webrtcvad is None:
+            raise ImportError("需要安裝 webrtcvad 才能使用 WebRTCVAD：pip install webrtcvad")
+        if sample_rate not in (8000, 16000, 32000, 48000):
+            raise ValueError(f"webrtcvad 不支援取樣率 {sample_rate}")
+        self.sample_rate = sample_rate
+        self._vad = webrtcvad.Vad(aggressiveness)
+        self.energy_gate = energy_gate if energy_gate is not None else EnergyVAD(min_rms=300.0)
+
+    def is_speech(self, frame):
+        samples = np.ascontiguousarray(frame, dtype=np.int16)
+        frame_ms = len(samples) * 1000 // self.sample_rate
+        if frame_ms not in self.FRAME_MS:
+            raise ValueError(f"webrtcvad 幀長需為 10/20/30 ms，收到 {frame_ms} ms")
+        # 能量閘門仍需每幀更新噪音底，因此先計算
+        loud = self.energy_gate.is_speech(samples)
+        return loud and self._vad.is_speech(samples.tobytes(), self.sample_rate)
+
+    def reset(self):
+        self.energy_gate.reset()
+
+
+def create_vad(mode="auto", sample_rate=16000, aggressiveness=2):
+    """建立 VAD：'energy'、'webrtc' 或 'auto'（有安裝 webrtcvad 時使用 webrtc）"""
+    if mode == "energy" or (mode == "auto" and webrtcvad is None):
+        return EnergyVAD()
+    if mode in ("webrtc", "auto"):
+        return WebRTCVAD(sample_rate=sample_rate, aggressiveness=aggressiveness)
+    raise ValueError(f"未知的 VAD 模式: {mode}")
+
+
+class Endpointer:
+    """語音端點偵測狀態機，以幀為單位計時
+
+    update() 回傳：
+    - "start"：連續 start_ms 語音，開始一段語句
+    - "end"：語句後靜音超過 hangover_ms，且語音長度足夠
+    - "discard"：語句結束但語音太短（咳嗽、敲擊聲）
+    - None：狀態不變
+    """
+
+    def __init__(self, frame_ms=30, start_ms=90, hangover_ms=300, min_speech_ms=150):
+        self.frame_ms = frame_ms
+        self.start_frames = max(1, math.ceil(start_ms / frame_ms))
+        self.hangover_frames = max(1, math.ceil(hangover_ms / frame_ms))
+        self.min_speech_frames = max(1, math.ceil(min_speech_ms / frame_ms))
+        self.reset()
+
+    def reset(self):
+        self.triggered = False
+        self._run = 0
+        self._voiced = 0
+        self._silence = 0
+
+    def update(self, is_speech):
+        if not self.triggered:
+            self._run = self._run + 1 if is_speech else 0
+            if self._run >= self.start_frames:
+                self.triggered = True
+                self._voiced = self._run
+                self._silence = 0
+                return "start"
+            return None
+
+        if is_speech:
+            self._voiced += 1
+            self._silence = 0
+            return None
+
+        self._silence += 1
+        if self._silence >= self.hangover_frames:
+            voiced = self._voiced
+            self.reset()
+            return "end" if voiced >= self.min_speech_frames else "discard"
+        return None
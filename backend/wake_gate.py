@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+
+WAKE_WORDS = ("你好",)
+SLEEP_WORDS = ("再見",)
+
+
+class WakeWordGate:
+    """對話模式狀態機，放在雲端 STT 前面：只有對助手說的話才送 Whisper
+
+    sleeping --(喚醒詞)--> awake --(結束詞 / 閒置 timeout 秒)--> sleeping
+
+    - sleeping 時語句一律擋下（計入 suppressed），不開串流辨識、不呼叫 endpoint
+    - 喚醒詞後面緊接著的話（同一段語句）照常送出，「你好，今天天氣如何」不必分兩次說
+    - is_busy() 為真（助手還在說話）時不會逾時
+    喚醒 / 結束詞由 keyword_spotter.KeywordSpotter 在裝置端偵測，經 on_keyword() 傳入。
+    """
+
+    def __init__(self, wake_words=WAKE_WORDS, sleep_words=SLEEP_WORDS, timeout=None, is_busy=None,
+                 on_change=None):
+        self.wake_words = tuple(wake_words)
+        self.sleep_words = tuple(sleep_words)
+        self.timeout = timeout or float(os.getenv('WAKE_TIMEOUT', '30'))
+        self.is_busy = is_busy
+        self.on_change = on_change
+        self.state = "sleeping"
+        self.last_active = 0.0
+        self._lock = threading.Lock()
+        self.wakes = 0
+        self.sleeps = 0
+        self.timeouts = 0
+        self.forwarded = 0
+        self.suppressed = 0
+        self.suppressed_seconds = 0.0
+
+    def _set_state(self, state, reason):
+        with self._lock:
+            if self.state == state:
+                self.last_active = time.time()
+                return
+            self.state = state
+            self.last_active = time.time()
+        print(f"✅ 對話模式：{'已喚醒' if state == 'awake' else '休眠'}（{reason}）")
+        if self.on_change:
+            self.on_change(state, reason)
+
+    def wake(self, reason="wake_word"):
+        self.wakes += 1
+        self._set_state("awake", reason)
+
+    def sleep(self, reason="sleep_word"):
+        self.sleeps += 1
+        self._set_state("sleeping", reason)
+
+    def poll(self):
+        """閒置超過 timeout 秒就回到休眠；回傳目前是否醒著"""
+        if self.state != "awake":
+            return False
+        if self.is_busy and self.is_busy():
+            self.last_active = time.time()
+            return True
+        if time.time() - self.last_active > self.timeout:
+            self.timeouts += 1
+            self._set_state("sleeping", "timeout")
+            return False
+        return True
+
+    def touch(self):
+        """使用者正在說話：還沒逾時就重新計時"""
+        if self.poll():
+            self.last_active = time.time()
+
+    @property
+    def awake(self):
+        return self.poll()
+
+    def on_keyword(self, keyword):
+        """處理喚醒 / 結束詞，回傳 True；其他關鍵詞（控制指令）回傳 False"""
+        if keyword in self.wake_words:
+            self.wake()
+            return True
+        if keyword in self.sleep_words:
+            if self.state == "awake":
+                self.sleep()
+            return True
+        return False
+
+    def allow(self, utterance):
+        """語句結束時呼叫：醒著就放行（並重新計時），否則擋下"""
+        if self.poll():
+            self.forwarded += 1
+            self.last_active = time.time()
+            return True
+        self.suppressed += 1
+        self.suppressed_seconds += utterance.duration
+        return False
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "timeout": self.timeout,
+            "wakes": self.wakes,
+            "sleeps": self.sleeps,
+            "timeouts": self.timeouts,
+            "forwarded": self.forwarded,
+            "suppressed": self.suppressed,
+            "suppressed_seconds": round(self.suppressed_seconds, 1),
+        }
@@ -17,6 +17,9 @@ export default function App() {
   const sweat = useRef()
   const mouth = useRef()
   const questions = useRef([])
+  const eventSource = useRef(null)
+
+  useEffect(() => () => eventSource.current && eventSource.current.close(), [])
 
   useEffect(() => {
     const handleKeyDown = (e) => {
@@ -131,14 +134,18 @@ export default function App() {
     try {
       await axios.post("http://localhost:5001/process_audio")
   
-      const intervalId = setInterval(async () => {
-        const status = await axios.get("http://localhost:5001/audio_status")
-        console.log(status.data)  // ✅ 正確 debug
-        setState(status.data.state)
-        if (status.data.has_new) {
-          setFullText(status.data.reply)
-        }
-      }, 1000)
+      // ✅ 改用 SSE 推播，不再每秒輪詢 /audio_status；斷線時瀏覽器會自動帶 Last-Event-ID 重連
+      if (eventSource.current) eventSource.current.close()
+      const source = new EventSource("http://localhost:5001/events")
+      eventSource.current = source
+      const parse = (e) => JSON.parse(e.data)
+
+      source.addEventListener('state', (e) => setState(parse(e).state))
+      source.addEventListener('transcript', (e) => {
+        const { text, final } = parse(e)
+        setFullText(final ? `🎙️ ${text}` : `🎙️ ${text}...`)
+      })
+      source.addEventListener('reply', (e) => setFullText(parse(e).text))
     } catch (err) {
       console.error(err)
       setFullText("❌ 發生錯誤，請稍後再試")